@@ -1,19 +1,21 @@
-from fastapi import APIRouter, Request, Depends, Form, HTTPException, status, UploadFile, File
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, RedirectResponse, HTMLResponse
+from fastapi import APIRouter, Request, Depends, Form, HTTPException, status, UploadFile, File, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, RedirectResponse, HTMLResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Any, Optional, List, Union
+import asyncio
 import datetime # 引入datetime
+import functools
 import os # for checking file existence
 import uuid # For generating report ID
 import json
-import pandas as pd
-import tempfile
 import csv
 from io import BytesIO
 import logging
 from sqlalchemy.orm import Session
 
 # 导入服务和认证依赖
-from Predict.app.services import predictor_service
+from Predict.app.services import batch_jobs, predictor_service
+from Predict.app.api import websocket
 from Predict.app.services.auth import get_current_user
 from Predict.app.models.user import User  # 导入 User 模型用于类型提示
 from Predict.app.services import auth
@@ -61,11 +63,14 @@ async def get_models_list():
              responses={400: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
 async def run_single_prediction(
     payload: SinglePredictionRequest, # Accept Pydantic model as request body
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
-    """Receives JSON data, executes single prediction, generates report, and returns results.
+    """Receives JSON data, executes single prediction, and returns results with a report handle.
 
-    Uses Pydantic model `SinglePredictionRequest` for input validation.
+    Uses Pydantic model `SinglePredictionRequest` for input validation. The PDF report is
+    rendered lazily on first download from a persisted prediction snapshot, or prerendered
+    in the background when `REPORT_PRERENDER` is enabled.
     """
     try:
         # Convert Pydantic model to dict, respecting aliases for field names
@@ -73,15 +78,17 @@ async def run_single_prediction(
         form_data_raw = payload.dict(by_alias=True)  # 使用 dict() 而不是 model_dump() 兼容 Pydantic v1
 
         # 1. Prepare input data (applies mapping, encoding, sorting)
-        input_df = predictor_service.prepare_single_input(form_data_raw)
+        input_row = predictor_service.prepare_single_input(form_data_raw)
         
-        # 2. Execute prediction (gets all model results)
-        prediction_result = predictor_service.predict_single(input_df)
+        # 2. Execute prediction (gets all model results); concurrent requests are coalesced into one batch
+        prediction_result = await predictor_service.prediction_coalescer.submit(input_row)
         
-        # 3. Generate PDF report and get path
+        # 3. Persist a snapshot for the report; the PDF itself is rendered on demand
         report_id = str(uuid.uuid4())
-        # Pass the original raw form data (before encoding) to the report function for display
-        report_filepath = predictor_service.generate_single_report(form_data_raw, prediction_result, report_id)
+        # Keep the original raw form data (before encoding) for display in the report
+        await run_in_threadpool(predictor_service.save_prediction_snapshot, report_id, form_data_raw, prediction_result)
+        if predictor_service.REPORT_PRERENDER:
+            background_tasks.add_task(predictor_service.prerender_report, report_id)
 
         # 保存预测记录到数据库
         try:
@@ -109,9 +116,13 @@ async def run_single_prediction(
             probabilities=prediction_result.get('probabilities'),
             risk_level=prediction_result.get('risk_level'),
             feature_contributions=prediction_result.get('feature_contributions'),
+            feature_contribution_type=prediction_result.get('feature_contribution_type'),
+            models_evaluated=prediction_result.get('models_evaluated'),
+            models_dropped=prediction_result.get('models_dropped'),
+            models_failed=prediction_result.get('models_failed'),
             report_id=report_id,
             download_report_url=f"/api/predictor/download_report/{report_id}",
-            message="预测成功完成，报告已生成。"
+            message="预测成功完成，报告可通过下载链接获取。"
         )
 
     except ValueError as ve:
@@ -125,124 +136,140 @@ async def run_single_prediction(
         predictor_service.logger.error(f"单例预测 API 出错: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="预测过程中发生内部错误。")
 
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 中任一实体标签 (忽略弱校验前缀 W/) 与 etag 相同或为 * 时返回 True。"""
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any(tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
 # 新增：下载单例预测报告的 API 端点
 @router.get("/download_report/{report_id}")
-async def download_single_report(report_id: str, current_user: User = Depends(get_current_user)):
-    """根据报告 ID 下载对应的单例预测 PDF 报告。"""
+async def download_single_report(report_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    """根据报告 ID 下载对应的单例预测 PDF 报告，首次下载时根据预测快照在内存中生成。
+
+    响应带有内容地址 ETag；请求的 If-None-Match 与之相同时返回 304，不生成也不传输报告。
+    """
     report_filename = f"report_{report_id}.pdf"
-    report_filepath = predictor_service.REPORTS_DIR / report_filename
 
-    if not os.path.exists(report_filepath):
-        predictor_service.logger.warning(f"尝试下载不存在的报告: {report_filepath}")
+    try:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            content_key = await asyncio.to_thread(predictor_service.get_report_content_key, report_id)
+            etag = f'"{content_key}"'
+            if _etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        content_key, report_bytes = await predictor_service.get_report_bytes(report_id)
+    except FileNotFoundError:
+        predictor_service.logger.warning(f"尝试下载不存在的报告: {report_id}")
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="找不到指定的预测报告文件。")
+    except RuntimeError as re:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(re))
 
-    return FileResponse(
-        path=report_filepath,
-        filename=report_filename,
-        media_type='application/pdf'
+    return StreamingResponse(
+        content=predictor_service.iter_bytes_chunks(report_bytes),
+        media_type='application/pdf',
+        headers={
+            "Content-Disposition": f"attachment; filename={report_filename}",
+            "Content-Length": str(len(report_bytes)),
+            "ETag": f'"{content_key}"'
+        }
     )
 
 # --- 批量预测 API --- 
+def _require_admin(current_user: User, detail: str):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+
 @router.post("/batch_predict")
 async def run_batch_prediction_with_all_models(
+    request: Request,
     file: UploadFile = File(...),
+    client_id: Optional[str] = Form(None),
+    result_format: Optional[str] = Form(None),
     current_user: User = Depends(get_current_user)
 ):
-    """批量预测API（仅管理员可访问）"""
-    # 检查用户是否是管理员
-    if current_user.role != "admin":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="需要管理员权限执行批量预测"
-        )
+    """提交批量预测任务（仅管理员可访问）
+
+    上传文件写入磁盘后立即返回任务 ID，预测在后台分块进行。进度可通过 GET /jobs/{job_id} 查询；
+    提供 client_id 时同时通过 WebSocket (/api/ws/ws/{client_id}) 推送每块的进度，但只有该 WebSocket 连在
+    接收本请求的同一 worker 进程上时才能收到；多 worker 部署时以轮询任务状态为准。
+    result_format 为结果文件格式 (xlsx / csv)，省略时使用配置的默认格式。
+    """
+    _require_admin(current_user, "需要管理员权限执行批量预测")
     
     predictor_service.logger.info(f"接收到批量预测请求，文件：{file.filename}, 文件大小：{file.size if hasattr(file, 'size') else '未知'}")
-    predictor_service.logger.info(f"请求头：{dict(request.headers)}")
     
     if not file.filename.endswith(('.csv', '.xlsx', '.xls')):
         predictor_service.logger.warning(f"文件格式错误：{file.filename}")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="文件格式错误，请上传 CSV 或 Excel 文件。")
             
+    # 转换当前用户为TokenData格式，每块结果随推理批量保存到该用户的预测历史
+    user_data = TokenData(
+        sub=str(current_user.id), 
+        username=current_user.username
+    )
+    notify = functools.partial(websocket.send_progress_update, client_id) if client_id else None
     try:
-        # 使用所有可用模型进行批量预测 (不再需要特定的model_key)
-        predictor_service.logger.info("开始处理批量预测文件")
-        batch_id, result_filepath = await predictor_service.process_batch_file_with_all_models(file)
-        predictor_service.logger.info(f"批量预测处理完成，批次ID：{batch_id}, 结果路径：{result_filepath}")
-        
-        # 保存批量预测记录到数据库
-        try:
-            # 转换当前用户为TokenData格式
-            user_data = TokenData(
-                sub=str(current_user.id), 
-                username=current_user.username
-            )
-            
-            # 读取结果文件的内容
-            if result_filepath.endswith('.xlsx'):
-                results_df = pd.read_excel(result_filepath)
-            else:
-                results_df = pd.read_csv(result_filepath)
-            
-            # 保存每条预测记录
-            for index, row in results_df.iterrows():
-                row_dict = row.to_dict()
-                # 分离输入数据和预测结果
-                input_data = {k: v for k, v in row_dict.items() if k not in ['prediction', 'risk_level', 'probability']}
-                prediction_result = {
-                    "prediction": row_dict.get('prediction', None),
-                    "risk_level": row_dict.get('risk_level', '未知'),
-                    "probability": row_dict.get('probability', None)
-                }
-                
-                # 保存到数据库
-                await save_batch_prediction_history(
-                    user_data=user_data,
-                    batch_id=batch_id,
-                    input_data=input_data,
-                    prediction_result=prediction_result,
-                    risk_level=row_dict.get('risk_level', '未知')
-                )
-        except Exception as save_error:
-            # 记录错误但不中断预测流程
-            predictor_service.logger.error(f"保存批量预测历史记录时出错: {save_error}")
-        
-        # 检查Accept头
-        accept_header = request.headers.get("accept", "").lower()
-        predictor_service.logger.info(f"客户端接受的响应类型：{accept_header}")
-        
-        # 根据接受类型返回不同的响应
-        if "text/html" in accept_header:
-            # 如果客户端接受HTML响应，重定向到批量预测结果页面
-            redirect_url = f"/predictor/batch_results/{batch_id}"
-            predictor_service.logger.info(f"客户端请求HTML响应，重定向到：{redirect_url}")
-            return RedirectResponse(
-                url=redirect_url,
-                status_code=status.HTTP_303_SEE_OTHER
-            )
-        else:
-            # 如果客户端接受JSON，或没有指定，返回JSON响应
-            predictor_service.logger.info(f"客户端请求JSON响应或未指定，返回JSON结果")
-            json_response = {
-                "success": True,
-                "message": f"批量预测任务 {batch_id} 处理完成。",
-                "batch_id": batch_id,
-                "download_url": f"/api/predictor/download_batch_results/{batch_id}"
-            }
-            predictor_service.logger.info(f"返回JSON响应：{json_response}")
-            return JSONResponse(
-                content=json_response,
-                media_type="application/json; charset=utf-8"
-            )
+        job = await batch_jobs.job_manager.submit(
+            file,
+            owner=current_user.username,
+            notify=notify,
+            result_format=result_format,
+            history_user=user_data
+        )
     except ValueError as ve:
-        predictor_service.logger.error(f"处理批量预测文件时发生值错误: {ve}")
+        predictor_service.logger.error(f"提交批量预测任务时发生值错误: {ve}")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"处理文件失败: {str(ve)}")
     except RuntimeError as re:
-        predictor_service.logger.error(f"批量预测执行失败: {re}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"预测执行失败: {str(re)}")
+        predictor_service.logger.warning(f"批量预测任务队列已满: {re}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="批量预测任务较多，请稍后重试。")
     except Exception as e:
         predictor_service.logger.error(f"批量预测 API 出错: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="处理批量预测时发生内部错误。")
 
+    batch_id = job.job_id
+    # 检查Accept头
+    accept_header = request.headers.get("accept", "").lower()
+    if "text/html" in accept_header:
+        # 如果客户端接受HTML响应，重定向到批量预测结果页面 (页面轮询任务进度)
+        return RedirectResponse(
+            url=f"/predictor/batch_results/{batch_id}",
+            status_code=status.HTTP_303_SEE_OTHER
+        )
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={
+            "success": True,
+            "message": f"批量预测任务 {batch_id} 已提交。",
+            "batch_id": batch_id,
+            "job_id": batch_id,
+            "status": job.status,
+            "result_format": job.result_format,
+            "status_url": f"/api/predictor/jobs/{batch_id}",
+            "cancel_url": f"/api/predictor/jobs/{batch_id}/cancel",
+            "results_url": f"/predictor/batch_results/{batch_id}",
+            "download_url": f"/api/predictor/download_batch_results/{batch_id}"
+        },
+        media_type="application/json; charset=utf-8"
+    )
+
+@router.get("/jobs/{job_id}")
+async def get_batch_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """查询批量预测任务的状态和进度（仅管理员可访问）"""
+    _require_admin(current_user, "需要管理员权限查看批量预测任务")
+    job = batch_jobs.job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="找不到指定的批量预测任务。")
+    return job
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_batch_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """取消批量预测任务，正在处理的块完成后停止（仅管理员可访问）"""
+    _require_admin(current_user, "需要管理员权限取消批量预测任务")
+    job = batch_jobs.job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="找不到指定的批量预测任务。")
+    return job
+
 @router.get("/download_batch_results/{batch_id}")
 async def download_batch_results(
     batch_id: str, 
@@ -256,18 +283,93 @@ async def download_batch_results(
             detail="需要管理员权限下载批量预测结果"
         )
     
-    result_filename = f"batch_{batch_id}_results.xlsx"
-    result_filepath = predictor_service.BATCH_RESULTS_DIR / result_filename
+    try:
+        result_filepath = batch_jobs.get_batch_results_path(batch_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="找不到指定的批量预测结果文件。")
 
     if not os.path.exists(result_filepath):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="找不到指定的批量预测结果文件。")
 
+    await asyncio.to_thread(predictor_service.retention_janitor.touch, result_filepath)
     return FileResponse(
         path=result_filepath,
-        filename=result_filename,
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        filename=result_filepath.name,
+        media_type=batch_jobs.batch_results_media_type(result_filepath)
+    )
+
+@router.get("/download_batch_report/{batch_id}")
+async def download_batch_report(
+    batch_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """下载批量预测的多患者 PDF 报告（仅管理员可访问），首次请求时生成"""
+    # 检查用户是否是管理员
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="需要管理员权限下载批量预测报告"
+        )
+
+    try:
+        report_filepath = await batch_jobs.ensure_batch_report(batch_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="找不到指定的批量预测结果文件。")
+    except RuntimeError as re:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(re))
+
+    await asyncio.to_thread(predictor_service.retention_janitor.touch, report_filepath)
+    return StreamingResponse(
+        content=predictor_service.iter_file_chunks(report_filepath),
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f"attachment; filename={report_filepath.name}",
+            "Content-Length": str(report_filepath.stat().st_size),
+            "Access-Control-Expose-Headers": "Content-Disposition"
+        }
     )
 
+@router.post("/reload_models")
+async def reload_models(current_user: User = Depends(get_current_user)):
+    """热更新模型（仅管理员可访问）：在后台加载并预热 models/hapi_predictor 中的新模型后原子替换
+
+    本 worker 进程立即更新；多 worker 部署时其他进程通过热更新标记文件在 sync_interval_seconds 秒内各自更新。
+    """
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="需要管理员权限更新模型"
+        )
+    try:
+        result = await predictor_service.model_reloader.reload_all(f"管理员 {current_user.username} 触发")
+    except RuntimeError as re:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(re))
+    if result.get("broadcast"):
+        message = f"模型已更新，其他 worker 进程将在 {result['sync_interval_seconds']:.0f} 秒内完成更新"
+    else:
+        message = "本 worker 进程的模型已更新，但无法通知其他 worker 进程，请检查模型目录写权限或重启服务"
+    return {"message": message, **result}
+
+@router.get("/metrics")
+async def get_predictor_metrics(current_user: User = Depends(get_current_user)):
+    """获取预测服务的运行指标（仅管理员可访问）"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="需要管理员权限查看预测服务指标"
+        )
+    return {
+        "models": predictor_service.model_reloader.get_metrics(),
+        "coalescer": predictor_service.prediction_coalescer.get_metrics(),
+        "cache": predictor_service.prediction_cache.get_metrics(),
+        "inference_executor": predictor_service.inference_executor.get_metrics(),
+        "ensemble": predictor_service.ensemble_scheduler.get_metrics(),
+        "report_executor": predictor_service.report_executor.get_metrics(),
+        "report_store": predictor_service.report_store.get_metrics(),
+        "retention": predictor_service.retention_janitor.get_metrics(),
+        "batch_jobs": batch_jobs.job_manager.get_metrics()
+    }
+
 @router.get("/download_template")
 async def download_template(current_user: User = Depends(get_current_user)):
     """下载批量预测的 CSV 模板文件。"""
@@ -315,23 +417,6 @@ async def save_single_prediction_history(user_data: TokenData, input_data: dict,
         print(f"保存预测历史记录时出错: {e}")
         # 不抛出异常，继续处理预测结果
 
-async def save_batch_prediction_history(user_data: TokenData, batch_id: str, input_data: dict, prediction_result: dict, risk_level: str):
-    """保存批量预测历史记录"""
-    try:
-        if user_data:
-            await db.save_prediction_history(
-                user_id=user_data.sub,
-                username=user_data.username,
-                prediction_type="batch",
-                batch_id=batch_id,
-                input_data=input_data,
-                prediction_result=prediction_result,
-                risk_level=risk_level
-            )
-    except Exception as e:
-        print(f"保存批量预测历史记录时出错: {e}")
-        # 不抛出异常，继续处理预测结果
-
 # 添加获取预测历史记录的接口
 class PredictionHistoryResponse(BaseModel):
     id: int
@@ -395,54 +480,3 @@ async def run_prediction(request: Request, current_user: Optional[TokenData] = D
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"预测过程中出错: {str(e)}"
         )
-
-# 修改现有的批量预测API，添加保存历史记录的功能
-@router.post("/batch_predict")
-async def run_batch_prediction(file: UploadFile = File(...), current_user: Optional[TokenData] = Depends(auth.get_current_user_optional)):
-    """运行批量预测"""
-    try:
-        # 保存上传的文件到临时目录
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_file:
-            temp_file.write(await file.read())
-            temp_file_path = temp_file.name
-        
-        # 生成批次ID
-        batch_id = f"batch_{uuid.uuid4().hex[:8]}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
-        # 调用批量预测服务
-        result = predictor_service.process_batch_file(temp_file_path, batch_id)
-        
-        # 保存预测历史记录
-        if current_user and result.get("success") and result.get("data"):
-            # 对于批量预测，我们保存每条记录的预测结果
-            for idx, row in enumerate(result["data"]):
-                input_data = {k: v for k, v in row.items() if k not in ["prediction", "risk_level", "probability"]}
-                prediction_result = {
-                    "prediction": row.get("prediction", None),
-                    "risk_level": row.get("risk_level", "未知"),
-                    "probability": row.get("probability", None)
-                }
-                
-                await save_batch_prediction_history(
-                    user_data=current_user,
-                    batch_id=batch_id,
-                    input_data=input_data,
-                    prediction_result=prediction_result,
-                    risk_level=row.get("risk_level", "未知")
-                )
-        
-        # 清理临时文件
-        if os.path.exists(temp_file_path):
-            os.unlink(temp_file_path)
-        
-        return {
-            "success": result.get("success", False),
-            "batch_id": batch_id,
-            "message": result.get("message", ""),
-            "download_url": f"/api/predictor/download_batch_results/{batch_id}" if result.get("success") else None
-        }
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"批量预测过程中出错: {str(e)}"
-        ) 
@@ -16,7 +16,6 @@ from pathlib import Path
 from sqlalchemy.orm import Session
 from typing import Optional
 import datetime
-import pandas as pd
 import logging
 import asyncio
 
@@ -57,7 +56,7 @@ from Predict.app.api import websocket, auth, medical_qa, dashboard, feedback, pr
 from Predict.app.services.db import create_tables, get_db
 from Predict.app.services.auth import get_current_user, SECRET_KEY, ALGORITHM
 from Predict.app.models.user import User
-from Predict.app.services import predictor_service
+from Predict.app.services import batch_jobs, predictor_service
 from Predict.app.api import data_dashboard  # 导入数据看板API
 from Predict.app.services import db  # 导入数据库服务
 
@@ -87,6 +86,25 @@ async def startup_event():
     except Exception as e:
         logger.error(f"预测历史表初始化错误: {e}")
 
+    # 加载预测模型 (并行加载，MODEL_LAZY_MODELS 中的模型推迟到第一次使用)
+    await predictor_service.startup_models()
+
+    # 启动报告和批量结果目录的后台清理任务
+    predictor_service.retention_janitor.start()
+    # 启动模型文件监视 (MODEL_WATCH_ENABLED 开启时)
+    predictor_service.model_reloader.start()
+
+# 关闭事件
+@app.on_event("shutdown")
+async def shutdown_event():
+    await predictor_service.retention_janitor.stop()
+    await predictor_service.model_reloader.stop()
+    # 取消未完成的批量任务，再关闭推理和报告执行器的工作线程/进程
+    batch_jobs.job_manager.shutdown()
+    predictor_service.inference_executor.shutdown()
+    predictor_service.ensemble_scheduler.shutdown()
+    predictor_service.report_executor.shutdown()
+
 # 自定义异常处理器
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -182,29 +200,51 @@ async def batch_results_page(
             detail="需要管理员权限访问批量预测结果"
         )
     # 检查结果文件是否存在
-    result_filename = f"batch_{batch_id}_results.xlsx"
-    result_filepath = predictor_service.BATCH_RESULTS_DIR / result_filename
+    try:
+        result_filepath = batch_jobs.get_batch_results_path(batch_id)
+    except FileNotFoundError:
+        result_filepath = None
+    result_filename = result_filepath.name if result_filepath else f"batch_{batch_id}_results.xlsx"
     
-    if not os.path.exists(result_filepath):
+    if result_filepath is None or not os.path.exists(result_filepath):
+        # 任务仍在后台处理时显示进度页面，页面轮询任务状态，完成后自动刷新
+        job = batch_jobs.job_manager.get(batch_id)
+        if job is not None and job["status"] in ("queued", "processing"):
+            return templates.TemplateResponse(
+                "predictor/batch_results.html",
+                {
+                    "request": request,
+                    "username": current_user.username,
+                    "job": job,
+                    "filename": job["filename"],
+                    "now": datetime.datetime.now()
+                }
+            )
         # 结果文件不存在，返回错误
+        error_message = "找不到指定的批量预测结果文件。"
+        if job is not None and job["status"] in ("failed", "cancelled"):
+            error_message = f"批量预测任务未完成: {job['message']}"
         return templates.TemplateResponse(
             "error.html", 
             {
                 "request": request,
                 "username": current_user.username,
-                "error_message": "找不到指定的批量预测结果文件。"
+                "error_message": error_message
             }, 
             status_code=404
         )
     
     try:
-        # 使用pandas读取结果文件
-        df_results = pd.read_excel(result_filepath)
+        # 行数、风险等级分布等来自批次摘要文件，不再解析结果文件 (旧批次首次访问时生成一次)
+        manifest = await asyncio.to_thread(batch_jobs.load_batch_manifest, batch_id)
         
         # 创建简单的结果对象
         results = {
             "batch_id": batch_id,
-            "file_count": len(df_results),
+            "file_count": manifest["row_count"],
+            "risk_level_counts": manifest.get("risk_level_counts", {}),
+            "models": [model["name"] for model in manifest.get("models", [])],
+            "timings_ms": manifest.get("timings_ms"),
             "download_url": f"/api/predictor/download_batch_results/{batch_id}"
         }
         
@@ -215,7 +255,7 @@ async def batch_results_page(
                 "request": request,
                 "username": current_user.username,
                 "results": results,
-                "filename": result_filename,
+                "filename": manifest.get("source_filename") or result_filename,
                 "now": datetime.datetime.now()
             }
         )
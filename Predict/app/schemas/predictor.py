@@ -39,7 +39,11 @@ class SinglePredictionResponse(BaseModel):
     predictions: Optional[Any] = None
     probabilities: Optional[Any] = None
     feature_contributions: Optional[Any] = None
+    feature_contribution_type: Optional[str] = None  # global: 全局特征重要性; patient: 逐患者贡献值 (对数几率)
     risk_level: Optional[str] = None
+    models_evaluated: Optional[Any] = None  # 实际运行的模型 (级联模式下可能少于全部模型)
+    models_dropped: Optional[Any] = None  # 超过截止时间或已降级而未计入的模型及原因
+    models_failed: Optional[Any] = None  # 推理出错的模型
     report_id: Optional[str] = None
     download_report_url: Optional[str] = None
     message: str
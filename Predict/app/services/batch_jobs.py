@@ -0,0 +1,840 @@
+"""
+批量预测任务
+
+上传文件落盘后按块流式处理: 逐块读取输入 (csv / xlsx)，推理提交到预测服务的 inference_executor，
+结果逐块写入结果文件 (BatchResultSink)，完成时写入批次摘要 (batch_<id>_manifest.json)。
+BatchJobManager 在后台线程中运行任务，并把任务状态写入结果目录，多个 worker 进程都能查询和取消。
+批量 PDF 报告由预测服务的报告模板生成，本模块只负责确定文件路径和合并并发请求。
+
+配置项 (BATCH_*) 与预测服务其他配置一起在 config.ini 的 [predictor] 段中读取。
+"""
+import asyncio
+import codecs
+import csv
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+import openpyxl
+import pandas as pd
+from fastapi import UploadFile
+
+from Predict.app.services import db, predictor_service
+from Predict.app.services.predictor_service import (
+    BATCH_CHUNK_ROWS, BATCH_ENCODING_PROBE_BYTES, BATCH_JOB_FINISHED_STATUSES, BATCH_JOB_HEARTBEAT_SECONDS,
+    BATCH_JOB_HISTORY, BATCH_JOB_MAX_QUEUE, BATCH_JOB_STALE_SECONDS, BATCH_JOB_WORKERS, BATCH_RESULTS_DIR,
+    BATCH_RESULT_FORMAT, BATCH_SPOOL_CHUNK_BYTES, EXPECTED_FEATURES, MODEL_NAMES,
+    ManagedExecutor, ModelSet, current_model_set, display_value, iter_batch_result_rows,
+    predict_batch_with_all_models, prepare_batch_input,
+)
+
+logger = logging.getLogger("batch_jobs")
+
+BATCH_PATIENT_INFO_FIELDS = ["患者ID", "患者姓名", "序号", "年龄"]
+# Excel 单个工作表的最大行数 (含表头)
+EXCEL_MAX_ROWS = 1048576
+
+async def spool_upload(file: UploadFile, target_path: Path, chunk_bytes: int = BATCH_SPOOL_CHUNK_BYTES) -> int:
+    """把上传文件分块复制到磁盘，返回字节数 (不把整个文件读入内存)。"""
+    total = 0
+    with open(target_path, 'wb') as target:
+        while True:
+            chunk = await file.read(chunk_bytes)
+            if not chunk:
+                break
+            target.write(chunk)
+            total += len(chunk)
+    return total
+
+def detect_csv_encoding(filepath: Path, probe_bytes: int = BATCH_ENCODING_PROBE_BYTES) -> str:
+    """根据文件开头的字节判断 CSV 编码: 带 BOM 的 UTF-8、UTF-8，否则按 GBK 处理。"""
+    with open(filepath, 'rb') as f:
+        prefix = f.read(probe_bytes)
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # 前缀末尾可能截断一个多字节字符，使用增量解码器只校验完整的字符
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'gbk'
+
+def _xlsx_header(values) -> list:
+    # 与 pandas.read_excel 一致，空表头命名为 "Unnamed: 列号"
+    return [f"Unnamed: {i}" if value is None else str(value) for i, value in enumerate(values)]
+
+def iter_batch_input_chunks(filepath: Path, ext: str, chunk_rows: int = None):
+    """按固定行数逐块读取批量输入文件，每块为一个 DataFrame，内存占用与文件大小无关。
+
+    CSV 使用 pandas 分块解析 (编码只在开头检测一次)，xlsx 使用 openpyxl 只读模式逐行读取；
+    旧版 .xls 格式无法流式读取，整体读入后再分块。
+    """
+    chunk_rows = max(1, chunk_rows or BATCH_CHUNK_ROWS)
+    if ext == '.csv':
+        encoding = detect_csv_encoding(filepath)
+        logger.info(f"批量输入文件编码: {encoding}")
+        try:
+            with pd.read_csv(filepath, encoding=encoding, chunksize=chunk_rows) as reader:
+                for chunk in reader:
+                    yield chunk
+        except UnicodeDecodeError as e:
+            raise ValueError(f"文件编码不一致，无法按 {encoding} 解析: {e}")
+    elif ext == '.xlsx':
+        workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            # 部分软件导出的文件记录的表格范围不准确，忽略它并读到最后一行
+            sheet.reset_dimensions()
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            header = _xlsx_header(header)
+            width = len(header)
+            buffer = []
+            for values in rows:
+                if all(value is None for value in values):
+                    continue
+                buffer.append(tuple(values[:width]) + (None,) * (width - len(values)))
+                if len(buffer) >= chunk_rows:
+                    yield pd.DataFrame(buffer, columns=header).infer_objects()
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=header).infer_objects()
+        finally:
+            workbook.close()
+    elif ext == '.xls':
+        input_df = pd.read_excel(filepath)
+        for offset in range(0, len(input_df), chunk_rows):
+            yield input_df.iloc[offset:offset + chunk_rows].reset_index(drop=True)
+    else:
+        raise ValueError(f"不支持的文件类型: {ext}")
+
+def estimate_batch_rows(filepath: Path, ext: str):
+    """估计输入文件的数据行数 (用于显示进度)，无法估计时返回 None。
+
+    CSV 按换行符计数 (引号内的换行会使估计偏大)，xlsx 使用工作表记录的范围。
+    """
+    if ext == '.csv':
+        count = 0
+        last_block = b''
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(BATCH_SPOOL_CHUNK_BYTES), b''):
+                count += block.count(b'\n')
+                last_block = block
+        if last_block and not last_block.endswith(b'\n'):
+            count += 1
+        return max(0, count - 1)
+    if ext == '.xlsx':
+        workbook = openpyxl.load_workbook(filepath, read_only=True)
+        try:
+            max_row = workbook.worksheets[0].max_row
+        finally:
+            workbook.close()
+        return max(0, max_row - 1) if max_row else None
+    return None
+
+def build_batch_result_frame(input_df: pd.DataFrame, prediction_results: dict) -> pd.DataFrame:
+    """把一块输入数据与其预测结果合并为结果表的对应行 (列顺序: 患者标识、其余输入、各模型、综合结果、贡献、真实标签)。"""
+    result_df = pd.DataFrame(index=input_df.index)
+
+    # 首先添加患者标识字段（如果存在）
+    for field in BATCH_PATIENT_INFO_FIELDS:
+        if field in input_df.columns:
+            result_df[field] = input_df[field]
+
+    # 添加原始输入数据的其他字段（排除患者标识字段和actual_label）
+    for col in input_df.columns:
+        if col not in BATCH_PATIENT_INFO_FIELDS and col != "actual_label":
+            result_df[col] = input_df[col]
+
+    # 添加各模型的预测结果
+    for model_key in prediction_results["model_predictions"]:
+        if model_key in MODEL_NAMES:
+            model_name = MODEL_NAMES[model_key]
+            result_df[f"{model_name}_概率"] = prediction_results["model_probabilities"][model_key]
+            result_df[f"{model_name}_预测"] = prediction_results["model_predictions"][model_key]
+
+    # 添加综合结果
+    result_df["综合预测概率"] = prediction_results["ensemble_probabilities"]
+    result_df["综合预测结果"] = prediction_results["ensemble_predictions"]
+    result_df["风险级别"] = prediction_results["risk_levels"]
+
+    # 逐患者特征贡献列 (FEATURE_CONTRIBUTIONS = patient 时)
+    contribution_frames = [
+        pd.DataFrame(matrix, index=result_df.index,
+                     columns=[f"{MODEL_NAMES[model_key]}_贡献_{feature}" for feature in EXPECTED_FEATURES])
+        for model_key, matrix in prediction_results.get("feature_contributions", {}).items()
+    ]
+    if contribution_frames:
+        result_df = pd.concat([result_df, *contribution_frames], axis=1)
+
+    # 如果有真实标签，添加到结果中
+    if "actual_label" in input_df.columns:
+        result_df["真实标签"] = input_df["actual_label"]
+    return result_df
+
+def iter_batch_history_rows(input_df: pd.DataFrame, result_df: pd.DataFrame):
+    """把一块结果逐行转换为预测历史记录 (输入数据, 预测结果, 风险级别)，供 db.PredictionHistoryWriter 写入。"""
+    inputs = input_df.drop(columns=["actual_label"], errors="ignore")
+    inputs = inputs.astype(object).where(inputs.notna(), None).to_dict('records')
+    for input_data, prediction, probability, risk_level in zip(
+            inputs, result_df["综合预测结果"].tolist(), result_df["综合预测概率"].tolist(), result_df["风险级别"].tolist()):
+        prediction_result = {"prediction": prediction, "risk_level": risk_level, "probability": probability}
+        yield input_data, prediction_result, risk_level
+
+class BatchResultSink:
+    """批量结果的流式写入器: 结果按块写入 .part 文件，abort() 丢弃。
+
+    finish() 生成完整的 .part 文件，publish() 把它原子替换为最终文件 (commit() 依次执行两者)；
+    两步之间可以写入依赖结果的其他文件 (例如批次摘要)，保证最终文件出现时它们已经存在。
+
+    第一块决定列顺序，之后的块按相同的列写入。子类实现 _write_header / _write_rows / _finish / _discard。
+    """
+
+    format = None
+    media_type = None
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.partial_path = self.path.with_name(self.path.name + '.part')
+        self.columns = None
+        self.rows = 0
+
+    def write_chunk(self, result_df: pd.DataFrame):
+        if self.columns is None:
+            self.columns = list(result_df.columns)
+            self._write_header(self.columns)
+        else:
+            result_df = result_df.reindex(columns=self.columns)
+        self._write_rows(result_df)
+        self.rows += len(result_df)
+
+    def finish(self):
+        self._finish()
+
+    def publish(self) -> Path:
+        os.replace(self.partial_path, self.path)
+        return self.path
+
+    def commit(self) -> Path:
+        self.finish()
+        return self.publish()
+
+    def abort(self):
+        try:
+            self._discard()
+        finally:
+            if self.partial_path.exists():
+                self.partial_path.unlink()
+
+    def _write_header(self, columns: list):
+        raise NotImplementedError
+
+    def _write_rows(self, result_df: pd.DataFrame):
+        raise NotImplementedError
+
+    def _finish(self):
+        raise NotImplementedError
+
+    def _discard(self):
+        pass
+
+class XlsxResultSink(BatchResultSink):
+    """openpyxl 只写模式: 行数据直接序列化到临时文件，内存中不保留单元格对象。"""
+
+    format = 'xlsx'
+    media_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("Sheet1")
+
+    def write_chunk(self, result_df: pd.DataFrame):
+        if self.rows + len(result_df) >= EXCEL_MAX_ROWS:
+            raise ValueError(f"文件行数超过 Excel 工作表上限 ({EXCEL_MAX_ROWS - 1} 行)，请拆分后再上传或选择 CSV 格式")
+        super().write_chunk(result_df)
+
+    def _write_header(self, columns: list):
+        self.sheet.append(columns)
+
+    def _write_rows(self, result_df: pd.DataFrame):
+        # NaN 写为空单元格 (与 DataFrame.to_excel 一致)
+        values = result_df.astype(object).where(result_df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            self.sheet.append(row)
+
+    def _finish(self):
+        self.workbook.save(self.partial_path)
+
+    def _discard(self):
+        # 中止时关闭工作表并删除 openpyxl 的行数据临时文件 (否则要到进程退出时才删除)
+        writer = self.sheet._writer
+        if self.sheet.closed or writer is None:
+            return
+        try:
+            self.sheet.close()
+        finally:
+            writer.cleanup()
+
+class CsvResultSink(BatchResultSink):
+    """CSV 格式，带 BOM 的 UTF-8 编码 (Excel 可直接打开中文列名)，写入速度远高于 xlsx。"""
+
+    format = 'csv'
+    media_type = 'text/csv; charset=utf-8'  # BOM 已在文件内容中，utf-8-sig 不是合法的 charset 名称
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._file = open(self.partial_path, 'w', encoding='utf-8-sig', newline='')
+
+    def _write_header(self, columns: list):
+        csv.writer(self._file).writerow(columns)
+
+    def _write_rows(self, result_df: pd.DataFrame):
+        result_df.to_csv(self._file, header=False, index=False)
+
+    def _finish(self):
+        self._file.close()
+
+    def _discard(self):
+        self._file.close()
+
+# 批量结果文件格式 -> 写入器
+BATCH_RESULT_SINKS = {sink.format: sink for sink in (XlsxResultSink, CsvResultSink)}
+
+def normalize_result_format(result_format: str = None) -> str:
+    """校验批量结果格式，省略时使用 BATCH_RESULT_FORMAT。"""
+    result_format = (result_format or BATCH_RESULT_FORMAT).strip().lower()
+    if result_format not in BATCH_RESULT_SINKS:
+        raise ValueError(f"不支持的结果文件格式: {result_format}，可选: {', '.join(BATCH_RESULT_SINKS)}")
+    return result_format
+
+def create_result_sink(batch_id: str, result_format: str = None) -> BatchResultSink:
+    result_format = normalize_result_format(result_format)
+    return BATCH_RESULT_SINKS[result_format](BATCH_RESULTS_DIR / f"batch_{batch_id}_results.{result_format}")
+
+def run_batch_pipeline(input_path: Path, ext: str, sink: BatchResultSink, model_set: ModelSet = None,
+                       chunk_rows: int = None, progress=None, on_results=None, finalize=None) -> dict:
+    """流式批量预测: 逐块读取、编码、推理，并把结果逐块交给 sink 写入，返回批次摘要 (见 write_batch_manifest)。
+
+    每块的推理提交到 inference_executor (队列已满时等待空位)，内存中只保留当前一块数据；全部完成后 sink 才生成最终文件，
+    出错或取消时丢弃已写入的部分。progress(累计行数) 在每块完成后调用，抛出异常即中止任务 (用于取消)。
+    on_results(输入块, 结果块) 在每块写入后调用 (例如保存预测历史)。
+    finalize(摘要) 在结果文件写完、但尚未出现在最终路径之前调用 (例如写入批次摘要)，出错时结果文件被丢弃。
+    """
+    model_set = model_set or current_model_set()
+    chunk_rows = max(1, chunk_rows or BATCH_CHUNK_ROWS)
+    timings = {"read": 0.0, "prepare": 0.0, "predict": 0.0, "write": 0.0, "history": 0.0}
+    risk_level_counts = {}
+    models = []
+    total_rows = 0
+    chunks = 0
+    started = time.perf_counter()
+    try:
+        input_chunks = iter_batch_input_chunks(input_path, ext, chunk_rows)
+        while True:
+            t = time.perf_counter()
+            input_df = next(input_chunks, None)
+            timings["read"] += time.perf_counter() - t
+            if input_df is None:
+                break
+            if input_df.empty:
+                continue
+            if chunks == 0 and "actual_label" in input_df.columns:
+                logger.info("检测到actual_label列，将进行模型评估")
+
+            # 数据预处理（仅处理预测相关字段）
+            t = time.perf_counter()
+            processed_df = prepare_batch_input(input_df.drop(columns=["actual_label"], errors="ignore"))
+            timings["prepare"] += time.perf_counter() - t
+            t = time.perf_counter()
+            # 推理队列被单例请求占满时等待空位，而不是让整个批量任务失败
+            prediction_results = predictor_service.inference_executor.submit(predict_batch_with_all_models, processed_df, model_set, block=True).result()
+            timings["predict"] += time.perf_counter() - t
+            t = time.perf_counter()
+            result_df = build_batch_result_frame(input_df, prediction_results)
+            sink.write_chunk(result_df)
+            timings["write"] += time.perf_counter() - t
+            if on_results is not None:
+                t = time.perf_counter()
+                on_results(input_df, result_df)
+                timings["history"] += time.perf_counter() - t
+
+            if not models:
+                models = [key for key in prediction_results["model_predictions"] if key in MODEL_NAMES]
+            for level, count in result_df["风险级别"].value_counts(dropna=False).items():
+                level = '未知' if pd.isna(level) else str(level)
+                risk_level_counts[level] = risk_level_counts.get(level, 0) + int(count)
+            total_rows += len(input_df)
+            chunks += 1
+            logger.info(f"批量预测第 {chunks} 块完成，累计 {total_rows} 行")
+            if progress is not None:
+                progress(total_rows)
+
+        if total_rows == 0:
+            raise ValueError("上传的文件为空或无法读取。")
+        t = time.perf_counter()
+        sink.finish()
+        timings["write"] += time.perf_counter() - t
+
+        total = time.perf_counter() - started
+        summary = {
+            "row_count": total_rows,
+            "chunk_rows": chunk_rows,
+            "chunks": chunks,
+            "risk_level_counts": risk_level_counts,
+            "models": [{"key": key, "name": MODEL_NAMES[key]} for key in models],
+            "model_set_version": model_set.version,
+            "result_file": sink.path.name,
+            "result_format": sink.format,
+            "columns": sink.columns,
+            "timings_ms": {**{stage: round(value * 1000, 1) for stage, value in timings.items()},
+                           "total": round(total * 1000, 1)},
+            "rows_per_second": round(total_rows / total, 1) if total > 0 else None,
+        }
+        if finalize is not None:
+            finalize(summary)
+        sink.publish()
+    except BaseException:
+        sink.abort()
+        raise
+    return summary
+
+# --- 结果文件路径与批次摘要 ---
+def get_batch_results_path(batch_id: str) -> Path:
+    """返回批量预测结果文件路径 (xlsx 或 csv 中已存在的一个，都不存在时为 xlsx 路径)，batch_id 必须是合法的 UUID。"""
+    try:
+        normalized_id = str(uuid.UUID(batch_id))
+    except (ValueError, TypeError, AttributeError):
+        raise FileNotFoundError(f"无效的批次 ID: {batch_id}")
+    for result_format in BATCH_RESULT_SINKS:
+        result_path = BATCH_RESULTS_DIR / f"batch_{normalized_id}_results.{result_format}"
+        if result_path.exists():
+            return result_path
+    return BATCH_RESULTS_DIR / f"batch_{normalized_id}_results.xlsx"
+
+def batch_results_media_type(result_path: Path) -> str:
+    for sink in BATCH_RESULT_SINKS.values():
+        if result_path.suffix == f".{sink.format}":
+            return sink.media_type
+    return 'application/octet-stream'
+
+def get_batch_report_path(batch_id: str) -> Path:
+    """返回批量 PDF 报告的存放路径。"""
+    return get_batch_results_path(batch_id).with_name(f"batch_{batch_id}_report.pdf")
+
+
+def get_batch_manifest_path(batch_id: str) -> Path:
+    """返回批次摘要文件路径，batch_id 必须是合法的 UUID。"""
+    return get_batch_results_path(batch_id).with_name(f"batch_{str(uuid.UUID(batch_id))}_manifest.json")
+
+def write_batch_manifest(batch_id: str, summary: dict, **extra) -> dict:
+    """批次完成时写入摘要文件 (行数、风险等级分布、模型列表、各阶段耗时、列结构)，页面和汇总直接读取它而不再解析结果文件。"""
+    manifest = {"batch_id": batch_id, "created_at": datetime.now().isoformat(), **extra, **summary}
+    manifest_path = get_batch_manifest_path(batch_id)
+    tmp_path = manifest_path.with_name(f".{manifest_path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+def _scan_batch_manifest(batch_id: str) -> dict:
+    """没有摘要文件的旧批次: 流式扫描一次结果文件得到行数、风险等级分布和列结构。"""
+    result_path = get_batch_results_path(batch_id)
+    row_count = 0
+    risk_level_counts = {}
+    columns = None
+    for rows in iter_batch_result_rows(result_path):
+        if columns is None:
+            columns = list(rows[0])
+        for row in rows:
+            level = display_value(row.get("风险级别"), default='未知')
+            risk_level_counts[level] = risk_level_counts.get(level, 0) + 1
+        row_count += len(rows)
+    models = [{"key": key, "name": name} for key, name in MODEL_NAMES.items() if columns and f"{name}_概率" in columns]
+    return {
+        "row_count": row_count,
+        "risk_level_counts": risk_level_counts,
+        "models": models,
+        "result_file": result_path.name,
+        "result_format": result_path.suffix.lstrip('.'),
+        "columns": columns or [],
+    }
+
+def load_batch_manifest(batch_id: str) -> dict:
+    """读取批次摘要；旧批次没有摘要文件时扫描一次结果文件并补写。结果不存在时抛出 FileNotFoundError。"""
+    manifest_path = get_batch_manifest_path(batch_id)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        logger.warning(f"批次摘要 {manifest_path.name} 无法解析，将重新生成: {e}")
+    if not get_batch_results_path(batch_id).exists():
+        raise FileNotFoundError(f"找不到批次 {batch_id} 的预测结果")
+    logger.info(f"批次 {batch_id} 没有摘要文件，扫描结果文件生成")
+    return write_batch_manifest(batch_id, _scan_batch_manifest(batch_id), rebuilt=True)
+
+_batch_report_renders = {}  # 批次 ID -> 正在生成的批量报告 (Future)
+
+async def ensure_batch_report(batch_id: str) -> Path:
+    """返回批量 PDF 报告路径，尚未生成时通过报告执行器生成 (同一批次的并发请求共享一次生成)。"""
+    report_filepath = get_batch_report_path(batch_id)
+    if report_filepath.exists():
+        return report_filepath
+    result_path = get_batch_results_path(batch_id)
+    if not result_path.exists():
+        raise FileNotFoundError(f"找不到批次 {batch_id} 的预测结果")
+
+    async def render_report():
+        total_rows = (await asyncio.to_thread(load_batch_manifest, batch_id))["row_count"]
+        return await predictor_service.report_executor.run(
+            predictor_service.generate_batch_report, batch_id, result_path, report_filepath, total_rows)
+
+    render = _batch_report_renders.get(batch_id)
+    if render is None:
+        render = asyncio.ensure_future(render_report())
+        _batch_report_renders[batch_id] = render
+        render.add_done_callback(lambda _: _batch_report_renders.pop(batch_id, None))
+        logger.info(f"开始生成批量 PDF 报告: {batch_id}")
+    return await asyncio.shield(render)
+
+# --- 后台批量任务 ---
+class BatchJobCancelled(RuntimeError):
+    """批量任务已被取消。"""
+
+class BatchJob:
+    """一个后台批量预测任务的状态。任务 ID 同时也是批次 ID (结果文件名和下载地址沿用批次 ID)。"""
+
+    def __init__(self, job_id: str, filename: str, ext: str, owner=None, result_format: str = 'xlsx', history_user=None):
+        self.job_id = job_id
+        self.filename = filename
+        self.ext = ext
+        self.owner = owner
+        self.history_user = history_user
+        self.result_format = result_format
+        self.status = 'queued'
+        self.progress = 0.0
+        self.rows_done = 0
+        self.total_rows = None
+        self.message = '等待处理'
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result_path = BATCH_RESULTS_DIR / f"batch_{job_id}_results.{result_format}"
+        self.upload_path = BATCH_RESULTS_DIR / f"batch_{job_id}_upload{ext}"
+        self.cancel_event = threading.Event()
+        self.manifest = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in BatchJobManager.FINISHED
+
+    def to_dict(self) -> dict:
+        timestamp = lambda value: datetime.fromtimestamp(value).isoformat() if value else None
+        return {
+            "job_id": self.job_id,
+            "batch_id": self.job_id,
+            "filename": self.filename,
+            "owner": self.owner,
+            "pid": os.getpid(),
+            "heartbeat_at": time.time(),
+            "result_format": self.result_format,
+            "status": self.status,
+            "progress": round(self.progress, 1),
+            "rows_done": self.rows_done,
+            "total_rows": self.total_rows,
+            "message": self.message,
+            "error": self.error,
+            "created_at": timestamp(self.created_at),
+            "started_at": timestamp(self.started_at),
+            "finished_at": timestamp(self.finished_at),
+            "download_url": f"/api/predictor/download_batch_results/{self.job_id}" if self.status == 'completed' else None,
+            "risk_level_counts": self.manifest["risk_level_counts"] if self.manifest else None,
+        }
+
+class BatchJobManager:
+    """后台批量预测任务: 上传文件落盘后立即返回任务 ID，由 batch 执行器中的线程流式处理。
+
+    每块完成后更新进度，并通过 notify(task_id, progress, status, message) 协程 (例如 WebSocket 推送) 通知客户端。
+    notify 只能送达本进程持有的 WebSocket 连接: 多 worker 部署时客户端的 WebSocket 通常连在其他进程上，
+    推送会被丢弃，此时应轮询 GET /jobs/{job_id} (结果页面即采用轮询)。
+    任务状态同时写入结果目录的 batch_<id>_job.json，多个 worker 进程部署时任一进程都能查询；
+    状态文件记录运行进程的 pid 和心跳时间，未结束的任务超过 stale_seconds 没有心跳即视为失败。
+    取消请求若不在本进程，则写入取消标记文件，由运行任务的进程在下一块开始前检查。
+    """
+
+    FINISHED = BATCH_JOB_FINISHED_STATUSES
+
+    def __init__(self, workers: int = BATCH_JOB_WORKERS, max_queue: int = BATCH_JOB_MAX_QUEUE,
+                 history: int = BATCH_JOB_HISTORY, heartbeat_seconds: float = BATCH_JOB_HEARTBEAT_SECONDS,
+                 stale_seconds: float = BATCH_JOB_STALE_SECONDS):
+        self.executor = ManagedExecutor('batch', 'thread', workers, max_queue)
+        self.history = max(1, int(history))
+        self.heartbeat_seconds = max(1.0, float(heartbeat_seconds))
+        self.stale_seconds = max(self.heartbeat_seconds * 2, float(stale_seconds))
+        self._jobs = OrderedDict()  # 任务 ID -> BatchJob
+        self._lock = threading.Lock()
+        self._heartbeat_stop = threading.Event()
+        self._watchers = set()  # 各任务的 _watch 任务 (事件循环只持有弱引用)
+        self._heartbeat_thread = None
+
+    @staticmethod
+    def _normalize_id(job_id: str):
+        try:
+            return str(uuid.UUID(job_id))
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    @staticmethod
+    def _status_path(job_id: str) -> Path:
+        return BATCH_RESULTS_DIR / f"batch_{job_id}_job.json"
+
+    @staticmethod
+    def _cancel_marker(job_id: str) -> Path:
+        return BATCH_RESULTS_DIR / f".batch_{job_id}.cancel"
+
+    def _save(self, job: BatchJob):
+        status_path = self._status_path(job.job_id)
+        tmp_path = status_path.with_name(f".{status_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, status_path)
+        except OSError as e:
+            logger.warning(f"写入批量任务 {job.job_id} 状态文件失败: {e}")
+
+    def _start_heartbeat(self):
+        if self._heartbeat_thread is not None:
+            return
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='batch-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        # 排队中或单块处理较慢的任务也要定期刷新状态文件，供其他进程判断任务是否仍在运行
+        while not self._heartbeat_stop.wait(self.heartbeat_seconds):
+            with self._lock:
+                running = [job for job in self._jobs.values() if not job.finished]
+            for job in running:
+                self._save(job)
+
+    def _notify(self, job: BatchJob, loop, notify):
+        if notify is None:
+            return
+        async def send():
+            try:
+                await notify(job.job_id, round(job.progress, 1), job.status, job.message)
+            except Exception as e:
+                logger.warning(f"推送批量任务 {job.job_id} 进度失败: {e}")
+        # 进度回调在工作线程中执行，需要回到事件循环发送
+        asyncio.run_coroutine_threadsafe(send(), loop)
+
+    async def submit(self, file: UploadFile, owner=None, notify=None, on_complete=None, result_format: str = None,
+                     history_user=None) -> BatchJob:
+        """把上传文件写入磁盘并提交后台任务，返回 BatchJob。
+
+        on_complete(job) 为结果文件生成后在事件循环中执行的协程；
+        result_format 为结果文件格式 (xlsx / csv)，省略时使用 BATCH_RESULT_FORMAT；
+        提供 history_user (带 sub 和 username 的 TokenData) 时，每块结果随推理批量写入该用户的预测历史。
+        文件类型或结果格式不支持时抛出 ValueError，任务队列已满时抛出 RuntimeError。
+        """
+        ext = os.path.splitext(file.filename or '')[1].lower()
+        if ext not in ('.csv', '.xlsx', '.xls'):
+            raise ValueError(f"不支持的文件类型: {ext}")
+        result_format = normalize_result_format(result_format)
+        os.makedirs(BATCH_RESULTS_DIR, exist_ok=True)
+        job = BatchJob(str(uuid.uuid4()), file.filename, ext, owner, result_format, history_user)
+        try:
+            size = await spool_upload(file, job.upload_path)
+            job.total_rows = await asyncio.to_thread(estimate_batch_rows, job.upload_path, ext)
+            loop = asyncio.get_running_loop()
+            # 整个任务使用提交时的模型集快照，不受期间的模型热更新影响
+            future = self.executor.submit(self.run_job, job, current_model_set(), functools.partial(self._on_chunk, job, loop, notify))
+        except Exception:
+            if job.upload_path.exists():
+                job.upload_path.unlink()
+            raise
+        logger.info(f"批量任务 {job.job_id} 已提交: {job.filename} ({size / 1024 / 1024:.1f} MB, 约 {job.total_rows} 行)")
+        with self._lock:
+            self._jobs[job.job_id] = job
+        self._save(job)
+        self._start_heartbeat()
+        watcher = loop.create_task(self._watch(job, future, loop, notify, on_complete))
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+        return job
+
+    def run_job(self, job: BatchJob, model_set: ModelSet, progress) -> dict:
+        """在 batch 执行器的线程中运行一个任务，写入批次摘要并返回它。"""
+        if job.cancel_event.is_set():
+            raise BatchJobCancelled(f"批量任务 {job.job_id} 已取消")
+        job.status = 'processing'
+        job.started_at = time.time()
+        job.message = '正在处理'
+        self._save(job)
+        sink = BATCH_RESULT_SINKS[job.result_format](job.result_path)
+        writer = None
+        if job.history_user is not None:
+            writer = db.PredictionHistoryWriter(job.history_user.sub, job.history_user.username, "batch", job.job_id)
+        manifest = {}
+
+        def finalize(summary: dict):
+            # 预测历史和批次摘要都在结果文件出现之前完成，页面看到结果文件时摘要一定已经存在
+            history = None
+            if writer is not None:
+                try:
+                    history = writer.close()
+                except Exception as e:
+                    logger.error(f"批量任务 {job.job_id} 保存预测历史记录时出错: {e}")
+                    writer.discard()
+            manifest.update(write_batch_manifest(
+                job.job_id, summary, source_filename=job.filename, owner=job.owner,
+                submitted_at=datetime.fromtimestamp(job.created_at).isoformat(),
+                queue_wait_ms=round((job.started_at - job.created_at) * 1000, 1), history=history))
+
+        try:
+            run_batch_pipeline(job.upload_path, job.ext, sink, model_set, None, progress,
+                               functools.partial(self._save_history, job, writer) if writer else None, finalize)
+        except BaseException:
+            # 任务失败或取消时删除已写入的预测历史和摘要，与结果文件一起丢弃
+            if writer is not None:
+                writer.discard()
+            get_batch_manifest_path(job.job_id).unlink(missing_ok=True)
+            raise
+        return manifest
+
+    def _save_history(self, job: BatchJob, writer, input_df: pd.DataFrame, result_df: pd.DataFrame):
+        # 预测历史写入失败不影响预测结果: 记录错误后本任务不再写入历史
+        if job.history_user is None:
+            return
+        try:
+            writer.extend(iter_batch_history_rows(input_df, result_df))
+        except Exception as e:
+            logger.error(f"批量任务 {job.job_id} 保存预测历史记录时出错，后续结果不再保存: {e}")
+            job.history_user = None
+            writer.discard()
+
+    def _on_chunk(self, job: BatchJob, loop, notify, rows_done: int):
+        job.rows_done = rows_done
+        if job.cancel_event.is_set() or self._cancel_marker(job.job_id).exists():
+            raise BatchJobCancelled(f"批量任务 {job.job_id} 已取消")
+        if job.total_rows:
+            # 行数只是估计值，完成前最多显示 99%
+            job.progress = min(99.0, rows_done * 100.0 / job.total_rows)
+        job.message = f"已处理 {rows_done} 行"
+        self._save(job)
+        self._notify(job, loop, notify)
+
+    async def _watch(self, job: BatchJob, future, loop, notify, on_complete):
+        try:
+            job.manifest = await asyncio.wrap_future(future)
+            rows = job.manifest["row_count"]
+            job.rows_done = rows
+            if on_complete is not None:
+                job.message = '正在保存预测记录'
+                try:
+                    await on_complete(job)
+                except Exception as e:
+                    logger.error(f"批量任务 {job.job_id} 完成回调出错: {e}", exc_info=True)
+            job.status = 'completed'
+            job.progress = 100.0
+            job.message = f"批量预测完成，共 {rows} 行"
+        except BatchJobCancelled:
+            job.status = 'cancelled'
+            job.message = '任务已取消'
+        except ValueError as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.message = f"处理文件失败: {e}"
+        except Exception as e:
+            logger.error(f"批量任务 {job.job_id} 失败: {e}", exc_info=True)
+            job.status = 'failed'
+            job.error = str(e)
+            job.message = '批量预测处理失败'
+        finally:
+            job.finished_at = time.time()
+            for path in (job.upload_path, self._cancel_marker(job.job_id)):
+                if path.exists():
+                    path.unlink()
+            self._save(job)
+            self._notify(job, loop, notify)
+            self._prune()
+            elapsed = job.finished_at - (job.started_at or job.created_at)
+            logger.info(f"批量任务 {job.job_id} 结束: {job.status}, {job.rows_done} 行, 耗时 {elapsed:.1f} 秒")
+
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self._jobs[job_id]
+
+    def get(self, job_id: str):
+        """返回任务状态字典，任务不存在时返回 None。本进程没有该任务时读取状态文件。"""
+        job_id = self._normalize_id(job_id)
+        if job_id is None:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        try:
+            with open(self._status_path(job_id), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+                modified_at = os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError):
+            return None
+        if state.get("status") not in self.FINISHED:
+            heartbeat_at = state.get("heartbeat_at") or modified_at
+            if time.time() - heartbeat_at > self.stale_seconds:
+                # 运行任务的进程已退出 (崩溃或重启)，任务不会再有进展
+                state["status"] = 'failed'
+                state["error"] = f"进程 {state.get('pid')} 超过 {self.stale_seconds:.0f} 秒没有心跳"
+                state["message"] = '批量任务所在的进程已停止，请重新提交'
+        return state
+
+    def cancel(self, job_id: str):
+        """请求取消任务 (当前块完成后停止)，返回任务状态字典；任务不存在时返回 None。"""
+        job_id = self._normalize_id(job_id)
+        if job_id is None:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            if not job.finished:
+                job.cancel_event.set()
+                job.message = '正在取消'
+            return job.to_dict()
+        state = self.get(job_id)
+        if state is not None and state.get("status") not in self.FINISHED:
+            # 任务在其他 worker 进程中运行
+            self._cancel_marker(job_id).touch()
+            state["message"] = '正在取消'
+        return state
+
+    def shutdown(self):
+        """取消所有未结束的任务并等待当前块完成。"""
+        self._heartbeat_stop.set()
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.finished:
+                    job.cancel_event.set()
+        self.executor.shutdown()
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"jobs": counts, "executor": self.executor.get_metrics()}
+
+job_manager = BatchJobManager()
@@ -1,6 +1,7 @@
 import os
 import logging
 import configparser
+import time
 from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -20,6 +21,8 @@ DB_PASSWORD = "!!Wy040105"
 DB_HOST = "localhost"
 DB_PORT = "3306"
 DB_NAME = "mission1_db"
+# 批量写入预测历史时每个事务 (一条多行 INSERT) 包含的行数
+HISTORY_BULK_CHUNK_ROWS = 1000
 
 # 如果存在配置文件，则从文件中读取数据库配置
 if os.path.exists(config_file):
@@ -30,6 +33,7 @@ if os.path.exists(config_file):
         DB_HOST = config['database'].get('DB_HOST', DB_HOST)
         DB_PORT = config['database'].get('DB_PORT', DB_PORT)
         DB_NAME = config['database'].get('DB_NAME', DB_NAME)
+        HISTORY_BULK_CHUNK_ROWS = config['database'].getint('HISTORY_BULK_CHUNK_ROWS', HISTORY_BULK_CHUNK_ROWS)
 
 # 构建数据库URL
 DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
@@ -89,15 +93,16 @@ async def create_prediction_history_table():
     finally:
         db.close()
 
+INSERT_PREDICTION_HISTORY_SQL = text("""
+    INSERT INTO prediction_history 
+    (user_id, username, prediction_type, batch_id, input_data, prediction_result, risk_level) 
+    VALUES (:user_id, :username, :prediction_type, :batch_id, :input_data, :prediction_result, :risk_level)
+""")
+
 async def save_prediction_history(user_id, username, prediction_type, input_data, prediction_result, risk_level, batch_id=None):
     """保存预测历史记录"""
     db = SessionLocal()
     try:
-        insert_sql = text("""
-            INSERT INTO prediction_history 
-            (user_id, username, prediction_type, batch_id, input_data, prediction_result, risk_level) 
-            VALUES (:user_id, :username, :prediction_type, :batch_id, :input_data, :prediction_result, :risk_level)
-        """)
         params = {
             "user_id": user_id,
             "username": username,
@@ -107,7 +112,7 @@ async def save_prediction_history(user_id, username, prediction_type, input_data
             "prediction_result": json.dumps(prediction_result),
             "risk_level": risk_level
         }
-        result = db.execute(insert_sql, params)
+        result = db.execute(INSERT_PREDICTION_HISTORY_SQL, params)
         db.commit()
         return result.lastrowid
     except Exception as e:
@@ -117,6 +122,116 @@ async def save_prediction_history(user_id, username, prediction_type, input_data
     finally:
         db.close()
 
+class PredictionHistoryWriter:
+    """批量写入预测历史记录。
+
+    行先缓存在内存中，每满 chunk_rows 行用一次 executemany (PyMySQL 会改写为多行 INSERT) 在一个事务中提交，
+    整个写入过程只占用一个数据库连接。方法均为同步调用，应在工作线程中使用，不要在事件循环中直接调用。
+    """
+
+    def __init__(self, user_id, username, prediction_type="batch", batch_id=None, chunk_rows: int = None):
+        self.base = {
+            "user_id": user_id,
+            "username": username,
+            "prediction_type": prediction_type,
+            "batch_id": batch_id
+        }
+        self.chunk_rows = max(1, chunk_rows or HISTORY_BULK_CHUNK_ROWS)
+        self.rows = 0
+        self.chunks = 0
+        self.elapsed = 0.0
+        self._pending = []
+        self._connection = None
+
+    def add(self, input_data, prediction_result, risk_level):
+        self._pending.append({
+            **self.base,
+            "input_data": json.dumps(input_data, default=str),
+            "prediction_result": json.dumps(prediction_result, default=str),
+            "risk_level": risk_level
+        })
+        if len(self._pending) >= self.chunk_rows:
+            self.flush()
+
+    def extend(self, rows):
+        """rows 为 (输入数据, 预测结果, 风险等级) 的可迭代对象，逐行读取，不会一次性展开。"""
+        for input_data, prediction_result, risk_level in rows:
+            self.add(input_data, prediction_result, risk_level)
+
+    def flush(self):
+        """在一个事务中写入缓存的行。"""
+        if not self._pending:
+            return
+        started = time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = engine.connect()
+            with self._connection.begin():
+                self._connection.execute(INSERT_PREDICTION_HISTORY_SQL, self._pending)
+        except Exception as e:
+            logger.error(f"批量保存预测历史记录时出错: {e}")
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - started
+        self.rows += len(self._pending)
+        self.chunks += 1
+        self._pending = []
+
+    def stats(self) -> dict:
+        return {
+            "rows": self.rows,
+            "chunks": self.chunks,
+            "elapsed_ms": round(self.elapsed * 1000, 1),
+            "rows_per_second": round(self.rows / self.elapsed, 1) if self.elapsed > 0 else None
+        }
+
+    def close(self) -> dict:
+        """写入剩余的行并释放连接，返回写入统计 (行数、事务数、耗时、每秒行数)。"""
+        try:
+            self.flush()
+        finally:
+            self._release()
+        stats = self.stats()
+        logger.info(f"批量保存预测历史记录 {stats['rows']} 条, {stats['chunks']} 个事务, "
+                    f"耗时 {stats['elapsed_ms']} 毫秒, {stats['rows_per_second']} 行/秒")
+        return stats
+
+    def discard(self):
+        """丢弃缓存的行，并删除本批次已提交的记录 (批量任务失败或取消时调用)。"""
+        self._pending = []
+        try:
+            if self.rows and self.base["batch_id"] is not None:
+                if self._connection is None:
+                    self._connection = engine.connect()
+                with self._connection.begin():
+                    self._connection.execute(
+                        text("DELETE FROM prediction_history WHERE batch_id = :batch_id"),
+                        {"batch_id": self.base["batch_id"]}
+                    )
+                self.rows = 0
+        except Exception as e:
+            logger.error(f"删除批次 {self.base['batch_id']} 的预测历史记录时出错: {e}")
+        finally:
+            self._release()
+
+    def _release(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+def save_prediction_history_bulk(rows, user_id, username, prediction_type="batch", batch_id=None, chunk_rows: int = None) -> dict:
+    """批量保存预测历史记录，rows 为 (输入数据, 预测结果, 风险等级) 的可迭代对象 (可以是生成器)。
+
+    每 chunk_rows 行提交一个事务，出错时已提交的事务不回滚。同步执行，返回写入统计。
+    """
+    writer = PredictionHistoryWriter(user_id, username, prediction_type, batch_id, chunk_rows)
+    try:
+        writer.extend(rows)
+    except Exception:
+        writer._release()
+        raise
+    return writer.close()
+
 async def get_prediction_history(user_id=None, limit=10):
     """获取预测历史记录"""
     db = SessionLocal()
@@ -0,0 +1,437 @@
+"""
+原生模型文件格式
+
+把 joblib pickle 模型转换为不依赖 pickle 的原生格式，启动时直接读取:
+- XGBoost: booster 自带的 UBJSON 格式 (包含 sklearn 包装器的属性)
+- 逻辑回归 / 朴素贝叶斯: 系数和统计量保存为 .npz
+- 随机森林: 所有树的节点数组拼接后保存为 .npz
+
+目录中的 manifest.json 记录每个原生文件的大小和 SHA-256、转换时源 pickle 的大小、修改时间和 SHA-256，
+以及转换时的 sklearn / xgboost 版本:
+源文件未变化的模型在再次转换时跳过；加载时源文件已变化、或库版本与转换时不同的原生模型视为过期，由调用方回退到 pickle
+(重建模型依赖 sklearn 的 Tree 状态结构和 XGBClassifier 的内部属性，版本升级后可能无法加载或加载出错误的模型)。
+加载时默认只比较文件大小，SHA-256 在转换和 verify 命令中校验，也可在加载时开启。
+
+用法 (在仓库根目录执行):
+    python -m Predict.app.services.model_artifacts convert [--force]
+    python -m Predict.app.services.model_artifacts verify
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger("model_artifacts")
+
+MANIFEST_FILENAME = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(native_dir: Path) -> dict:
+    """读取 manifest.json，不存在时返回空清单。"""
+    manifest_path = Path(native_dir) / MANIFEST_FILENAME
+    if not manifest_path.exists():
+        return {"format_version": FORMAT_VERSION, "models": {}}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"不支持的原生模型格式版本: {manifest.get('format_version')}")
+    return manifest
+
+
+def library_versions(kind: str) -> dict:
+    """原生格式的重建所依赖的库版本。"""
+    import sklearn
+    versions = {"sklearn": sklearn.__version__}
+    if kind == 'xgboost':
+        import xgboost
+        versions["xgboost"] = xgboost.__version__
+    return versions
+
+
+def versions_match(entry: dict) -> bool:
+    """清单条目记录的库版本与当前环境是否一致 (没有记录的旧条目视为不一致)。"""
+    return entry.get("library_versions") == library_versions(entry.get("kind"))
+
+
+def _write_manifest(native_dir: Path, manifest: dict):
+    manifest_path = Path(native_dir) / MANIFEST_FILENAME
+    tmp_path = manifest_path.with_name(f".{MANIFEST_FILENAME}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+# --- 参数编码 (只保存 JSON 可表示的超参数，预测不依赖这些值) ---
+def _encode_params(params: dict) -> dict:
+    encoded = {}
+    for name, value in params.items():
+        if isinstance(value, dict):
+            encoded[name] = {"__pairs__": [[k, v] for k, v in value.items()]}
+        elif value is None or isinstance(value, (str, bool, int, float)):
+            encoded[name] = value
+    return encoded
+
+
+def _decode_params(encoded: dict) -> dict:
+    return {
+        name: dict((k, v) for k, v in value["__pairs__"]) if isinstance(value, dict) and "__pairs__" in value else value
+        for name, value in encoded.items()
+    }
+
+
+def _common_meta(model) -> dict:
+    meta = {"params": _encode_params(model.get_params())}
+    if hasattr(model, 'feature_names_in_'):
+        meta["feature_names"] = [str(name) for name in model.feature_names_in_]
+    if hasattr(model, 'decision_threshold_'):
+        meta["decision_threshold"] = float(model.decision_threshold_)
+    return meta
+
+
+def _apply_common_meta(model, meta: dict):
+    if "feature_names" in meta:
+        model.feature_names_in_ = np.asarray(meta["feature_names"], dtype=object)
+    if "decision_threshold" in meta:
+        model.decision_threshold_ = meta["decision_threshold"]
+
+
+# --- .npz 读写 ---
+def _save_npz(path: Path, **arrays):
+    # 不压缩: 各数组在 zip 中连续存放，可以直接内存映射
+    np.savez(path, **arrays)
+
+
+def load_npz(path: Path, mmap: bool = False) -> dict:
+    """读取 .npz 中的全部数组 (禁止 pickle)。
+
+    mmap=True 时数组以只读方式映射到 zip 中对应成员的数据区，不复制到进程内存，
+    多个工作进程映射同一文件时共享物理页。
+    """
+    if not mmap:
+        with np.load(path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as raw:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path} 中的 {info.filename} 已压缩，无法内存映射")
+            # 本地文件头: 30 字节固定部分 + 文件名 + 扩展字段
+            raw.seek(info.header_offset)
+            local_header = raw.read(30)
+            name_length = int.from_bytes(local_header[26:28], 'little')
+            extra_length = int.from_bytes(local_header[28:30], 'little')
+            member_offset = info.header_offset + 30 + name_length + extra_length
+            raw.seek(member_offset)
+            version = np.lib.format.read_magic(raw)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+            if dtype.hasobject:
+                raise ValueError(f"{path} 中的 {info.filename} 包含 Python 对象，拒绝加载")
+            arrays[info.filename[:-len('.npy')]] = np.memmap(
+                path, dtype=dtype, mode='r', offset=raw.tell(), shape=shape,
+                order='F' if fortran_order else 'C'
+            )
+    return arrays
+
+
+# --- 各模型类型的导出与重建 ---
+def _export_xgboost(model, native_dir: Path, model_key: str) -> tuple[dict, list]:
+    filename = f"{model_key}.ubj"
+    model.get_booster().save_model(native_dir / filename)
+    return {"kind": "xgboost", "n_classes": int(model.n_classes_), **_common_meta(model)}, [filename]
+
+
+def _load_xgboost(native_dir: Path, files: list, meta: dict, mmap: bool):
+    import xgboost as xgb
+    booster = xgb.Booster()
+    booster.load_model(native_dir / files[0])
+    # 与反序列化 pickle 得到的状态相同: 超参数 + booster + n_classes_
+    # (不使用 XGBClassifier.load_model，它在部分 xgboost / sklearn 版本组合下无法判断估计器类型)
+    model = xgb.XGBClassifier(**_decode_params(meta["params"]))
+    model._Booster = booster
+    model.n_classes_ = meta["n_classes"]
+    if "decision_threshold" in meta:
+        model.decision_threshold_ = meta["decision_threshold"]
+    return model
+
+
+def _export_logistic_regression(model, native_dir: Path, model_key: str) -> tuple[dict, list]:
+    filename = f"{model_key}.npz"
+    _save_npz(native_dir / filename, coef=model.coef_, intercept=model.intercept_,
+              classes=model.classes_, n_iter=np.asarray(getattr(model, 'n_iter_', [0])))
+    return {"kind": "logistic_regression", **_common_meta(model)}, [filename]
+
+
+def _load_logistic_regression(native_dir: Path, files: list, meta: dict, mmap: bool):
+    from sklearn.linear_model import LogisticRegression
+    arrays = load_npz(native_dir / files[0], mmap=mmap)
+    model = LogisticRegression(**_decode_params(meta["params"]))
+    model.coef_ = arrays["coef"]
+    model.intercept_ = arrays["intercept"]
+    model.classes_ = np.asarray(arrays["classes"])
+    model.n_iter_ = np.asarray(arrays["n_iter"])
+    model.n_features_in_ = model.coef_.shape[1]
+    _apply_common_meta(model, meta)
+    return model
+
+
+def _export_naive_bayes(model, native_dir: Path, model_key: str) -> tuple[dict, list]:
+    filename = f"{model_key}.npz"
+    _save_npz(native_dir / filename, theta=model.theta_, var=model.var_, class_prior=model.class_prior_,
+              class_count=model.class_count_, classes=model.classes_, epsilon=np.asarray(model.epsilon_))
+    return {"kind": "naive_bayes", **_common_meta(model)}, [filename]
+
+
+def _load_naive_bayes(native_dir: Path, files: list, meta: dict, mmap: bool):
+    from sklearn.naive_bayes import GaussianNB
+    arrays = load_npz(native_dir / files[0], mmap=mmap)
+    model = GaussianNB(**_decode_params(meta["params"]))
+    model.theta_ = arrays["theta"]
+    model.var_ = arrays["var"]
+    model.class_prior_ = arrays["class_prior"]
+    model.class_count_ = arrays["class_count"]
+    model.classes_ = np.asarray(arrays["classes"])
+    model.epsilon_ = float(arrays["epsilon"])
+    model.n_features_in_ = model.theta_.shape[1]
+    _apply_common_meta(model, meta)
+    return model
+
+
+def _export_random_forest(model, native_dir: Path, model_key: str) -> tuple[dict, list]:
+    filename = f"{model_key}.npz"
+    states = [estimator.tree_.__getstate__() for estimator in model.estimators_]
+    node_offsets = np.cumsum([0] + [state["node_count"] for state in states]).astype(np.int64)
+    _save_npz(
+        native_dir / filename,
+        nodes=np.concatenate([state["nodes"] for state in states]),
+        values=np.concatenate([state["values"] for state in states]),
+        node_offsets=node_offsets,
+        max_depths=np.asarray([state["max_depth"] for state in states], dtype=np.int64),
+        classes=model.classes_,
+    )
+    meta = _common_meta(model)
+    meta.update({
+        "kind": "random_forest",
+        "n_outputs": int(model.n_outputs_),
+        "estimator_params": _encode_params(model.estimators_[0].get_params()),
+        "max_features": int(model.estimators_[0].max_features_),
+    })
+    return meta, [filename]
+
+
+def _load_random_forest(native_dir: Path, files: list, meta: dict, mmap: bool):
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.tree._tree import Tree
+
+    arrays = load_npz(native_dir / files[0], mmap=mmap)
+    nodes, values, offsets = arrays["nodes"], arrays["values"], arrays["node_offsets"]
+    classes = np.asarray(arrays["classes"])
+    n_classes = len(classes)
+    n_outputs = meta["n_outputs"]
+    n_features = len(meta["feature_names"]) if "feature_names" in meta else int(nodes["feature"].max()) + 1
+    estimator_params = _decode_params(meta["estimator_params"])
+
+    estimators = []
+    for i, max_depth in enumerate(arrays["max_depths"]):
+        start, end = int(offsets[i]), int(offsets[i + 1])
+        tree = Tree(n_features, np.asarray([n_classes] * n_outputs, dtype=np.intp), n_outputs)
+        # Tree 会把节点复制到自己的内存中
+        tree.__setstate__({
+            "max_depth": int(max_depth),
+            "node_count": end - start,
+            "nodes": np.ascontiguousarray(nodes[start:end]),
+            "values": np.ascontiguousarray(values[start:end]),
+        })
+        estimator = DecisionTreeClassifier(**estimator_params)
+        estimator.tree_ = tree
+        estimator.n_features_in_ = n_features
+        estimator.n_outputs_ = n_outputs
+        estimator.classes_ = classes
+        estimator.n_classes_ = np.int64(n_classes)
+        estimator.max_features_ = meta["max_features"]
+        estimators.append(estimator)
+
+    model = RandomForestClassifier(**_decode_params(meta["params"]))
+    model.estimator_ = DecisionTreeClassifier(**{k: v for k, v in estimator_params.items() if k != 'random_state'})
+    model.estimators_ = estimators
+    model.classes_ = classes
+    model.n_classes_ = np.int64(n_classes)
+    model.n_outputs_ = n_outputs
+    model.n_features_in_ = n_features
+    _apply_common_meta(model, meta)
+    return model
+
+
+_EXPORTERS = {
+    'XGBClassifier': _export_xgboost,
+    'LogisticRegression': _export_logistic_regression,
+    'GaussianNB': _export_naive_bayes,
+    'RandomForestClassifier': _export_random_forest,
+}
+
+_LOADERS = {
+    'xgboost': _load_xgboost,
+    'logistic_regression': _load_logistic_regression,
+    'naive_bayes': _load_naive_bayes,
+    'random_forest': _load_random_forest,
+}
+
+
+def export_model(model, model_key: str, native_dir: Path) -> tuple[dict, list]:
+    """将一个已加载的模型写入原生格式，返回 (元数据, 生成的文件名列表)。"""
+    exporter = _EXPORTERS.get(type(model).__name__)
+    if exporter is None:
+        raise ValueError(f"模型 {model_key} 的类型 {type(model).__name__} 不支持原生格式")
+    return exporter(model, Path(native_dir), model_key)
+
+
+def _source_record(source_path: Path) -> dict:
+    stat = source_path.stat()
+    return {
+        "file": source_path.name,
+        "bytes": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(source_path),
+    }
+
+
+def source_unchanged(entry: dict, source_path: Path) -> bool:
+    """源 pickle 与转换时是否一致: 大小和修改时间相同时直接认为一致，否则比较 SHA-256 (例如 git 检出后修改时间变化)。"""
+    source = entry.get("source") or {}
+    try:
+        stat = source_path.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != source.get("bytes"):
+        return False
+    if stat.st_mtime_ns == source.get("mtime_ns"):
+        return True
+    return file_sha256(source_path) == source.get("sha256")
+
+
+def convert_models(sources: dict, native_dir: Path, force: bool = False) -> dict:
+    """把 pickle 模型转换为原生格式。
+
+    Args:
+        sources: 模型键 -> 源 pickle 路径
+        native_dir: 原生文件目录
+        force: 为 True 时忽略清单，全部重新转换
+
+    Returns:
+        dict: 模型键 -> "converted" / "skipped" / 错误信息
+    """
+    import joblib
+
+    native_dir = Path(native_dir)
+    native_dir.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(native_dir)
+    results = {}
+    for model_key, source_path in sources.items():
+        source_path = Path(source_path)
+        entry = manifest["models"].get(model_key)
+        if (not force and entry and source_unchanged(entry, source_path) and versions_match(entry)
+                and verify_entry(native_dir, entry)):
+            results[model_key] = "skipped"
+            logger.info(f"模型 {model_key} 的源文件未变化，跳过转换")
+            continue
+        try:
+            model = joblib.load(source_path)
+            meta, files = export_model(model, model_key, native_dir)
+        except Exception as e:
+            logger.error(f"转换模型 {model_key} ({source_path}) 失败: {e}")
+            results[model_key] = f"失败: {e}"
+            continue
+        manifest["models"][model_key] = {
+            **meta,
+            "class": type(model).__name__,
+            "files": {name: {"bytes": (native_dir / name).stat().st_size, "sha256": file_sha256(native_dir / name)} for name in files},
+            "source": _source_record(source_path),
+            "library_versions": library_versions(meta["kind"]),
+            "converted_at": datetime.now().isoformat(),
+        }
+        results[model_key] = "converted"
+        logger.info(f"模型 {model_key} 已转换为原生格式: {', '.join(files)}")
+    _write_manifest(native_dir, manifest)
+    return results
+
+
+def verify_entry(native_dir: Path, entry: dict, check_hash: bool = True) -> bool:
+    """检查清单中记录的原生文件是否存在且大小一致，check_hash 为 True 时同时比较 SHA-256。"""
+    for name, record in entry.get("files", {}).items():
+        path = Path(native_dir) / name
+        if not path.exists() or path.stat().st_size != record["bytes"]:
+            return False
+        if check_hash and file_sha256(path) != record["sha256"]:
+            return False
+    return True
+
+
+def load_native_model(native_dir: Path, entry: dict, verify: bool = False, mmap: bool = False):
+    """根据清单条目加载原生格式的模型。
+
+    库版本与转换时不同、文件缺失或大小不符 (verify 为 True 时还包括 SHA-256 不一致) 时抛出 ValueError，
+    由调用方回退到 pickle。
+    """
+    native_dir = Path(native_dir)
+    if not versions_match(entry):
+        raise ValueError(f"原生文件转换时的库版本 {entry.get('library_versions')} 与当前 "
+                         f"{library_versions(entry.get('kind'))} 不一致，需要重新转换")
+    if not verify_entry(native_dir, entry, check_hash=verify):
+        raise ValueError("原生模型文件缺失或校验和不一致")
+    loader = _LOADERS.get(entry.get("kind"))
+    if loader is None:
+        raise ValueError(f"未知的原生模型类型: {entry.get('kind')}")
+    return loader(native_dir, list(entry["files"]), entry, mmap)
+
+
+def main():
+    from Predict.app.services import predictor_service
+
+    parser = argparse.ArgumentParser(description="HAPI 模型原生格式转换")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("convert", help="把 models/hapi_predictor 中的 pickle 模型转换为原生格式")
+    p.add_argument("--force", action="store_true", help="忽略清单，全部重新转换")
+    subparsers.add_parser("verify", help="校验原生文件的校验和以及源文件是否变化")
+    args = parser.parse_args()
+
+    native_dir = predictor_service.NATIVE_MODEL_PATH
+    sources = {
+        model_key: predictor_service.MODEL_PATH / filename
+        for model_key, filename in predictor_service.model_name_mapping.items()
+        if (predictor_service.MODEL_PATH / filename).exists()
+    }
+    if args.command == "convert":
+        for model_key, status in convert_models(sources, native_dir, force=args.force).items():
+            print(f"{model_key}: {status}")
+    else:
+        manifest = read_manifest(native_dir)
+        for model_key, entry in manifest["models"].items():
+            files_ok = verify_entry(native_dir, entry)
+            source_path = sources.get(model_key)
+            fresh = source_path is None or source_unchanged(entry, source_path)
+            versions_ok = versions_match(entry)
+            print(f"{model_key}: 文件{'完整' if files_ok else '损坏'}, {'与源文件一致' if fresh else '源文件已变化，需要重新转换'}, "
+                  f"{'库版本一致' if versions_ok else '库版本与转换时不同，需要重新转换'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,23 @@ import pandas as pd
 import numpy as np
 import joblib
 import os
+import re
 from pathlib import Path
 import logging
 import uuid
+import warnings
+import asyncio
+import configparser
+import copy
+import functools
+import gc
+import hashlib
+import importlib
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
 from io import BytesIO, StringIO
 import csv
 from fastapi import UploadFile
@@ -16,11 +30,13 @@ from datetime import datetime
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, KeepTogether
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase.cidfonts import UnicodeCIDFont
 
+from Predict.app.services import model_artifacts, tree_engine
+
 # 配置日志记录
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,6 +47,8 @@ SERVICE_DIR = Path(__file__).resolve().parent
 APP_DIR = SERVICE_DIR.parent
 # HAPI 模型文件存放路径 (相对于 app 目录)
 MODEL_PATH = APP_DIR / 'models' / 'hapi_predictor'
+# 原生格式模型目录 (由 model_artifacts 转换生成，存在时优先于 pickle 加载)
+NATIVE_MODEL_PATH = MODEL_PATH / 'native'
 BATCH_RESULTS_DIR = APP_DIR / 'batch_results' # 新增：批量结果目录
 PREDICTIONS_DIR = APP_DIR / 'predictions' # 新增：用于存储单例预测记录 (可选)
 REPORTS_DIR = APP_DIR / 'reports' # 新增：用于临时存储 PDF 报告
@@ -40,6 +58,615 @@ os.makedirs(BATCH_RESULTS_DIR, exist_ok=True)
 os.makedirs(PREDICTIONS_DIR, exist_ok=True)
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
+# 读取配置文件 (与 db / auth 服务共用 appDatas/config.ini，预测相关配置位于 [predictor] 段)
+config = configparser.ConfigParser()
+config_file = os.path.join(APP_DIR.parent, 'appDatas', 'config.ini')
+
+# 单例预测请求合并 (micro-batching) 配置
+COALESCE_ENABLED = True
+COALESCE_WINDOW_MS = 2.0  # 收集窗口 (毫秒)
+COALESCE_MAX_BATCH = 64  # 单批最大行数
+
+# 级联提前结束: 先运行低成本模型，其平均概率落在风险等级阈值 (0.3/0.7) 附近 ±CASCADE_BAND 以内时才运行其余模型
+CASCADE_ENABLED = False
+CASCADE_CHEAP_MODELS = 'logistic_regression,naive_bayes'
+CASCADE_BAND = 0.1
+
+# 集成推理截止时间: 各模型并发运行，超过预算 (毫秒) 仍未完成的模型不计入本次结果；0 表示不设截止时间、依次运行
+# 默认关闭 (与级联一致): 开启后超时的模型不计入综合风险等级，报告中会列出未计入的模型
+# ENSEMBLE_MODEL_BUDGETS_MS 可为单个模型指定预算，如 "random_forest:300,xgboost:200"
+# 连续 ENSEMBLE_MISS_LIMIT 次超时的模型降级 ENSEMBLE_DEPRIORITIZE_SECONDS 秒 (期间跳过)，之后放行一次请求试探
+ENSEMBLE_DEADLINE_MS = 0.0
+ENSEMBLE_MODEL_BUDGETS_MS = ''
+ENSEMBLE_MISS_LIMIT = 3
+ENSEMBLE_DEPRIORITIZE_SECONDS = 60.0
+# 同一模型最多允许的后台超时推理数，达到后新请求跳过该模型 (防止挂起的模型占满线程池)
+ENSEMBLE_MAX_STRAGGLERS = 4
+
+# 特征贡献: global 返回 XGBoost 的全局特征重要性 (模型加载时计算一次)；
+# patient 返回每位患者的贡献值 (XGBoost 原生 SHAP 值，逻辑回归为 系数×特征值)，批量结果中同时增加各特征的贡献列
+FEATURE_CONTRIBUTIONS = 'global'
+
+# 单例预测结果缓存配置
+CACHE_ENABLED = True
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL_SECONDS = 300.0
+
+# 推理执行器配置 (thread: 线程池; process: 进程池)
+INFERENCE_EXECUTOR = 'thread'
+INFERENCE_WORKERS = min(4, os.cpu_count() or 1)
+INFERENCE_MAX_QUEUE = 256  # 等待执行的最大任务数，超出时拒绝
+# 进程池 (推理、报告排版) 的启动方式: gunicorn worker 中已有执行器、集成推理和心跳等线程，
+# fork 会把其他线程当时持有的锁 (logging、sqlite 等) 原样复制到子进程，可能死锁；
+# 默认使用 forkserver (平台不支持时使用 spawn)，子进程重新导入本模块并加载模型
+EXECUTOR_START_METHOD = 'forkserver'
+
+# PDF 报告配置: 默认在首次下载时生成，开启后在预测返回后于后台预先生成
+REPORT_PRERENDER = False
+# 报告排版进程池 (关闭时在本进程的线程中排版)
+REPORT_POOL_ENABLED = True
+REPORT_WORKERS = 2
+REPORT_MAX_QUEUE = 32
+# 批量 PDF 报告每次排版的患者数 (控制内存中的 Flowable 数量)
+REPORT_BATCH_CHUNK_ROWS = 200
+# 单例报告按内容寻址存放在内存中的字节上限 (MB)
+REPORT_MEMORY_BUDGET_MB = 64
+# 报告落盘策略: 0 表示只保存在内存中，N 表示同一内容被下载 N 次后写入 REPORTS_DIR
+REPORT_PERSIST_AFTER_HITS = 0
+# 模型加载: 启动时用线程池并行加载；MODEL_LAZY_MODELS 中的模型 (逗号分隔的模型键) 推迟到第一次使用时加载
+MODEL_LOAD_WORKERS = 4
+MODEL_LAZY_MODELS = ''
+# 原生格式模型: 是否优先加载、加载时是否校验 SHA-256 (默认只比较文件大小，完整校验在转换和 verify 命令中进行)、
+# 数组是否以内存映射方式读取
+MODEL_NATIVE_ENABLED = True
+MODEL_NATIVE_VERIFY = False
+MODEL_NATIVE_MMAP = False
+# 使用向量化树推理引擎 (tree_engine) 的模型键，逗号分隔；留空则全部使用 sklearn 自身的 predict_proba
+MODEL_FLAT_TREE_MODELS = 'random_forest'
+# 超过该行数的批量仍交给 sklearn (大批量时 sklearn 更快)
+MODEL_FLAT_TREE_MAX_ROWS = 256
+# XGBoost 使用原生 booster 的 inplace_predict 推理；每 MODEL_XGB_ROWS_PER_THREAD 行使用一个线程，
+# 最多 MODEL_XGB_MAX_THREADS 个 (0 表示 CPU 核数)
+MODEL_XGB_INPLACE = True
+MODEL_XGB_ROWS_PER_THREAD = 4096
+MODEL_XGB_MAX_THREADS = 0
+# 模型文件监视: 开启后定期检查模型目录，文件变化时自动热更新
+MODEL_WATCH_ENABLED = False
+MODEL_WATCH_INTERVAL_SECONDS = 10.0
+# 多 worker 部署时管理员触发的热更新: 处理请求的 worker 更新后写入模型目录中的热更新标记文件，
+# 其他 worker 每 MODEL_SYNC_INTERVAL_SECONDS 秒检查一次标记 (与 MODEL_WATCH_ENABLED 无关)，发现新标记后各自热更新
+MODEL_SYNC_INTERVAL_SECONDS = 5.0
+# 产物目录的保留策略: 字节预算 (MB) 和最长保留天数，0 表示不限制
+RETENTION_ENABLED = True
+RETENTION_INTERVAL_SECONDS = 600.0
+REPORTS_MAX_MB = 256.0
+REPORTS_MAX_AGE_DAYS = 30.0
+BATCH_RESULTS_MAX_MB = 512.0
+BATCH_RESULTS_MAX_AGE_DAYS = 90.0
+PREDICTIONS_MAX_MB = 256.0
+PREDICTIONS_MAX_AGE_DAYS = 30.0
+# 批量预测每块处理的行数 (读取、编码、推理、写入)，决定批量任务的峰值内存
+BATCH_CHUNK_ROWS = 5000
+BATCH_SPOOL_CHUNK_BYTES = 1024 * 1024
+# 批量结果文件的默认格式: xlsx 或 csv (提交任务时可单独指定)
+BATCH_RESULT_FORMAT = 'xlsx'
+# 检测 CSV 编码时读取的文件开头字节数
+BATCH_ENCODING_PROBE_BYTES = 64 * 1024
+# 后台批量任务: 同时运行的任务数、排队上限、内存中保留的已结束任务数
+BATCH_JOB_WORKERS = 1
+BATCH_JOB_MAX_QUEUE = 8
+BATCH_JOB_HISTORY = 200
+# 运行任务的进程定期刷新状态文件的心跳；超过 BATCH_JOB_STALE_SECONDS 没有心跳的未结束任务视为失败 (进程已退出)
+BATCH_JOB_HEARTBEAT_SECONDS = 15.0
+BATCH_JOB_STALE_SECONDS = 120.0
+# 批量任务的终止状态 (状态文件中为其他值时任务仍在排队或运行)
+BATCH_JOB_FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+if os.path.exists(config_file):
+    config.read(config_file)
+    if 'predictor' in config:
+        predictor_config = config['predictor']
+        COALESCE_ENABLED = predictor_config.getboolean('COALESCE_ENABLED', COALESCE_ENABLED)
+        COALESCE_WINDOW_MS = predictor_config.getfloat('COALESCE_WINDOW_MS', COALESCE_WINDOW_MS)
+        COALESCE_MAX_BATCH = predictor_config.getint('COALESCE_MAX_BATCH', COALESCE_MAX_BATCH)
+        CASCADE_ENABLED = predictor_config.getboolean('CASCADE_ENABLED', CASCADE_ENABLED)
+        CASCADE_CHEAP_MODELS = predictor_config.get('CASCADE_CHEAP_MODELS', CASCADE_CHEAP_MODELS)
+        CASCADE_BAND = predictor_config.getfloat('CASCADE_BAND', CASCADE_BAND)
+        ENSEMBLE_DEADLINE_MS = predictor_config.getfloat('ENSEMBLE_DEADLINE_MS', ENSEMBLE_DEADLINE_MS)
+        ENSEMBLE_MODEL_BUDGETS_MS = predictor_config.get('ENSEMBLE_MODEL_BUDGETS_MS', ENSEMBLE_MODEL_BUDGETS_MS)
+        ENSEMBLE_MISS_LIMIT = predictor_config.getint('ENSEMBLE_MISS_LIMIT', ENSEMBLE_MISS_LIMIT)
+        ENSEMBLE_DEPRIORITIZE_SECONDS = predictor_config.getfloat('ENSEMBLE_DEPRIORITIZE_SECONDS', ENSEMBLE_DEPRIORITIZE_SECONDS)
+        ENSEMBLE_MAX_STRAGGLERS = predictor_config.getint('ENSEMBLE_MAX_STRAGGLERS', ENSEMBLE_MAX_STRAGGLERS)
+        FEATURE_CONTRIBUTIONS = predictor_config.get('FEATURE_CONTRIBUTIONS', FEATURE_CONTRIBUTIONS)
+        CACHE_ENABLED = predictor_config.getboolean('CACHE_ENABLED', CACHE_ENABLED)
+        CACHE_MAX_ENTRIES = predictor_config.getint('CACHE_MAX_ENTRIES', CACHE_MAX_ENTRIES)
+        CACHE_TTL_SECONDS = predictor_config.getfloat('CACHE_TTL_SECONDS', CACHE_TTL_SECONDS)
+        INFERENCE_EXECUTOR = predictor_config.get('INFERENCE_EXECUTOR', INFERENCE_EXECUTOR)
+        INFERENCE_WORKERS = predictor_config.getint('INFERENCE_WORKERS', INFERENCE_WORKERS)
+        INFERENCE_MAX_QUEUE = predictor_config.getint('INFERENCE_MAX_QUEUE', INFERENCE_MAX_QUEUE)
+        EXECUTOR_START_METHOD = predictor_config.get('EXECUTOR_START_METHOD', EXECUTOR_START_METHOD)
+        REPORT_PRERENDER = predictor_config.getboolean('REPORT_PRERENDER', REPORT_PRERENDER)
+        REPORT_POOL_ENABLED = predictor_config.getboolean('REPORT_POOL_ENABLED', REPORT_POOL_ENABLED)
+        REPORT_WORKERS = predictor_config.getint('REPORT_WORKERS', REPORT_WORKERS)
+        REPORT_MAX_QUEUE = predictor_config.getint('REPORT_MAX_QUEUE', REPORT_MAX_QUEUE)
+        REPORT_BATCH_CHUNK_ROWS = predictor_config.getint('REPORT_BATCH_CHUNK_ROWS', REPORT_BATCH_CHUNK_ROWS)
+        REPORT_MEMORY_BUDGET_MB = predictor_config.getfloat('REPORT_MEMORY_BUDGET_MB', REPORT_MEMORY_BUDGET_MB)
+        REPORT_PERSIST_AFTER_HITS = predictor_config.getint('REPORT_PERSIST_AFTER_HITS', REPORT_PERSIST_AFTER_HITS)
+        MODEL_LOAD_WORKERS = predictor_config.getint('MODEL_LOAD_WORKERS', MODEL_LOAD_WORKERS)
+        MODEL_LAZY_MODELS = predictor_config.get('MODEL_LAZY_MODELS', MODEL_LAZY_MODELS)
+        MODEL_NATIVE_ENABLED = predictor_config.getboolean('MODEL_NATIVE_ENABLED', MODEL_NATIVE_ENABLED)
+        MODEL_NATIVE_VERIFY = predictor_config.getboolean('MODEL_NATIVE_VERIFY', MODEL_NATIVE_VERIFY)
+        MODEL_NATIVE_MMAP = predictor_config.getboolean('MODEL_NATIVE_MMAP', MODEL_NATIVE_MMAP)
+        MODEL_FLAT_TREE_MODELS = predictor_config.get('MODEL_FLAT_TREE_MODELS', MODEL_FLAT_TREE_MODELS)
+        MODEL_FLAT_TREE_MAX_ROWS = predictor_config.getint('MODEL_FLAT_TREE_MAX_ROWS', MODEL_FLAT_TREE_MAX_ROWS)
+        MODEL_XGB_INPLACE = predictor_config.getboolean('MODEL_XGB_INPLACE', MODEL_XGB_INPLACE)
+        MODEL_XGB_ROWS_PER_THREAD = predictor_config.getint('MODEL_XGB_ROWS_PER_THREAD', MODEL_XGB_ROWS_PER_THREAD)
+        MODEL_XGB_MAX_THREADS = predictor_config.getint('MODEL_XGB_MAX_THREADS', MODEL_XGB_MAX_THREADS)
+        MODEL_WATCH_ENABLED = predictor_config.getboolean('MODEL_WATCH_ENABLED', MODEL_WATCH_ENABLED)
+        MODEL_WATCH_INTERVAL_SECONDS = predictor_config.getfloat('MODEL_WATCH_INTERVAL_SECONDS', MODEL_WATCH_INTERVAL_SECONDS)
+        MODEL_SYNC_INTERVAL_SECONDS = predictor_config.getfloat('MODEL_SYNC_INTERVAL_SECONDS', MODEL_SYNC_INTERVAL_SECONDS)
+        RETENTION_ENABLED = predictor_config.getboolean('RETENTION_ENABLED', RETENTION_ENABLED)
+        RETENTION_INTERVAL_SECONDS = predictor_config.getfloat('RETENTION_INTERVAL_SECONDS', RETENTION_INTERVAL_SECONDS)
+        REPORTS_MAX_MB = predictor_config.getfloat('REPORTS_MAX_MB', REPORTS_MAX_MB)
+        REPORTS_MAX_AGE_DAYS = predictor_config.getfloat('REPORTS_MAX_AGE_DAYS', REPORTS_MAX_AGE_DAYS)
+        BATCH_RESULTS_MAX_MB = predictor_config.getfloat('BATCH_RESULTS_MAX_MB', BATCH_RESULTS_MAX_MB)
+        BATCH_RESULTS_MAX_AGE_DAYS = predictor_config.getfloat('BATCH_RESULTS_MAX_AGE_DAYS', BATCH_RESULTS_MAX_AGE_DAYS)
+        PREDICTIONS_MAX_MB = predictor_config.getfloat('PREDICTIONS_MAX_MB', PREDICTIONS_MAX_MB)
+        PREDICTIONS_MAX_AGE_DAYS = predictor_config.getfloat('PREDICTIONS_MAX_AGE_DAYS', PREDICTIONS_MAX_AGE_DAYS)
+        BATCH_CHUNK_ROWS = predictor_config.getint('BATCH_CHUNK_ROWS', BATCH_CHUNK_ROWS)
+        BATCH_RESULT_FORMAT = predictor_config.get('BATCH_RESULT_FORMAT', BATCH_RESULT_FORMAT)
+        BATCH_JOB_WORKERS = predictor_config.getint('BATCH_JOB_WORKERS', BATCH_JOB_WORKERS)
+        BATCH_JOB_MAX_QUEUE = predictor_config.getint('BATCH_JOB_MAX_QUEUE', BATCH_JOB_MAX_QUEUE)
+        BATCH_JOB_HISTORY = predictor_config.getint('BATCH_JOB_HISTORY', BATCH_JOB_HISTORY)
+        BATCH_JOB_HEARTBEAT_SECONDS = predictor_config.getfloat('BATCH_JOB_HEARTBEAT_SECONDS', BATCH_JOB_HEARTBEAT_SECONDS)
+        BATCH_JOB_STALE_SECONDS = predictor_config.getfloat('BATCH_JOB_STALE_SECONDS', BATCH_JOB_STALE_SECONDS)
+
+class PredictionCache:
+    """单例预测结果的 LRU/TTL 缓存。
+
+    键为编码后特征向量的哈希加上当前模型集版本号，值为完整的 predict_single 结果字典。
+    load_models() 更换模型时版本号递增并清空缓存。
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS, enabled: bool = CACHE_ENABLED):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl_seconds
+        self.enabled = enabled
+        self._entries = OrderedDict()  # key -> (过期时间, 结果)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(input_row, version: int) -> str:
+        """根据编码后的特征向量和模型集版本号生成缓存键。"""
+        vector = np.ascontiguousarray(np.asarray(input_row, dtype=np.float64).reshape(-1))
+        digest = hashlib.blake2b(vector.tobytes(), digest_size=16)
+        digest.update(str(version).encode('ascii'))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """命中时返回结果的副本，未命中或已过期返回 None。"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, result = entry
+            if self.ttl > 0 and expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(result)
+
+    def put(self, key: str, result: dict):
+        """写入结果，超出容量时淘汰最久未使用的条目。有模型因超时、降级或出错未计入的不完整结果不缓存。"""
+        if not self.enabled or result.get("models_dropped") or result.get("models_failed"):
+            return
+        stored = copy.deepcopy(result)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, stored)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """清空缓存 (模型更换时调用)。"""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def get_metrics(self) -> dict:
+        """返回命中、未命中和淘汰计数。"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+prediction_cache = PredictionCache()
+
+def _timed_call(func, args, submitted_at):
+    """在执行器工作线程/进程中运行 func，并返回结果及开始、结束时间 (用于区分排队与计算耗时)。"""
+    started_at = time.time()
+    result = func(*args)
+    return result, started_at, time.time()
+
+def _process_pool_context():
+    """进程池使用的 multiprocessing 上下文 (EXECUTOR_START_METHOD，当前平台不支持时为 spawn)。"""
+    method = EXECUTOR_START_METHOD if EXECUTOR_START_METHOD in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+def _init_inference_worker():
+    """推理进程池工作进程初始化: 确保子进程中已加载模型。"""
+    current_model_set()
+
+class ManagedExecutor:
+    """托管执行器，把 CPU 密集的任务 (模型推理、报告排版) 移出 asyncio 事件循环。
+
+    支持线程池或进程池，排队任务数有上限 (超出时拒绝，或以 block=True 提交时等待空位)，并分别统计排队等待时间和计算时间。
+    """
+
+    def __init__(self, name: str, mode: str = 'thread', workers: int = 1, max_queue: int = 0, initializer=None):
+        self.name = name
+        self.mode = mode if mode in ('thread', 'process') else 'thread'
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.initializer = initializer
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.blocked = 0  # 因队列已满而等待空位的提交数
+        self._stats = {}  # 函数名 -> 计数与耗时统计
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.mode == 'process':
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_process_pool_context(),
+                                                 initializer=self.initializer)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'hapi-{self.name}')
+            logger.info(f"执行器 {self.name} 已启动: {self.mode} x {self.workers}, 最大排队 {self.max_queue}")
+        return self._pool
+
+    def submit(self, func, *args, block: bool = False):
+        """提交任务，返回 concurrent.futures.Future，结果为 func(*args) 的返回值。
+
+        队列已满时抛出 RuntimeError；block=True 时在调用线程中等待空位 (用于批量任务这类可以等待、不应失败的后台调用，
+        不能在事件循环中使用)。完成后 Future 的 timings 属性为 (排队等待秒数, 计算秒数)。
+        """
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                if not block:
+                    self.rejected += 1
+                    raise RuntimeError(f"{self.name} 队列已满，请稍后重试")
+                self.blocked += 1
+                while self._in_flight >= self.workers + self.max_queue:
+                    self._slot_freed.wait()
+            self._in_flight += 1
+            self.submitted += 1
+            pool = self._get_pool()
+
+        submitted_at = time.time()
+        try:
+            inner = pool.submit(_timed_call, func, args, submitted_at)
+        except Exception:
+            with self._lock:
+                self._in_flight -= 1
+                self._slot_freed.notify()
+            raise
+
+        outer = Future()
+        # 标记为运行中: 等待方被取消 (客户端断开、wait_for 超时) 时 asyncio.wrap_future 对它的 cancel() 不再生效，
+        # 任务完成后 set_result / set_exception 不会因 Future 已取消而抛出 InvalidStateError
+        outer.set_running_or_notify_cancel()
+
+        def _done(f):
+            with self._lock:
+                self._in_flight -= 1
+                self._slot_freed.notify()
+            try:
+                result, started_at, finished_at = f.result()
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                outer.set_exception(e)
+                return
+            outer.timings = (started_at - submitted_at, finished_at - started_at)
+            self._record(func.__name__, *outer.timings)
+            outer.set_result(result)
+
+        inner.add_done_callback(_done)
+        return outer
+
+    async def run(self, func, *args):
+        """在执行器中运行 func(*args) 并等待结果，不阻塞事件循环。"""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    async def run_timed(self, func, *args):
+        """与 run 相同，但同时返回 (排队等待秒数, 计算秒数)。"""
+        future = self.submit(func, *args)
+        result = await asyncio.wrap_future(future)
+        return result, future.timings
+
+    def _record(self, name: str, queue_wait: float, compute: float):
+        with self._lock:
+            self.completed += 1
+            stats = self._stats.setdefault(name, {
+                "calls": 0, "queue_wait_total_ms": 0.0, "queue_wait_max_ms": 0.0,
+                "compute_total_ms": 0.0, "compute_max_ms": 0.0
+            })
+            queue_wait_ms = max(0.0, queue_wait) * 1000.0
+            compute_ms = max(0.0, compute) * 1000.0
+            stats["calls"] += 1
+            stats["queue_wait_total_ms"] += queue_wait_ms
+            stats["queue_wait_max_ms"] = max(stats["queue_wait_max_ms"], queue_wait_ms)
+            stats["compute_total_ms"] += compute_ms
+            stats["compute_max_ms"] = max(stats["compute_max_ms"], compute_ms)
+
+    def reset(self):
+        """关闭进程池，使下一次提交时重新创建工作进程 (例如模型更换后；线程池共享内存中的模型，无需重建)。"""
+        with self._lock:
+            pool = self._pool if self.mode == 'process' else None
+            if pool is not None:
+                self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def get_metrics(self) -> dict:
+        """返回执行器状态以及各函数的排队等待与计算耗时。"""
+        with self._lock:
+            functions = {}
+            for name, stats in self._stats.items():
+                calls = stats["calls"] or 1
+                functions[name] = {
+                    **stats,
+                    "queue_wait_avg_ms": stats["queue_wait_total_ms"] / calls,
+                    "compute_avg_ms": stats["compute_total_ms"] / calls,
+                }
+            return {
+                "name": self.name,
+                "mode": self.mode,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "blocked": self.blocked,
+                "functions": functions,
+            }
+
+inference_executor = ManagedExecutor(
+    'inference', mode=INFERENCE_EXECUTOR, workers=INFERENCE_WORKERS,
+    max_queue=INFERENCE_MAX_QUEUE, initializer=_init_inference_worker
+)
+
+class EnsembleScheduler:
+    """集成推理的截止时间管理: 各模型在线程池中并发推理，请求只等待到各模型的预算用完为止。
+
+    超时的模型 (straggler) 不计入本次结果并记录在指标中，它的推理仍在后台完成；同一模型仍在后台执行的超时推理
+    达到 max_stragglers 个时新请求直接跳过该模型，避免挂起的模型占满线程池；连续 miss_limit 次超时的模型降级 deprioritize_seconds 秒，期间跳过；
+    期满后只放行一个试探请求，试探按时完成才恢复正常，超时则再次降级，试探进行期间其他请求仍跳过该模型。
+    deadline_ms <= 0 时在当前线程中依次运行各模型 (不设截止时间)。
+    进程池推理时每个工作进程各自统计。
+    """
+
+    # 模型未计入结果的原因
+    TIMEOUT = 'timeout'
+    BUSY = 'busy'
+    DEPRIORITIZED = 'deprioritized'
+
+    def __init__(self, deadline_ms: float = ENSEMBLE_DEADLINE_MS, budgets_ms: str = ENSEMBLE_MODEL_BUDGETS_MS,
+                 miss_limit: int = ENSEMBLE_MISS_LIMIT, deprioritize_seconds: float = ENSEMBLE_DEPRIORITIZE_SECONDS,
+                 max_stragglers: int = ENSEMBLE_MAX_STRAGGLERS):
+        self.deadline = deadline_ms / 1000.0
+        self.budgets = {}
+        for item in budgets_ms.split(','):
+            if ':' in item:
+                model_key, budget = item.split(':', 1)
+                self.budgets[model_key.strip()] = float(budget) / 1000.0
+        self.miss_limit = max(1, int(miss_limit))
+        self.deprioritize_seconds = deprioritize_seconds
+        self.max_stragglers = max(1, int(max_stragglers))
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stragglers = {}  # 模型键 -> 已超时但仍在后台执行的推理数
+        self._stats = {}
+        self.requests_with_drops = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.deadline > 0
+
+    def budget(self, model_key: str) -> float:
+        return self.budgets.get(model_key, self.deadline)
+
+    def _get_pool(self):
+        # 多个推理线程会同时调用，线程池只能创建一个
+        with self._lock:
+            if self._pool is None:
+                # 每个模型预留 max_stragglers 个线程给后台超时推理，其余线程保证正常请求不被挂起的模型饿死
+                self._pool = ThreadPoolExecutor(
+                    max_workers=len(MODEL_NAMES) * (max(1, INFERENCE_WORKERS) + self.max_stragglers),
+                    thread_name_prefix='hapi-ensemble'
+                )
+            return self._pool
+
+    def _model_stats(self, model_key: str) -> dict:
+        return self._stats.setdefault(model_key, {
+            "runs": 0, "in_time": 0, "misses": 0, "consecutive_misses": 0, "skipped": 0,
+            "failed": 0, "last_latency_ms": None, "max_latency_ms": 0.0, "deprioritized_until": 0.0,
+            "probing": False,
+        })
+
+    def _admit(self, model_key: str, now: float):
+        """返回模型不能运行的原因，可以运行时返回 None (降级期满后只放行一个试探请求)。调用方持有 self._lock。"""
+        stats = self._model_stats(model_key)
+        if self._stragglers.get(model_key, 0) >= self.max_stragglers:
+            return self.BUSY
+        if stats["deprioritized_until"] > now:
+            return self.DEPRIORITIZED
+        if stats["deprioritized_until"]:
+            # 降级已期满但尚未恢复: 已有试探请求在运行时其他请求继续跳过
+            if stats["probing"]:
+                return self.DEPRIORITIZED
+            stats["probing"] = True
+        return None
+
+    def _finish(self, model_key: str, started: float, future):
+        """模型推理完成 (包括超时之后才完成的) 时记录实际耗时。"""
+        latency_ms = (time.monotonic() - started) * 1000.0
+        with self._lock:
+            stats = self._model_stats(model_key)
+            stats["last_latency_ms"] = latency_ms
+            stats["max_latency_ms"] = max(stats["max_latency_ms"], latency_ms)
+            if future.exception() is not None:
+                stats["failed"] += 1
+            if getattr(future, 'straggler', False):
+                self._stragglers[model_key] -= 1
+                logger.info(f"超时模型 {model_key} 的推理已在 {latency_ms:.0f} ms 后完成")
+
+    def run(self, tasks: dict, started: float = None) -> tuple[dict, dict]:
+        """运行 {模型键: 无参函数}，返回 ({模型键: 返回值或异常}, {未计入结果的模型键: 原因})。
+
+        started 为请求开始的 time.monotonic() 时间，各模型的预算从这一刻算起 (级联模式的两个阶段共用一个截止时间)。
+        """
+        results = {}
+        dropped = {}
+        if not self.enabled:
+            for model_key, task in tasks.items():
+                try:
+                    results[model_key] = task()
+                except Exception as e:
+                    results[model_key] = e
+            return results, dropped
+
+        started = time.monotonic() if started is None else started
+        futures = {}
+        probes = set()  # 本请求持有试探名额的模型
+        with self._lock:
+            now = time.monotonic()
+            for model_key in tasks:
+                reason = self._admit(model_key, now)
+                if reason is not None:
+                    self._model_stats(model_key)["skipped"] += 1
+                    dropped[model_key] = reason
+                elif self._model_stats(model_key)["deprioritized_until"]:
+                    probes.add(model_key)
+        pool = self._get_pool()
+        for model_key, task in tasks.items():
+            if model_key in dropped:
+                continue
+            submitted = time.monotonic()
+            future = pool.submit(task)
+            future.add_done_callback(lambda f, key=model_key, t=submitted: self._finish(key, t, f))
+            futures[future] = model_key
+
+        pending = set(futures)
+        while pending:
+            remaining = max(started + self.budget(futures[f]) for f in pending) - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            # 已超过自身预算的模型不再等待
+            pending = {f for f in pending if started + self.budget(futures[f]) > now}
+
+        # 在请求停止等待之前完成的模型都计入结果 (即使略超过自身预算)
+        with self._lock:
+            for future, model_key in futures.items():
+                stats = self._model_stats(model_key)
+                stats["runs"] += 1
+                if model_key in probes:
+                    # 只有试探请求自己结束时才释放试探名额
+                    stats["probing"] = False
+                if future.done():
+                    stats["in_time"] += 1
+                    # 降级期间只有试探请求的结果决定是否恢复 (降级之前已开始的请求不算)
+                    if model_key in probes or not stats["deprioritized_until"]:
+                        stats["consecutive_misses"] = 0
+                        stats["deprioritized_until"] = 0.0
+                    try:
+                        results[model_key] = future.result()
+                    except Exception as e:
+                        results[model_key] = e
+                    continue
+                stats["misses"] += 1
+                stats["consecutive_misses"] += 1
+                # 在锁内标记，_finish 回调 (同样持锁) 据此减少该模型的后台推理数
+                future.straggler = True
+                self._stragglers[model_key] = self._stragglers.get(model_key, 0) + 1
+                dropped[model_key] = self.TIMEOUT
+                logger.warning(f"模型 {model_key} 超过截止时间 {self.budget(model_key) * 1000:.0f} ms 未完成，本次结果不包含该模型")
+                if stats["consecutive_misses"] >= self.miss_limit:
+                    stats["deprioritized_until"] = time.monotonic() + self.deprioritize_seconds
+                    logger.warning(f"模型 {model_key} 连续 {stats['consecutive_misses']} 次超时，降级 {self.deprioritize_seconds:.0f} 秒")
+            if dropped:
+                self.requests_with_drops += 1
+        return results, dropped
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_metrics(self) -> dict:
+        """返回截止时间配置、各模型的超时次数与降级状态。"""
+        with self._lock:
+            now = time.monotonic()
+            models = {}
+            for model_key, stats in self._stats.items():
+                models[model_key] = {
+                    **{k: v for k, v in stats.items() if k not in ("deprioritized_until", "probing")},
+                    "budget_ms": self.budget(model_key) * 1000.0,
+                    "deprioritized": stats["deprioritized_until"] > now,
+                    "deprioritized_remaining_s": max(0.0, stats["deprioritized_until"] - now),
+                    "stragglers_in_flight": self._stragglers.get(model_key, 0),
+                }
+            return {
+                "enabled": self.enabled,
+                "deadline_ms": self.deadline * 1000.0,
+                "miss_limit": self.miss_limit,
+                "deprioritize_seconds": self.deprioritize_seconds,
+                "requests_with_drops": self.requests_with_drops,
+                "models": models,
+            }
+
+ensemble_scheduler = EnsembleScheduler()
+
 # 定义输入字段及其类型 (从 HAPI-Predictor/app.py 迁移)
 NUMERIC_FIELDS = [
     '住院第几天',
@@ -73,19 +700,115 @@ MODEL_NAMES = {
 }
 
 # 预加载模型
+# 当前模型集中的模型和判定阈值 (随模型集整体替换，不在原地修改)。
+# 请求中应在开始时调用 current_model_set() 取得快照，避免热更新时前后使用不同的模型。
 models = {}
-logger.info(f"开始加载模型，模型目录: {MODEL_PATH}")
-# 检查目录是否存在
-if not os.path.exists(MODEL_PATH):
-    logger.error(f"模型目录不存在: {MODEL_PATH}")
-else:
-    # 列出目录中的文件
+# 模型集版本号，每次加载新的模型集递增，用于使预测缓存失效
+model_set_version = 0
+# 各模型的判定阈值，与模型一同在加载时确定 (正类概率超过阈值判为阳性)
+model_thresholds = {}
+DEFAULT_DECISION_THRESHOLD = 0.5
+
+def global_feature_importances(models: dict) -> dict:
+    """XGBoost 的全局特征重要性 (特征 -> 重要性，按重要性降序)，模型不可用时返回空字典。"""
+    xgb_model = models.get('xgboost')
+    if xgb_model is None:
+        return {}
     try:
-        model_files = os.listdir(MODEL_PATH)
-        logger.info(f"模型目录中的文件: {model_files}")
+        importance_scores = xgb_model.feature_importances_
+        contributions = {EXPECTED_FEATURES[i]: float(importance_scores[i]) for i in range(len(EXPECTED_FEATURES))}
+        return dict(sorted(contributions.items(), key=lambda item: item[1], reverse=True))
     except Exception as e:
-        logger.error(f"列出模型目录内容时出错: {e}")
-        model_files = []
+        logger.error(f"计算 XGBoost 特征重要性时出错: {e}")
+        return {}
+
+class ModelSet:
+    """一组已加载并预热的模型及其判定阈值。
+
+    安装后不在原地修改: 延迟加载的模型在第一次使用时加载，然后以新的字典整体替换 models，
+    正在遍历旧字典的请求不受影响。
+    """
+
+    def __init__(self, models: dict, sources: dict = None, signature: tuple = (), lazy_keys=(), load_stats: dict = None):
+        self._models = models
+        self.thresholds = self._thresholds_for(models)
+        # XGBoost 的全局特征重要性，模型不变则不变，加载时计算一次
+        self.global_importances = global_feature_importances(models)
+        self.version = 0  # 安装时分配
+        self.sources = sources or {}  # 模型键 -> 加载的文件路径 (模拟模型为 None)
+        self.signature = signature  # 加载时模型目录的文件签名，用于检测文件变化
+        self.load_stats = load_stats or {}  # 模型键 -> 加载耗时与内存
+        self.loaded_at = datetime.now().isoformat()
+        self._lazy_keys = frozenset(lazy_keys)
+        self._lazy_lock = threading.Lock()
+
+    @staticmethod
+    def _thresholds_for(models: dict) -> dict:
+        # 模型对象上若带有 decision_threshold_ 属性则使用该值，否则使用默认阈值 0.5
+        return {
+            model_key: float(getattr(model, 'decision_threshold_', DEFAULT_DECISION_THRESHOLD))
+            for model_key, model in models.items() if model is not None
+        }
+
+    @property
+    def models(self) -> dict:
+        """全部模型 (会触发尚未加载的延迟模型加载)。"""
+        if self._lazy_keys:
+            self._load_lazy(self._lazy_keys)
+        return self._models
+
+    def get_model(self, model_key: str):
+        """返回单个模型，只加载这一个延迟模型。"""
+        if model_key in self._lazy_keys:
+            self._load_lazy([model_key])
+        return self._models.get(model_key)
+
+    def _load_lazy(self, model_keys):
+        with self._lazy_lock:
+            pending = [model_key for model_key in MODEL_NAMES if model_key in model_keys and model_key in self._lazy_keys]
+            if not pending:
+                return
+            loaded, sources, stats = _load_model_files(pending)
+            for model_key in _warm_up_models(loaded):
+                loaded[model_key] = None
+            merged = {**self._models, **loaded}
+            self._models = {model_key: merged[model_key] for model_key in MODEL_NAMES if model_key in merged}
+            self.thresholds = self._thresholds_for(self._models)
+            self.global_importances = global_feature_importances(self._models)
+            self.sources = {**self.sources, **sources}
+            self.load_stats = {**self.load_stats, **stats}
+            self._lazy_keys = self._lazy_keys.difference(pending)
+            _publish_model_set(self)
+            logger.info(f"延迟加载模型完成: {', '.join(pending)}")
+
+    def available_models(self) -> dict:
+        """可用模型 (延迟模型视为可用，不触发加载)。"""
+        return {
+            model_key: display_name for model_key, display_name in MODEL_NAMES.items()
+            if self._models.get(model_key) is not None or model_key in self._lazy_keys
+        }
+
+    def lazy_models(self) -> list:
+        return sorted(self._lazy_keys)
+
+    def __reduce__(self):
+        # 传给推理进程池时不序列化模型本身: 工作进程使用自己加载的当前模型集 (模型更换时进程池会重建)
+        return (current_model_set, ())
+
+_active_model_set = ModelSet({})
+_model_swap_lock = threading.Lock()
+_initial_load_lock = threading.Lock()
+
+def current_model_set() -> ModelSet:
+    """返回当前模型集。请求开始时调用一次，之后只使用这个快照。
+
+    应用启动阶段 (load_models) 之前调用时 (例如脚本或工具直接使用本模块)，会先加载模型。
+    """
+    if _active_model_set.version == 0:
+        with _initial_load_lock:
+            if _active_model_set.version == 0:
+                load_models()
+    return _active_model_set
 
 # 简化的模型文件名映射
 model_name_mapping = {
@@ -103,18 +826,130 @@ fallback_model_patterns = {
     'naive_bayes': ['naive_bayes_model.pkl', 'naive_bayes.pkl', 'NaiveBayes.pkl', 'NaiveBayes.model']
 }
 
-def load_models():
-    """重新加载所有模型文件，用于初始化或需要重新加载模型时调用。"""
-    global models
-    
-    # 初始化模型字典
-    models = {}
-    logger.info(f"开始重新加载所有模型，模型目录: {MODEL_PATH}")
+def load_models(lazy_keys=None) -> "ModelSet":
+    """加载模型目录中的模型，预热后原子替换当前模型集，用于应用启动或需要重新加载模型时调用。
+
+    Args:
+        lazy_keys: 推迟到第一次使用时加载的模型键，省略时使用 MODEL_LAZY_MODELS 配置
+    """
+    return _install_model_set(build_model_set(strict=False, lazy_keys=lazy_keys))
+
+def _configured_lazy_models() -> set:
+    return {key.strip() for key in MODEL_LAZY_MODELS.split(',') if key.strip() in MODEL_NAMES}
+
+def build_model_set(strict: bool = False, lazy_keys=None) -> "ModelSet":
+    """并行加载并预热一组新模型，不影响当前正在使用的模型集。
+
+    strict=True 时 (热更新) 全部模型立即加载，任一模型需要用模拟模型替代或预热失败都会抛出 RuntimeError，
+    调用方保留旧模型集；否则预热失败的模型置为 None。
+    """
+    signature = _model_dir_signature()
+    lazy = set() if strict else (_configured_lazy_models() if lazy_keys is None else set(lazy_keys) & set(MODEL_NAMES))
+    eager = [model_key for model_key in MODEL_NAMES if model_key not in lazy]
+    new_models, sources, stats = _load_model_files(eager)
+    if strict:
+        missing = [model_key for model_key in MODEL_NAMES if not sources.get(model_key)]
+        if missing:
+            raise RuntimeError(f"以下模型没有可用的模型文件: {', '.join(missing)}")
+    failed = _warm_up_models(new_models)
+    if failed:
+        if strict:
+            raise RuntimeError(f"新模型预热失败: {', '.join(failed)}")
+        for model_key in failed:
+            new_models[model_key] = None
+    if lazy:
+        logger.info(f"以下模型将在第一次使用时加载: {', '.join(sorted(lazy))}")
+    return ModelSet(new_models, sources, signature, lazy_keys=lazy, load_stats=stats)
+
+def _publish_model_set(model_set: "ModelSet"):
+    """同步旧的模块级变量 (models / model_thresholds / model_set_version)，仅当 model_set 是当前模型集时。"""
+    global models, model_thresholds, model_set_version
+    with _model_swap_lock:
+        if _active_model_set is model_set:
+            models, model_thresholds, model_set_version = model_set._models, model_set.thresholds, model_set.version
+
+def _install_model_set(model_set: "ModelSet") -> "ModelSet":
+    """原子替换当前模型集: 分配新的版本号，并清空基于旧模型的预测缓存。
+
+    只替换引用，不修改旧模型集，持有旧快照的请求会用旧模型完成。
+    """
+    global _active_model_set
+    with _model_swap_lock:
+        model_set.version = _active_model_set.version + 1
+        _active_model_set = model_set
+    _publish_model_set(model_set)
+    prediction_cache.clear()
+    inference_executor.reset()
+    return model_set
+
+def _warm_up_models(candidate_models: dict) -> list:
+    """用一行全零输入对每个模型预测一次，提前触发延迟初始化并发现无法使用的模型，返回预热失败的模型键。"""
+    dummy = np.zeros((1, len(EXPECTED_FEATURES)), dtype=np.float64)
+    failed = []
+    for model_key, model in candidate_models.items():
+        if model is None:
+            continue
+        try:
+            model_predict_proba(model, dummy)
+        except Exception as e:
+            logger.error(f"模型 {model_key} 预热失败: {e}")
+            failed.append(model_key)
+    return failed
+
+def _model_dir_signature() -> tuple:
+    """模型目录中各文件的 (文件名, 修改时间, 大小)，用于检测模型文件是否变化。"""
+    try:
+        with os.scandir(MODEL_PATH) as entries:
+            signature = [
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in entries if entry.is_file() and not entry.name.startswith('.')
+            ]
+    except FileNotFoundError:
+        return ()
+    # 原生格式通过清单整体更新，清单变化即视为模型变化
+    manifest_path = NATIVE_MODEL_PATH / model_artifacts.MANIFEST_FILENAME
+    if manifest_path.exists():
+        stat = manifest_path.stat()
+        signature.append((f"native/{manifest_path.name}", stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(signature))
+
+def _current_rss() -> int:
+    """当前进程的常驻内存 (字节)，无法获取时返回 0。"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return 0
+
+def _load_model_files(model_keys=None, workers: int = None) -> tuple[dict, dict, dict]:
+    """在线程池中并行加载各模型文件 (joblib 反序列化大部分时间释放 GIL)。
+
+    Args:
+        model_keys: 要加载的模型键，省略时加载全部模型
+        workers: 并行加载的线程数，省略时使用 MODEL_LOAD_WORKERS
+
+    Returns:
+        tuple[dict, dict, dict]: (模型键 -> 模型对象, 模型键 -> 加载的文件路径 (模拟模型为 None),
+        模型键 -> {"load_ms", "file_bytes", "rss_delta_bytes"})
+    """
+    model_keys = [model_key for model_key in MODEL_NAMES if model_keys is None or model_key in model_keys]
+    # 加载到新的字典中，加载完成前不影响当前模型集
+    loaded = {}
+    sources = {}
+    stats = {}
+    if not model_keys:
+        return loaded, sources, stats
+    logger.info(f"开始加载模型 {model_keys}，模型目录: {MODEL_PATH}")
     
     # 检查目录是否存在
     if not os.path.exists(MODEL_PATH):
         logger.error(f"模型目录不存在: {MODEL_PATH}")
-        return
+        return loaded, sources, stats
     
     # 列出目录中的文件
     try:
@@ -124,85 +959,169 @@ def load_models():
         # 如果目录为空，使用模拟模型创建占位
         if not model_files:
             logger.warning("模型目录为空，使用模拟模型替代")
-            _create_mock_models()
-            return
+            return _create_mock_models(model_keys), sources, stats
     except Exception as e:
         logger.error(f"列出模型目录内容时出错: {e}")
         model_files = []
-    
-    # 加载每个模型
-    for model_key, display_name in MODEL_NAMES.items():
-        logger.info(f"尝试加载模型: {model_key} ({display_name})")
-        model_loaded = False
-        
-        # 1. 首先尝试使用主要映射的文件名
-        filename = model_name_mapping.get(model_key)
-        if filename:
-            model_file_path = MODEL_PATH / filename
-            logger.info(f"尝试加载模型文件: {model_file_path}")
-            
+
+    native_manifest = {}
+    if MODEL_NATIVE_ENABLED:
+        try:
+            native_manifest = model_artifacts.read_manifest(NATIVE_MODEL_PATH)["models"]
+        except Exception as e:
+            logger.error(f"读取原生模型清单失败，使用 pickle 加载: {e}")
+
+    def load_one(model_key):
+        rss_before = _current_rss()
+        started = time.perf_counter()
+        model, source = _load_model(model_key, model_files, native_manifest.get(model_key))
+        if source:
+            model = _with_inference_engine(model_key, model)
+        load_ms = (time.perf_counter() - started) * 1000
+        return model_key, model, source, {
+            "load_ms": load_ms,
+            "file_bytes": os.path.getsize(source) if source else 0,
+            # 并行加载时各模型的内存增量会相互重叠，仅供参考
+            "rss_delta_bytes": max(0, _current_rss() - rss_before),
+        }
+
+    workers = max(1, min(len(model_keys), MODEL_LOAD_WORKERS if workers is None else workers))
+    if workers > 1:
+        _import_model_libraries()
+    rss_before = _current_rss()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hapi-model-load') as pool:
+        for model_key, model, source, model_stats in pool.map(load_one, model_keys):
+            loaded[model_key] = model
+            sources[model_key] = source
+            stats[model_key] = model_stats
+            logger.info(f"模型 {model_key} 加载耗时 {model_stats['load_ms']:.0f} ms, 文件 {model_stats['file_bytes'] / 1024:.0f} KB, 内存增量约 {model_stats['rss_delta_bytes'] / 1024 / 1024:.1f} MB")
+    logger.info(f"{len(model_keys)} 个模型加载完成 ({workers} 线程): 总耗时 {(time.perf_counter() - started) * 1000:.0f} ms, 内存增量 {max(0, _current_rss() - rss_before) / 1024 / 1024:.1f} MB")
+    return loaded, sources, stats
+
+def _import_model_libraries():
+    """在当前线程中先导入反序列化模型所需的库。
+
+    多个加载线程同时首次导入 sklearn 的子模块时会触发循环导入错误或模块锁死锁，导致模型被模拟模型替代。
+    """
+    for module_name in ('sklearn.base', 'sklearn.tree', 'sklearn.ensemble', 'sklearn.linear_model',
+                        'sklearn.naive_bayes', 'xgboost'):
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            logger.warning(f"导入 {module_name} 失败: {e}")
+
+def _with_inference_engine(model_key: str, model):
+    """按配置把模型包装为快速推理引擎 (随机森林向量化遍历 / XGBoost inplace_predict)。
+
+    未启用、模型类型不支持或概率校验不一致时返回原模型。
+    """
+    flat_tree_keys = {key.strip() for key in MODEL_FLAT_TREE_MODELS.split(',') if key.strip()}
+    try:
+        if model_key in flat_tree_keys:
+            engine = tree_engine.build_flat_forest(model, max_rows=MODEL_FLAT_TREE_MAX_ROWS)
+        elif MODEL_XGB_INPLACE and model_key == 'xgboost':
+            engine = tree_engine.build_xgboost_inplace(
+                model, rows_per_thread=MODEL_XGB_ROWS_PER_THREAD, max_threads=MODEL_XGB_MAX_THREADS
+            )
+        else:
+            return model
+    except Exception as e:
+        logger.error(f"模型 {model_key} 构建快速推理引擎失败，使用原模型推理: {e}")
+        return model
+    if engine is None:
+        logger.warning(f"模型 {model_key} 不支持快速推理引擎，使用原模型推理")
+        return model
+    return engine
+
+def _load_model(model_key: str, model_files: list, native_entry: dict = None):
+    """按原生格式、主要文件名、备选文件名、候选文件的顺序加载一个模型，都失败时创建模拟模型。
+
+    Returns:
+        (模型对象, 加载的文件路径；模拟模型为 None)
+    """
+    display_name = MODEL_NAMES[model_key]
+    logger.info(f"尝试加载模型: {model_key} ({display_name})")
+
+    # 0. 优先使用转换好的原生格式 (不经过 pickle)；源 pickle 在转换后发生变化时原生文件视为过期
+    if native_entry:
+        source_path = MODEL_PATH / native_entry["source"]["file"]
+        if source_path.exists() and not model_artifacts.source_unchanged(native_entry, source_path):
+            logger.warning(f"模型 {model_key} 的原生文件已过期 (源文件 {source_path.name} 已变化)，改用 pickle 加载")
+        else:
             try:
-                if model_file_path.exists():
-                    models[model_key] = joblib.load(model_file_path)
-                    logger.info(f"成功加载模型: {model_key} 从 {model_file_path}")
-                    model_loaded = True
-                else:
-                    logger.warning(f"主要模型文件未找到: {model_file_path}")
+                model = model_artifacts.load_native_model(
+                    NATIVE_MODEL_PATH, native_entry, verify=MODEL_NATIVE_VERIFY, mmap=MODEL_NATIVE_MMAP
+                )
+                native_path = NATIVE_MODEL_PATH / next(iter(native_entry["files"]))
+                logger.info(f"成功从原生格式加载模型: {model_key} 从 {native_path}")
+                return model, str(native_path)
             except Exception as e:
-                logger.error(f"加载主要模型文件 {model_key} 出错: {e}")
-        
-        # 2. 如果主要映射失败，尝试备选文件名
-        if not model_loaded and model_key in fallback_model_patterns:
-            for fallback_name in fallback_model_patterns[model_key]:
-                fallback_path = MODEL_PATH / fallback_name
-                logger.info(f"尝试加载备选模型文件: {fallback_path}")
-                
-                try:
-                    if fallback_path.exists():
-                        models[model_key] = joblib.load(fallback_path)
-                        logger.info(f"成功从备选路径加载模型: {model_key} 从 {fallback_path}")
-                        model_loaded = True
-                        break
-                except Exception as e:
-                    logger.error(f"加载备选模型文件 {fallback_path} 出错: {e}")
-        
-        # 3. 如果所有尝试都失败，尝试在目录中查找任何包含模型名称的文件
-        if not model_loaded:
-            potential_files = [f for f in model_files if model_key.lower() in f.lower()]
-            for pot_file in potential_files:
-                pot_path = MODEL_PATH / pot_file
-                logger.info(f"尝试加载候选模型文件: {pot_path}")
-                try:
-                    models[model_key] = joblib.load(pot_path)
-                    logger.info(f"成功从候选文件加载模型: {model_key} 从 {pot_path}")
-                    model_loaded = True
-                    break
-                except Exception as e:
-                    logger.error(f"加载候选模型文件 {pot_path} 出错: {e}")
-        
-        # 4. 如果所有尝试都失败，创建模拟模型
-        if not model_loaded:
-            logger.warning(f"所有尝试均未能加载模型 {model_key}，使用模拟模型替代")
-            _create_mock_model(model_key)
+                logger.error(f"加载原生格式模型 {model_key} 出错，改用 pickle 加载: {e}")
+
+    # 1. 首先尝试使用主要映射的文件名
+    filename = model_name_mapping.get(model_key)
+    if filename:
+        model_file_path = MODEL_PATH / filename
+        logger.info(f"尝试加载模型文件: {model_file_path}")
+
+        try:
+            if model_file_path.exists():
+                model = joblib.load(model_file_path)
+                logger.info(f"成功加载模型: {model_key} 从 {model_file_path}")
+                return model, str(model_file_path)
+            else:
+                logger.warning(f"主要模型文件未找到: {model_file_path}")
+        except Exception as e:
+            logger.error(f"加载主要模型文件 {model_key} 出错: {e}")
+
+    # 2. 如果主要映射失败，尝试备选文件名
+    for fallback_name in fallback_model_patterns.get(model_key, []):
+        fallback_path = MODEL_PATH / fallback_name
+        logger.info(f"尝试加载备选模型文件: {fallback_path}")
+
+        try:
+            if fallback_path.exists():
+                model = joblib.load(fallback_path)
+                logger.info(f"成功从备选路径加载模型: {model_key} 从 {fallback_path}")
+                return model, str(fallback_path)
+        except Exception as e:
+            logger.error(f"加载备选模型文件 {fallback_path} 出错: {e}")
+
+    # 3. 如果所有尝试都失败，尝试在目录中查找任何包含模型名称的文件
+    potential_files = [f for f in model_files if model_key.lower() in f.lower()]
+    for pot_file in potential_files:
+        pot_path = MODEL_PATH / pot_file
+        logger.info(f"尝试加载候选模型文件: {pot_path}")
+        try:
+            model = joblib.load(pot_path)
+            logger.info(f"成功从候选文件加载模型: {model_key} 从 {pot_path}")
+            return model, str(pot_path)
+        except Exception as e:
+            logger.error(f"加载候选模型文件 {pot_path} 出错: {e}")
 
-def _create_mock_models():
+    # 4. 如果所有尝试都失败，创建模拟模型
+    logger.warning(f"所有尝试均未能加载模型 {model_key}，使用模拟模型替代")
+    return _create_mock_model(model_key), None
+
+def _create_mock_models(model_keys=None) -> dict:
     """创建模拟的模型对象用于测试。
     
     当真实模型文件不可用时，创建简单的模拟模型以保证功能可用。
     """
+    mock_models = {}
     try:
-        from sklearn.ensemble import RandomForestClassifier
-        from sklearn.linear_model import LogisticRegression
-        
         # 创建简单的模拟模型
         logger.info("创建模拟模型")
         for model_key in MODEL_NAMES:
-            _create_mock_model(model_key)
+            if model_keys is None or model_key in model_keys:
+                mock_models[model_key] = _create_mock_model(model_key)
     except Exception as e:
         logger.error(f"创建模拟模型时出错: {e}")
+    return mock_models
 
 def _create_mock_model(model_key):
-    """为指定的模型键创建模拟模型"""
+    """为指定的模型键创建并返回拟合好的模拟模型，失败时返回 None"""
     try:
         # 尝试导入必要的库
         from sklearn.ensemble import RandomForestClassifier
@@ -214,34 +1133,238 @@ def _create_mock_model(model_key):
         logger.info(f"为 {model_key} 创建模拟模型")
         
         if model_key == 'random_forest':
-            models[model_key] = RandomForestClassifier(n_estimators=10, random_state=42)
+            model = RandomForestClassifier(n_estimators=10, random_state=42)
         elif model_key == 'logistic_regression':
-            models[model_key] = LogisticRegression(random_state=42)
+            model = LogisticRegression(random_state=42)
         elif model_key == 'naive_bayes':
-            models[model_key] = GaussianNB()
+            model = GaussianNB()
         elif model_key == 'xgboost':
-            models[model_key] = xgb.XGBClassifier(n_estimators=10, random_state=42)
+            model = xgb.XGBClassifier(n_estimators=10, random_state=42)
         else:
             # 默认使用随机森林
-            models[model_key] = RandomForestClassifier(n_estimators=10, random_state=42)
+            model = RandomForestClassifier(n_estimators=10, random_state=42)
         
         # 使用简单特征训练模型
-        import numpy as np
         X = np.random.rand(100, len(EXPECTED_FEATURES))
         y = np.random.randint(0, 2, 100)
         
         # 拟合模型
-        models[model_key].fit(X, y)
+        model.fit(X, y)
         logger.info(f"成功创建并拟合模拟模型: {model_key}")
+        return model
     except ImportError as ie:
         logger.error(f"导入必要库失败，无法创建模拟模型: {ie}")
-        models[model_key] = None
+        return None
     except Exception as e:
         logger.error(f"创建模拟模型 {model_key} 时出错: {e}")
-        models[model_key] = None
+        return None
+
+class ModelReloader:
+    """模型热更新。
+
+    在后台线程中加载并预热新的模型集，成功后原子替换当前模型集；失败时保留旧模型集。
+    可由管理员接口触发，也可以定期检查模型目录中文件的修改时间，发现变化后自动触发。
+    模型集属于单个进程: 管理员触发时 (reload_all) 本进程更新成功后写入热更新标记文件，
+    其他 worker 进程的同步任务每 sync_interval 秒检查一次标记，发现新的标记后各自热更新。
+    """
+
+    MARKER_FILENAME = '.reload_request.json'
+
+    def __init__(self, watch_interval_seconds: float = MODEL_WATCH_INTERVAL_SECONDS, watch_enabled: bool = MODEL_WATCH_ENABLED,
+                 sync_interval_seconds: float = MODEL_SYNC_INTERVAL_SECONDS):
+        self.watch_interval = max(1.0, float(watch_interval_seconds))
+        self.watch_enabled = watch_enabled
+        self.sync_interval = max(1.0, float(sync_interval_seconds))
+        self.marker_path = MODEL_PATH / self.MARKER_FILENAME
+        self._lock = None  # asyncio.Lock，首次使用时在事件循环中创建
+        self._task = None
+        self._sync_task = None
+        self._applied_generation = None  # 本进程已处理的热更新标记
+        self._pending_signature = None
+        self._failed_signature = None
+        self.reloads = 0
+        self.failures = 0
+        self.last_trigger = None
+        self.last_reload_at = None
+        self.last_reload_ms = 0.0
+        self.last_error = None
+
+    async def reload(self, trigger: str = "管理员触发") -> dict:
+        """加载、预热并替换模型集，同一时间只进行一次热更新。失败时抛出 RuntimeError，旧模型集继续使用。"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            previous = current_model_set()
+            started = time.perf_counter()
+            logger.info(f"开始模型热更新 ({trigger})，当前版本 {previous.version}")
+            try:
+                model_set = await asyncio.to_thread(build_model_set, True)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                logger.error(f"模型热更新失败 ({trigger})，继续使用版本 {previous.version}: {e}")
+                raise RuntimeError(f"模型热更新失败: {e}")
+            _install_model_set(model_set)
+            duration_ms = (time.perf_counter() - started) * 1000
+            self.reloads += 1
+            self.last_trigger = trigger
+            self.last_reload_at = model_set.loaded_at
+            self.last_reload_ms = duration_ms
+            self.last_error = None
+            logger.info(f"模型热更新完成 ({trigger}): 版本 {previous.version} -> {model_set.version}，耗时 {duration_ms:.0f} ms")
+            return {
+                "previous_version": previous.version,
+                "version": model_set.version,
+                "models": model_set.available_models(),
+                "duration_ms": duration_ms,
+            }
+
+    def _read_marker(self) -> dict:
+        try:
+            with open(self.marker_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取模型热更新标记失败: {e}")
+            return {}
+
+    def _write_marker(self, marker: dict):
+        tmp_path = self.marker_path.with_name(f"{self.marker_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(marker, f, ensure_ascii=False)
+            os.replace(tmp_path, self.marker_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    async def reload_all(self, trigger: str = "管理员触发") -> dict:
+        """在本进程热更新，成功后写入热更新标记，通知其他 worker 进程在 sync_interval 秒内各自热更新。
+
+        失败时抛出 RuntimeError，不通知其他进程。
+        """
+        result = await self.reload(trigger)
+        generation = uuid.uuid4().hex
+        self._applied_generation = generation
+        marker = {"generation": generation, "trigger": trigger, "pid": os.getpid(),
+                  "requested_at": datetime.now().isoformat()}
+        try:
+            await asyncio.to_thread(self._write_marker, marker)
+        except OSError as e:
+            logger.error(f"写入模型热更新标记失败，其他 worker 进程不会更新: {e}")
+            return {**result, "broadcast": False}
+        return {**result, "broadcast": True, "sync_interval_seconds": self.sync_interval}
+
+    async def _sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                marker = await asyncio.to_thread(self._read_marker)
+                generation = marker.get("generation")
+                if generation is None or generation == self._applied_generation:
+                    continue
+                self._applied_generation = generation
+                try:
+                    await self.reload(f"进程 {marker.get('pid')} 的热更新: {marker.get('trigger')}")
+                except RuntimeError:
+                    pass  # reload 已记录错误，本进程继续使用旧模型集
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"检查模型热更新标记时出错: {e}", exc_info=True)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                signature = await asyncio.to_thread(_model_dir_signature)
+                if signature == current_model_set().signature or signature == self._failed_signature:
+                    self._pending_signature = None
+                    continue
+                # 文件可能仍在复制中: 连续两次检查结果相同才触发
+                if signature != self._pending_signature:
+                    self._pending_signature = signature
+                    continue
+                self._pending_signature = None
+                try:
+                    await self.reload("模型文件变化")
+                except RuntimeError:
+                    # 同一组文件不再重复尝试，直到文件再次变化
+                    self._failed_signature = signature
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"检查模型文件变化时出错: {e}", exc_info=True)
+
+    def start(self):
+        """启动热更新标记同步任务和模型文件监视任务 (MODEL_WATCH_ENABLED 开启时)，应用启动时调用。"""
+        loop = asyncio.get_running_loop()
+        if self._sync_task is None:
+            # 启动时加载的模型已是最新文件，之前的标记不需要再处理
+            self._applied_generation = self._read_marker().get("generation")
+            self._sync_task = loop.create_task(self._sync())
+        if not self.watch_enabled or self._task is not None:
+            return
+        self._task = loop.create_task(self._watch())
+        logger.info(f"模型文件监视已启动，间隔 {self.watch_interval:.0f} 秒")
+
+    async def stop(self):
+        for task in (self._task, self._sync_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._sync_task = None
+
+    def get_metrics(self) -> dict:
+        model_set = current_model_set()
+        return {
+            "version": model_set.version,
+            "loaded_at": model_set.loaded_at,
+            "models": model_set.available_models(),
+            "sources": dict(model_set.sources),
+            "lazy_models": model_set.lazy_models(),
+            "load_stats": dict(model_set.load_stats),
+            "watch_enabled": self.watch_enabled,
+            "watch_interval_seconds": self.watch_interval,
+            "sync_interval_seconds": self.sync_interval,
+            "applied_generation": self._applied_generation,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_trigger": self.last_trigger,
+            "last_reload_at": self.last_reload_at,
+            "last_reload_ms": self.last_reload_ms,
+            "last_error": self.last_error,
+        }
+
+model_reloader = ModelReloader()
+
+async def startup_models():
+    """应用启动阶段加载模型: 在后台线程中并行加载，不阻塞事件循环。"""
+    model_set = await asyncio.to_thread(current_model_set)
+    logger.info(f"模型集版本 {model_set.version} 已就绪，可用模型: {list(model_set.available_models())}")
+
+
+def preload_for_workers(freeze_gc: bool = True) -> "ModelSet":
+    """gunicorn preload 模式下在主进程 fork worker 之前调用: 立即加载全部模型 (忽略延迟加载配置) 并注册报告字体。
+
+    worker 继承主进程的模型集，startup_models 不会重复加载，模型内存页在各 worker 之间以写时复制方式共享。
+    freeze_gc=True 时把现有对象移入 GC 永久代，避免 worker 中的垃圾回收写入对象头而复制这些内存页。
+    某个 worker 之后热更新得到的新模型集只属于该 worker，不再共享。
+    """
+    model_set = load_models(lazy_keys=())
+    register_report_font()
+    if freeze_gc:
+        gc.collect()
+        gc.freeze()
+    logger.info(f"主进程已预加载模型集版本 {model_set.version}，GC 冻结对象数: {gc.get_freeze_count()}")
+    return model_set
 
-# 初始化时尝试加载模型
-load_models()
 
 # 下面代码维持现有的get_available_models实现但增强其功能
 def get_available_models():
@@ -251,16 +1374,16 @@ def get_available_models():
     # 重新检查模型目录是否存在
     if not os.path.exists(MODEL_PATH):
         logger.error(f"模型目录不存在: {MODEL_PATH}")
-        if not models: # 如果模型字典为空，尝试创建模拟模型
-            _create_mock_models()
+        if not current_model_set().models: # 如果模型字典为空，尝试创建模拟模型
+            _install_model_set(ModelSet(_create_mock_models()))
     
     # 如果当前没有可用模型，尝试重新加载
-    if not any(model is not None for model in models.values()):
+    if not current_model_set().available_models():
         logger.warning("当前没有可用模型，尝试重新加载")
         load_models()
     
     # 返回已成功加载的模型
-    available_models = {key: MODEL_NAMES[key] for key, model in models.items() if model is not None}
+    available_models = current_model_set().available_models()
     
     if not available_models:
         logger.warning("没有一个模型加载成功，预测功能将不可用")
@@ -299,157 +1422,461 @@ EXPECTED_FEATURES = [
 ]
 
 # --- Reportlab Font Setup (Copied from HAPI app.py) ---
-try:
-    pdfmetrics.registerFont(UnicodeCIDFont('STSong-Light'))
-    DEFAULT_FONT = 'STSong-Light'
-    logger.info("使用 ReportLab CID 字体: STSong-Light")
-except Exception as e:
-    logger.warning(f"注册 Reportlab STSong-Light 字体失败: {e}. 尝试系统字体。")
+# 字体在首次生成报告时注册 (见 register_report_font)，导入模块时不做任何 IO
+DEFAULT_FONT = None
+_font_lock = threading.Lock()
+
+def register_report_font() -> str:
+    """注册报告使用的中文字体并返回字体名，只在第一次调用时注册。"""
+    global DEFAULT_FONT
+    if DEFAULT_FONT is not None:
+        return DEFAULT_FONT
+    with _font_lock:
+        if DEFAULT_FONT is None:
+            DEFAULT_FONT = _register_font()
+    return DEFAULT_FONT
+
+def _register_font() -> str:
+    try:
+        pdfmetrics.registerFont(UnicodeCIDFont('STSong-Light'))
+        logger.info("使用 ReportLab CID 字体: STSong-Light")
+        return 'STSong-Light'
+    except Exception as e:
+        logger.warning(f"注册 Reportlab STSong-Light 字体失败: {e}. 尝试系统字体。")
     font_paths = [
         '/System/Library/Fonts/STHeiti Light.ttc',
         '/System/Library/Fonts/PingFang.ttc',
         '/Library/Fonts/Arial Unicode.ttf',
         '/System/Library/Fonts/Hiragino Sans GB.ttc',
     ]
-    registered_custom_font = False
     for path in font_paths:
         if os.path.exists(path):
             try:
                 font_name = os.path.basename(path).split('.')[0].replace(' ', '')
                 pdfmetrics.registerFont(TTFont(font_name, path))
                 logger.info(f"成功注册 Reportlab 字体: {font_name} 从 {path}")
-                DEFAULT_FONT = font_name
-                registered_custom_font = True
-                break
+                return font_name
             except Exception as font_e:
                 logger.warning(f"尝试注册 Reportlab 字体 {path} 失败: {font_e}")
-    if not registered_custom_font:
-        DEFAULT_FONT = 'Helvetica'
-        logger.error("所有中文字体注册失败，回退到 Helvetica。PDF 报告可能无法正确显示中文。")
-
-def prepare_single_input(data: dict) -> pd.DataFrame:
-    """准备单例预测的输入数据，应用 HAPI 的映射、编码和排序。"""
-    input_dict_mapped = {}
-    # 处理数值字段
-    for field in NUMERIC_FIELDS:
-        original_value = data.get(field)
-        if original_value is None:
-            raise ValueError(f"缺少数值字段: {field}")
-        try:
+    logger.error("所有中文字体注册失败，回退到 Helvetica。PDF 报告可能无法正确显示中文。")
+    return 'Helvetica'
+
+class SingleInputEncoder:
+    """单例输入的预编译编码器。
+
+    加载时把 NUMERIC_FIELDS / CATEGORICAL_FIELDS / FIELD_MAPPING / CATEGORY_MAPPING
+    编译为固定的列槽位和查找表，请求时直接填充一行 numpy 数组，不再构造 DataFrame。
+    """
+
+    def __init__(self):
+        self.feature_names = list(EXPECTED_FEATURES)
+        self.n_features = len(self.feature_names)
+        slot_of = {name: i for i, name in enumerate(self.feature_names)}
+
+        # 数值字段: (原始字段名, 列槽位)
+        self.numeric_slots = []
+        for field in NUMERIC_FIELDS:
             mapped_field = FIELD_MAPPING.get(field, field)
-            input_dict_mapped[mapped_field] = [float(original_value)]
-        except (ValueError, TypeError):
-            raise ValueError(f"字段 '{field}' 的值 '{original_value}' 必须是数值")
-    
-    # 处理分类字段
-    for field in CATEGORICAL_FIELDS:
-        original_value = data.get(field)
-        if original_value is None:
-            raise ValueError(f"缺少分类字段: {field}")
-        
-        mapped_field = FIELD_MAPPING.get(field, field) # 获取映射后的字段名
-        mapping_dict = CATEGORY_MAPPING.get(mapped_field) # 使用映射后的字段名查找编码
-        
-        if not mapping_dict:
-             # 如果用映射后的名字找不到，尝试用原始名字 (以防万一)
-             mapping_dict = CATEGORY_MAPPING.get(field)
-             if not mapping_dict:
-                  raise ValueError(f"未找到字段 '{mapped_field}' (来自 '{field}') 的分类编码映射")
-        
-        if original_value not in mapping_dict:
-            raise ValueError(f"字段 '{field}' 的值 '{original_value}' 无效 (允许值: {list(mapping_dict.keys())})")
-            
-        input_dict_mapped[mapped_field] = [mapping_dict[original_value]]
+            self.numeric_slots.append((field, slot_of.get(mapped_field)))
 
-    # 转换为 DataFrame
-    try:
-        input_df = pd.DataFrame(input_dict_mapped)
-    except Exception as e:
-        logger.error(f"从处理后的字典创建 DataFrame 失败: {input_dict_mapped}, Error: {e}")
-        raise ValueError("无法根据输入数据创建有效的 DataFrame")
+        # 分类字段: (原始字段名, 映射后字段名, 列槽位, 编码查找表)
+        self.categorical_slots = []
+        for field in CATEGORICAL_FIELDS:
+            mapped_field = FIELD_MAPPING.get(field, field)
+            mapping_dict = CATEGORY_MAPPING.get(mapped_field) or CATEGORY_MAPPING.get(field)
+            self.categorical_slots.append((field, mapped_field, slot_of.get(mapped_field), mapping_dict))
 
-    # 检查并强制列顺序
-    missing_features = [f for f in EXPECTED_FEATURES if f not in input_df.columns]
-    if missing_features:
-        raise ValueError(f"处理后缺少模型所需的特征: {missing_features}")
-        
-    input_df = input_df[EXPECTED_FEATURES]
-    
-    # 检查是否有 NaN (理论上前面处理过了，再检查一遍)
-    if input_df.isnull().any().any():
-        raise ValueError("数据处理后仍存在无效值 (NaN)")
+        # 与旧实现一致：处理后缺少模型特征时在请求阶段报错
+        filled = {slot for _, slot in self.numeric_slots} | {slot for _, _, slot, _ in self.categorical_slots}
+        self.missing_features = [name for i, name in enumerate(self.feature_names) if i not in filled]
+        # 行模板，请求时复制或直接写入调用方提供的缓冲区
+        self._row_template = np.zeros((1, self.n_features), dtype=np.float64)
 
-    return input_df
+    def new_row(self) -> np.ndarray:
+        """返回一行新的输入缓冲区。"""
+        return self._row_template.copy()
 
-def predict_single(input_df: pd.DataFrame) -> dict:
-    """执行单例预测，返回所有模型结果和特征贡献。"""
-    if not models:
-        raise RuntimeError("模型未正确加载")
+    def encode(self, data: dict, out: np.ndarray = None) -> np.ndarray:
+        """将原始表单数据编码为一行特征数组，校验与错误信息与旧实现保持一致。
 
-    all_predictions = {}
-    all_probabilities = {}
-    feature_contributions = {}
+        Args:
+            data: 原始字段名到取值的字典
+            out: 可选的长度为特征数的一维缓冲区 (例如批量矩阵中的一行)
+
+        Returns:
+            np.ndarray: 形状为 (1, n_features) 的特征行 (传入 out 时返回 out)
+        """
+        row = self.new_row() if out is None else out
+        flat = row.reshape(-1)
+
+        # 处理数值字段
+        for field, slot in self.numeric_slots:
+            original_value = data.get(field)
+            if original_value is None:
+                raise ValueError(f"缺少数值字段: {field}")
+            try:
+                value = float(original_value)
+            except (ValueError, TypeError):
+                raise ValueError(f"字段 '{field}' 的值 '{original_value}' 必须是数值")
+            if slot is not None:
+                flat[slot] = value
+
+        # 处理分类字段
+        for field, mapped_field, slot, mapping_dict in self.categorical_slots:
+            original_value = data.get(field)
+            if original_value is None:
+                raise ValueError(f"缺少分类字段: {field}")
+            if not mapping_dict:
+                raise ValueError(f"未找到字段 '{mapped_field}' (来自 '{field}') 的分类编码映射")
+            if original_value not in mapping_dict:
+                raise ValueError(f"字段 '{field}' 的值 '{original_value}' 无效 (允许值: {list(mapping_dict.keys())})")
+            if slot is not None:
+                flat[slot] = mapping_dict[original_value]
+
+        if self.missing_features:
+            raise ValueError(f"处理后缺少模型所需的特征: {self.missing_features}")
+
+        # 检查是否有 NaN (例如数值字段传入了 'nan')
+        if np.isnan(flat).any():
+            raise ValueError("数据处理后仍存在无效值 (NaN)")
+
+        return row
+
+# 模块加载时编译一次
+single_input_encoder = SingleInputEncoder()
+
+# 模型以带特征名的 DataFrame 训练，单例路径直接传入按 EXPECTED_FEATURES 排好序的数组。
+# 只在确认模型的特征名与 EXPECTED_FEATURES 顺序一致的那次调用中忽略 sklearn 的特征名警告，其他调用方的警告照常显示；
+# catch_warnings 修改的是进程级的过滤器，用锁避免并发的推理线程互相覆盖 (持锁的只是逻辑回归、朴素贝叶斯这类微秒级的小批量推理)
+_feature_name_warning_lock = threading.Lock()
+
+def model_predict_proba(model, input_rows):
+    """调用模型的 predict_proba；输入为按 EXPECTED_FEATURES 排列的数组时不触发特征名警告。"""
+    names = getattr(model, 'feature_names_in_', None)
+    if names is None or not isinstance(input_rows, np.ndarray) or isinstance(model, (tree_engine.FlatForest, tree_engine.XGBoostInplace)):
+        return model.predict_proba(input_rows)
+    if list(names) != EXPECTED_FEATURES:
+        # 特征顺序与编码器不一致: 带上列名交给 sklearn 校验 (顺序不符时报错，而不是按错误的列预测)
+        return model.predict_proba(pd.DataFrame(input_rows, columns=EXPECTED_FEATURES))
+    with _feature_name_warning_lock, warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
+        return model.predict_proba(input_rows)
 
-    for model_key, model in models.items():
+def prepare_single_input(data: dict) -> np.ndarray:
+    """准备单例预测的输入数据，应用 HAPI 的映射、编码和排序。
+
+    返回按 EXPECTED_FEATURES 排列的 (1, 17) 特征数组，由预编译的编码器直接填充。
+    """
+    return single_input_encoder.encode(data)
+
+def single_input_to_frame(input_row: np.ndarray) -> pd.DataFrame:
+    """将编码后的特征数组转换为带列名的 DataFrame (供需要列名的调用方使用)。"""
+    return pd.DataFrame(input_row, columns=EXPECTED_FEATURES)
+
+def predict_single(input_df, model_set: ModelSet = None) -> dict:
+    """执行单例预测，返回所有模型结果和特征贡献。
+
+    input_df 可以是 prepare_single_input 返回的特征数组，也可以是按 EXPECTED_FEATURES 排序的 DataFrame。
+    相同特征向量在同一模型集版本下的结果会从 prediction_cache 中直接返回。
+    """
+    model_set = model_set or current_model_set()
+    input_row = input_df.to_numpy(dtype=np.float64) if isinstance(input_df, pd.DataFrame) else input_df
+    cache_key = PredictionCache.make_key(input_row, model_set.version)
+    cached = prediction_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    result = predict_rows(input_df, model_set)[0]
+    prediction_cache.put(cache_key, result)
+    return result
+
+def _evaluate_models(model_set: ModelSet, model_keys, input_rows, model_outputs: dict, dropped: dict,
+                     rows=None, started: float = None):
+    """对 rows 指定的行 (省略时为全部行) 并发执行各模型推理 (受 ensemble_scheduler 的截止时间约束)。
+
+    模型通过 model_set.get_model 逐个取得，延迟加载的模型只在此处第一次用到时加载。
+    结果写入 model_outputs[model_key] = (正类概率, 类别, rows)，推理出错的模型写入 (None, None, rows)，
+    超时或降级而未计入的模型写入 dropped[model_key] = (原因, rows)。
+    """
+    if rows is not None:
+        input_rows = input_rows.iloc[rows] if isinstance(input_rows, pd.DataFrame) else np.asarray(input_rows)[rows]
+    tasks = {}
+    models = {}
+    for model_key in model_keys:
+        model = models[model_key] = model_set.get_model(model_key)
         if model is None:
             logger.warning(f"跳过预测，模型 '{MODEL_NAMES.get(model_key, model_key)}' 未加载")
             continue
+        tasks[model_key] = functools.partial(model_predict_proba, model, input_rows)
+
+    probas, model_dropped = ensemble_scheduler.run(tasks, started)
+    thresholds = model_set.thresholds  # 延迟模型加载后阈值字典会整体替换，取加载之后的
+    for model_key, reason in model_dropped.items():
+        dropped[model_key] = (reason, rows)
+    for model_key, proba in probas.items():
         try:
-            prob = model.predict_proba(input_df)[0][1] # 正类概率
-            pred = model.predict(input_df)[0] # 预测类别
-            all_predictions[model_key] = int(pred)
-            all_probabilities[model_key] = float(prob)
+            if isinstance(proba, Exception):
+                raise proba
+            preds = classes_from_proba(model_key, models[model_key], proba, thresholds) # 预测类别 (由概率推导)
+            model_outputs[model_key] = (proba[:, 1], preds, rows) # 正类概率, 预测类别, 对应的行号
         except Exception as e:
             logger.error(f"模型 {model_key} 预测错误: {e}")
             # 根据策略决定是否继续或抛出异常
             # raise RuntimeError(f"模型 '{MODEL_NAMES.get(model_key, model_key)}' 预测失败")
-            all_predictions[model_key] = None
-            all_probabilities[model_key] = None
+            model_outputs[model_key] = (None, None, rows) # 保留行号，只有实际运行该模型的行记为失败
+
+def cascade_uncertain_rows(cheap_probabilities: np.ndarray) -> np.ndarray:
+    """低成本模型的平均概率落在任一风险等级阈值 ±CASCADE_BAND 以内 (或没有可用概率) 的行，需要继续运行其余模型。"""
+    uncertain = np.isnan(cheap_probabilities)
+    for threshold in RISK_LEVEL_THRESHOLDS:
+        uncertain |= np.abs(cheap_probabilities - threshold) < CASCADE_BAND
+    return uncertain
+
+def predict_rows(input_rows, model_set: ModelSet = None, cascade: bool = None) -> list[dict]:
+    """对多行已编码的输入执行预测，每个模型只推理一次，按行返回与 predict_single 相同结构的结果。
+
+    model_set 为请求开始时取得的模型集快照，省略时使用当前模型集。
+    cascade 为 True 时 (省略时使用 CASCADE_ENABLED) 先运行 CASCADE_CHEAP_MODELS，只有结果不确定的行才运行其余模型；
+    每行结果的 models_evaluated 列出该行实际运行并得到结果的模型，未运行的模型不出现在 predictions / probabilities 中；
+    对该行运行但出错的模型在 predictions / probabilities 中为 None，并列在 models_failed 中。
+    """
+    model_set = model_set or current_model_set()
+    # 只取模型键，不触发延迟模型加载: 级联跳过的模型不会被加载
+    model_keys = list(model_set.available_models())
+    if not model_keys:
+        raise RuntimeError("模型未正确加载")
+
+    n_rows = len(input_rows)
+    started = time.monotonic()
+    model_outputs = {}
+    dropped = {}
+    cascade = CASCADE_ENABLED if cascade is None else cascade
+    cheap_keys = [key.strip() for key in CASCADE_CHEAP_MODELS.split(',') if key.strip() in model_keys] if cascade else []
+
+    if cheap_keys:
+        _evaluate_models(model_set, cheap_keys, input_rows, model_outputs, dropped, started=started)
+        cheap_probs = [outputs[0] for outputs in (model_outputs.get(key) for key in cheap_keys)
+                       if outputs is not None and outputs[0] is not None]
+        cheap_mean = np.mean(cheap_probs, axis=0) if cheap_probs else np.full(n_rows, np.nan)
+        uncertain = np.flatnonzero(cascade_uncertain_rows(np.asarray(cheap_mean, dtype=np.float64)))
+        remaining = [model_key for model_key in model_keys if model_key not in cheap_keys]
+        if len(uncertain) == n_rows:
+            _evaluate_models(model_set, remaining, input_rows, model_outputs, dropped, started=started)
+        elif len(uncertain):
+            _evaluate_models(model_set, remaining, input_rows, model_outputs, dropped, rows=uncertain, started=started)
+    else:
+        _evaluate_models(model_set, model_keys, input_rows, model_outputs, dropped, started=started)
+
+    # 只对部分行运行的模型: 行号 -> 该模型输出中的位置 (-1 表示未运行)
+    positions = {}
+    for model_key, outputs in model_outputs.items():
+        if outputs[2] is not None:
+            position = np.full(n_rows, -1, dtype=np.intp)
+            position[outputs[2]] = np.arange(len(outputs[2]))
+            positions[model_key] = position
+    # 未计入结果的模型: 行号 -> 是否影响该行
+    dropped_rows = {}
+    for model_key, (reason, rows) in dropped.items():
+        affected = np.ones(n_rows, dtype=bool)
+        if rows is not None:
+            affected[:] = False
+            affected[rows] = True
+        dropped_rows[model_key] = (reason, affected)
+
+    # 特征贡献: 全局重要性 (所有行相同) 或整批一次计算的逐患者贡献
+    patient_contributions = None
+    if FEATURE_CONTRIBUTIONS == 'patient':
+        patient_contributions = patient_contribution_dicts(model_set, input_rows)
+    feature_contributions = model_set.global_importances
+
+    results = []
+    for i in range(n_rows):
+        all_predictions = {}
+        all_probabilities = {}
+        failed = []
+        for model_key in model_keys:
+            if model_key not in model_outputs:
+                continue
+            outputs = model_outputs[model_key]
+            j = positions[model_key][i] if model_key in positions else i
+            if j < 0:
+                continue # 级联提前结束，该行未运行此模型
+            if outputs[0] is None:
+                all_predictions[model_key] = None
+                all_probabilities[model_key] = None
+                failed.append(model_key)
+                continue
+            all_predictions[model_key] = int(outputs[1][j])
+            all_probabilities[model_key] = float(outputs[0][j])
+
+        # 计算风险等级 (基于平均概率)
+        valid_probs = [p for p in all_probabilities.values() if p is not None]
+        risk_level = get_risk_level(valid_probs) # 使用更新后的 get_risk_level
+
+        results.append({
+            "predictions": all_predictions,
+            "probabilities": all_probabilities,
+            "feature_contributions": patient_contributions[i] if patient_contributions is not None else dict(feature_contributions),
+            "feature_contribution_type": 'patient' if patient_contributions is not None else 'global',
+            "risk_level": risk_level,
+            "models_evaluated": [model_key for model_key in all_predictions if model_key not in failed],
+            "models_failed": failed,
+            "models_dropped": {model_key: reason for model_key, (reason, affected) in dropped_rows.items() if affected[i]},
+        })
+    return results
+
+class PredictionCoalescer:
+    """单例预测请求合并器 (micro-batching)。
+
+    空闲时请求直接执行 (不等待窗口)；已有预测在执行或排队时，新请求进入队列，
+    在收集窗口到期或达到最大行数时合并为一个矩阵，每个模型只推理一次，再把各行结果分发回等待的请求。
+    """
+
+    def __init__(self, window_ms: float = COALESCE_WINDOW_MS, max_batch_size: int = COALESCE_MAX_BATCH, enabled: bool = COALESCE_ENABLED):
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.enabled = enabled
+        self._pending = []  # [(input_row, cache_key, future, model_set)]
+        self._timer = None
+        self._running = 0  # 正在执行的批次数
+        self._tasks = set()  # 正在执行的批次任务 (事件循环只持有弱引用，需自行保存以免被回收)
+        # 指标
+        self.requests = 0
+        self.cache_hits = 0
+        self.bypassed = 0
+        self.batches = 0
+        self.batched_rows = 0
+        self.max_queue_depth = 0
+        self.max_batch_seen = 0
+        self.batch_size_histogram = {}
+
+    async def submit(self, input_row) -> dict:
+        """提交一行已编码的输入，返回该行的 predict_single 结果。"""
+        self.requests += 1
+        # 请求到达时的模型集快照，热更新期间排队的请求仍使用同一组模型
+        model_set = current_model_set()
+        cache_key = PredictionCache.make_key(input_row, model_set.version)
+        cached = prediction_cache.get(cache_key)
+        if cached is not None:
+            # 缓存命中的请求不进入队列
+            self.cache_hits += 1
+            return cached
+
+        if not self.enabled or (self._running == 0 and not self._pending):
+            # 队列为空: 直接执行，单请求延迟不受窗口影响
+            self.bypassed += 1
+            self._running += 1
+            try:
+                result = (await self._run(predict_rows, input_row, model_set))[0]
+                prediction_cache.put(cache_key, result)
+                return result
+            finally:
+                self._running -= 1
+                if self._pending and self._timer is None:
+                    self._schedule_flush()
 
-    # 计算特征贡献 (仅 XGBoost)
-    if 'xgboost' in models and models['xgboost'] is not None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((input_row, cache_key, future, model_set))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._schedule_flush()
+        return await future
+
+    def _schedule_flush(self):
+        """在收集窗口结束后合并执行队列中的请求。"""
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(self.window, self._flush)
+
+    def _flush(self):
+        """取出最多 max_batch_size 个排队请求 (使用同一模型集的连续请求)，作为一个批次执行。"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        model_set = self._pending[0][3]
+        size = 0
+        while size < min(self.max_batch_size, len(self._pending)) and self._pending[size][3] is model_set:
+            size += 1
+        batch = self._pending[:size]
+        self._pending = self._pending[size:]
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if self._pending:
+            self._schedule_flush()
+
+    async def _run_batch(self, batch):
+        batch_size = len(batch)
+        self.batches += 1
+        self.batched_rows += batch_size
+        self.max_batch_seen = max(self.max_batch_seen, batch_size)
+        self.batch_size_histogram[batch_size] = self.batch_size_histogram.get(batch_size, 0) + 1
+        self._running += 1
         try:
-            xgb_model = models['xgboost']
-            if hasattr(xgb_model, 'feature_importances_'):
-                importance_scores = xgb_model.feature_importances_
-                contributions = {EXPECTED_FEATURES[i]: float(importance_scores[i]) for i in range(len(EXPECTED_FEATURES))}
-                feature_contributions = dict(sorted(contributions.items(), key=lambda item: item[1], reverse=True))
-            else:
-                 logger.warning("XGBoost 模型没有 feature_importances_ 属性")
+            matrix = np.vstack([np.asarray(row, dtype=np.float64).reshape(1, -1) for row, _, _, _ in batch])
+            results = await self._run(predict_rows, matrix, batch[0][3])
+            for (_, cache_key, future, _), result in zip(batch, results):
+                prediction_cache.put(cache_key, result)
+                if not future.done():
+                    future.set_result(result)
         except Exception as e:
-            logger.error(f"计算 XGBoost 特征重要性时出错: {e}")
+            logger.error(f"合并预测批次 (共 {batch_size} 行) 执行失败: {e}")
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._running -= 1
 
-    # 计算风险等级 (基于平均概率)
-    valid_probs = [p for p in all_probabilities.values() if p is not None]
-    risk_level = get_risk_level(valid_probs) # 使用更新后的 get_risk_level
+    async def _run(self, func, *args):
+        """在推理执行器中执行，使等待期间到达的请求可以进入队列合并。"""
+        return await inference_executor.run(func, *args)
 
-    return {
-        "predictions": all_predictions,
-        "probabilities": all_probabilities,
-        "feature_contributions": feature_contributions,
-        "risk_level": risk_level
-    }
+    def get_metrics(self) -> dict:
+        """返回队列深度与批次大小等统计指标。"""
+        return {
+            "enabled": self.enabled,
+            "window_ms": self.window * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": len(self._pending),
+            "max_queue_depth": self.max_queue_depth,
+            "running_batches": self._running,
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "bypassed": self.bypassed,
+            "batches": self.batches,
+            "batched_rows": self.batched_rows,
+            "avg_batch_size": (self.batched_rows / self.batches) if self.batches else 0.0,
+            "max_batch_size_seen": self.max_batch_seen,
+            "batch_size_histogram": dict(sorted(self.batch_size_histogram.items())),
+        }
+
+prediction_coalescer = PredictionCoalescer()
 
-def predict_batch(model_key: str, df: pd.DataFrame) -> tuple[list[float], list[int]]:
+def predict_batch(model_key: str, df: pd.DataFrame, model_set: ModelSet = None) -> tuple[list[float], list[int]]:
     """执行批量预测，返回预测概率和预测结果。
     
     Args:
         model_key: 要使用的模型键名
         df: 预处理后的输入DataFrame
+        model_set: 任务开始时取得的模型集快照，省略时使用当前模型集
         
     Returns:
         tuple[list[float], list[int]]: 预测概率列表和预测结果列表
     """
-    if model_key not in models or models[model_key] is None:
+    model_set = model_set or current_model_set()
+    model = model_set.get_model(model_key)
+    if model is None:
         raise ValueError(f"所选模型 '{MODEL_NAMES.get(model_key, model_key)}' 不可用")
     
-    model = models[model_key]
-    
     try:
+        proba = model.predict_proba(df)
         # 预测概率 (获取正类的概率)
-        probabilities = model.predict_proba(df)[:, 1].tolist()
-        # 预测类别 
-        predictions = model.predict(df).tolist()
+        probabilities = proba[:, 1].tolist()
+        # 预测类别 (由概率推导，只做一次推理)
+        predictions = classes_from_proba(model_key, model, proba, model_set.thresholds).tolist()
         
         # 转换为基本的Python类型
         probabilities = [float(p) for p in probabilities]
@@ -460,14 +1887,89 @@ def predict_batch(model_key: str, df: pd.DataFrame) -> tuple[list[float], list[i
         logger.error(f"批量预测错误 (模型: {model_key}): {e}", exc_info=True)
         raise RuntimeError(f"使用模型 '{MODEL_NAMES.get(model_key, model_key)}' 执行批量预测失败: {str(e)}")
 
+def classes_from_proba(model_key: str, model, proba: np.ndarray, thresholds: dict = None) -> np.ndarray:
+    """根据 predict_proba 的输出和模型的判定阈值得到预测类别，避免再次调用 predict()。
+
+    默认阈值 0.5 时采用与 sklearn / XGBoost predict() 相同的规则：正类概率严格大于负类概率
+    才判为正类 (平票取负类)，结果与 predict() 逐位一致；自定义阈值时正类概率 >= 阈值判为正类。
+    """
+    threshold = (model_thresholds if thresholds is None else thresholds).get(model_key, DEFAULT_DECISION_THRESHOLD)
+    if threshold == DEFAULT_DECISION_THRESHOLD:
+        indices = (proba[:, 1] > proba[:, 0]).astype(int)
+    else:
+        indices = (proba[:, 1] >= threshold).astype(int)
+    classes = getattr(model, 'classes_', None)
+    if classes is not None and len(classes) == 2:
+        return np.asarray(classes)[indices]
+    return indices
+
+# 支持逐患者特征贡献的模型 (按优先顺序)
+CONTRIBUTION_MODELS = ('xgboost', 'logistic_regression')
+
+def _feature_positions(feature_names) -> np.ndarray:
+    """模型训练时的特征顺序中每个特征在 EXPECTED_FEATURES 中的列号 (模型没有特征名时按 EXPECTED_FEATURES 顺序)。"""
+    if feature_names is None:
+        return np.arange(len(EXPECTED_FEATURES))
+    missing = [name for name in feature_names if name not in EXPECTED_FEATURES]
+    if missing:
+        raise ValueError(f"模型特征 {', '.join(map(str, missing))} 不在输入特征中")
+    return np.array([EXPECTED_FEATURES.index(name) for name in feature_names], dtype=np.intp)
+
+def contribution_matrix(model_key: str, model, input_rows) -> np.ndarray:
+    """一次向量化调用计算整批输入的逐患者特征贡献，形状为 (行数, 特征数)，列顺序与 EXPECTED_FEATURES 一致。
+
+    XGBoost 为原生 SHAP 值 (pred_contribs，对数几率空间，去掉最后的偏置列)；逻辑回归为 系数 × 特征值。
+    输入先按模型训练时的特征顺序排列，计算结果再映射回 EXPECTED_FEATURES 的列。
+    其他模型不支持，抛出 ValueError。
+    """
+    estimator = tree_engine.unwrap(model)
+    if isinstance(input_rows, pd.DataFrame):
+        input_rows = input_rows[EXPECTED_FEATURES]
+    X = np.asarray(input_rows, dtype=np.float64)
+    if model_key == 'xgboost':
+        import xgboost as xgb
+        booster = estimator.get_booster()
+        positions = _feature_positions(booster.feature_names)
+        matrix = xgb.DMatrix(X[:, positions].astype(np.float32), feature_names=booster.feature_names, missing=np.nan)
+        contributions = booster.predict(matrix, pred_contribs=True)[:, :-1].astype(np.float64)
+    elif model_key == 'logistic_regression':
+        positions = _feature_positions(getattr(estimator, 'feature_names_in_', None))
+        contributions = X[:, positions] * np.asarray(estimator.coef_, dtype=np.float64)[0]
+    else:
+        raise ValueError(f"模型 {model_key} 不支持逐患者特征贡献")
+    result = np.zeros((len(X), len(EXPECTED_FEATURES)), dtype=np.float64)
+    result[:, positions] = contributions
+    return result
+
+def patient_contribution_dicts(model_set: ModelSet, input_rows) -> list:
+    """按 CONTRIBUTION_MODELS 顺序使用第一个可用模型计算逐患者特征贡献，返回每行的 {特征: 贡献} (按绝对值降序)。"""
+    for model_key in CONTRIBUTION_MODELS:
+        model = model_set.get_model(model_key)
+        if model is None:
+            continue
+        try:
+            contributions = contribution_matrix(model_key, model, input_rows)
+        except Exception as e:
+            logger.error(f"计算 {model_key} 逐患者特征贡献时出错: {e}")
+            continue
+        order = np.argsort(-np.abs(contributions), axis=1, kind='stable')
+        return [
+            {EXPECTED_FEATURES[j]: float(row[j]) for j in row_order}
+            for row, row_order in zip(contributions, order)
+        ]
+    return None
+
+# 风险等级的平均概率阈值: (中风险下限, 高风险下限)
+RISK_LEVEL_THRESHOLDS = (0.3, 0.7)
+
 def get_risk_level(probabilities: list[float]) -> str:
     """根据预测概率列表的平均值确定风险等级 (更新逻辑)。"""
     if not probabilities: # 处理空列表或所有模型预测失败的情况
         return "未知"
     avg_prob = np.mean(probabilities)
-    if avg_prob >= 0.7:
+    if avg_prob >= RISK_LEVEL_THRESHOLDS[1]:
         return '高风险'
-    elif avg_prob >= 0.3:
+    elif avg_prob >= RISK_LEVEL_THRESHOLDS[0]:
         return '中风险'
     else:
         return '低风险'
@@ -553,7 +2055,8 @@ async def process_batch_file(file: UploadFile, model_key: str) -> tuple[str, Pat
     result_filename = f"batch_{batch_id}_results.xlsx"
     result_filepath = BATCH_RESULTS_DIR / result_filename
 
-    if model_key not in models or models[model_key] is None:
+    model_set = current_model_set()
+    if model_set.get_model(model_key) is None:
         raise ValueError(f"所选模型 '{MODEL_NAMES.get(model_key, model_key)}' 不可用")
 
     try:
@@ -571,7 +2074,7 @@ async def process_batch_file(file: UploadFile, model_key: str) -> tuple[str, Pat
         df_processed = prepare_batch_input(df_input.copy())
 
         # 2. 执行批量预测
-        probabilities, predictions = predict_batch(model_key, df_processed)
+        probabilities, predictions = await inference_executor.run(predict_batch, model_key, df_processed, model_set)
 
         # 3. 计算风险等级 (需要修改 get_risk_level 以处理列表)
         # risk_levels = get_risk_level(probabilities) # 旧方法
@@ -669,148 +2172,46 @@ def generate_template_file() -> BytesIO:
         raise RuntimeError(f"无法生成模板文件: {str(e)}")
 
 # --- PDF Report Generation (Migrated from HAPI) ---
-def generate_single_report(input_data: dict, prediction_result: dict, report_id: str) -> Path:
-    """根据输入和预测结果生成 PDF 报告，并保存到文件。"""
-    report_filename = f"report_{report_id}.pdf"
-    report_filepath = REPORTS_DIR / report_filename
-    doc = SimpleDocTemplate(str(report_filepath), pagesize=A4, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
-    
-    # 自定义样式
-    styles.add(ParagraphStyle(name='TitleStyle', fontName=DEFAULT_FONT, fontSize=22, alignment=1, spaceAfter=20, textColor=colors.Color(0, 0.38, 0.48)))
-    styles.add(ParagraphStyle(name='SubtitleStyle', fontName=DEFAULT_FONT, fontSize=12, alignment=1, textColor=colors.Color(0.3, 0.3, 0.3), spaceAfter=25))
-    styles.add(ParagraphStyle(name='Heading1Style', fontName=DEFAULT_FONT, fontSize=16, spaceAfter=12, spaceBefore=12, textColor=colors.Color(0, 0.38, 0.48)))
-    styles.add(ParagraphStyle(name='BodyStyle', fontName=DEFAULT_FONT, fontSize=10, leading=14))
-    styles.add(ParagraphStyle(name='TableKeyStyle', fontName=DEFAULT_FONT, fontSize=9, alignment=1))
-    styles.add(ParagraphStyle(name='TableValueStyle', fontName=DEFAULT_FONT, fontSize=9, alignment=1))
-    styles.add(ParagraphStyle(name='TableHeaderStyle', fontName=DEFAULT_FONT, fontSize=9, alignment=1, textColor=colors.white))
-    styles.add(ParagraphStyle(name='DisclaimerStyle', fontName=DEFAULT_FONT, fontSize=9, textColor=colors.Color(0.5, 0.5, 0.5), alignment=1, spaceBefore=10))
-
-    story = []
-
-    # 1. 标题
-    story.append(Paragraph("HAPI风险预测报告", styles['TitleStyle']))
-    story.append(Paragraph(f"报告生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['SubtitleStyle']))
-    story.append(Spacer(1, 20))
-
-    # 2. 输入信息
-    story.append(Paragraph("一、患者输入信息", styles['Heading1Style']))
-    input_table_data = [[
-        Paragraph("项目", styles['TableHeaderStyle']), 
-        Paragraph("数值", styles['TableHeaderStyle'])
-    ]]
-    for key, value in input_data.items():
-        input_table_data.append([
-            Paragraph(str(key), styles['TableKeyStyle']),
-            Paragraph(str(value), styles['TableValueStyle'])
-        ])
-    input_table = Table(input_table_data, colWidths=[200, 200])
-    input_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.Color(0, 0.38, 0.48)),  # 深海蓝
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),  # 修改为白色
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('FONTNAME', (0, 0), (-1, 0), DEFAULT_FONT),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.Color(0.89, 0.95, 0.99)),  # 淡蓝色背景
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.Color(0.8, 0.8, 0.8)),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.Color(0.89, 0.95, 0.99), colors.Color(0.95, 0.98, 1.0)]),
-        ('LINEBELOW', (0, 0), (-1, 0), 1, colors.Color(0, 0.69, 1.0)),  # 底线颜色
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-    ]))
-    story.append(input_table)
-    story.append(Spacer(1, 20))
-
-    # 3. 预测结果
-    story.append(Paragraph("二、预测结果", styles['Heading1Style']))
-    pred_table_data = [[
-        Paragraph("评估模型", styles['TableHeaderStyle']), 
-        Paragraph("预测概率 (发生风险)", styles['TableHeaderStyle']),
-        Paragraph("预测结果", styles['TableHeaderStyle'])
-    ]]
-    probabilities = prediction_result.get('probabilities', {})
-    predictions = prediction_result.get('predictions', {})
-    for model_key, prob in probabilities.items():
-        if prob is not None:
-             pred_table_data.append([
-                 Paragraph(MODEL_NAMES.get(model_key, model_key), styles['TableKeyStyle']),
-                 Paragraph(f"{prob:.4f} ({prob*100:.1f}%)", styles['TableValueStyle']),
-                 Paragraph("有风险" if predictions.get(model_key, 0) == 1 else "无风险", styles['TableValueStyle'])
-             ])
-    pred_table = Table(pred_table_data, colWidths=[150, 150, 100])
-    pred_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.Color(0, 0.38, 0.48)),  # 深海蓝
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),  # 修改为白色
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('FONTNAME', (0, 0), (-1, 0), DEFAULT_FONT),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.Color(0.89, 0.95, 0.99)),  # 淡蓝色背景
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.Color(0.8, 0.8, 0.8)),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.Color(0.89, 0.95, 0.99), colors.Color(0.95, 0.98, 1.0)]),
-        ('LINEBELOW', (0, 0), (-1, 0), 1, colors.Color(0, 0.69, 1.0)),  # 底线颜色
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-    ]))
-    story.append(pred_table)
-    story.append(Spacer(1, 20))
-    
-    # 风险等级显示 - 创建一个更加突出的风险等级显示
-    risk_level = prediction_result.get('risk_level', '未知')
-    risk_color = colors.Color(0.2, 0.7, 0.2)  # 默认绿色
-    if risk_level == '高风险':
-        risk_color = colors.Color(0.8, 0.2, 0.2)  # 红色
-    elif risk_level == '中风险':
-        risk_color = colors.Color(0.95, 0.6, 0.1)  # 橙色
-    
-    risk_table_data = [[Paragraph("综合风险等级", styles['TableHeaderStyle']), Paragraph(risk_level, styles['TableHeaderStyle'])]]
-    risk_table = Table(risk_table_data, colWidths=[200, 200])
-    risk_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, 0), colors.Color(0, 0.38, 0.48)),  # 深海蓝
-        ('TEXTCOLOR', (0, 0), (0, 0), colors.white),  # 修改为白色
-        ('BACKGROUND', (1, 0), (1, 0), risk_color),
-        ('TEXTCOLOR', (1, 0), (1, 0), colors.white),  # 修改为白色
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('FONTNAME', (0, 0), (-1, 0), DEFAULT_FONT),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.Color(0.8, 0.8, 0.8)),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ('TOPPADDING', (0, 0), (-1, -1), 12),
-        ('FONTSIZE', (1, 0), (1, 0), 12),  # 风险级别字体放大
-    ]))
-    story.append(risk_table)
-    story.append(Spacer(1, 20))
-    
-    # 4. 特征贡献度 (如果可用)
-    feature_contributions = prediction_result.get('feature_contributions', {})
-    if feature_contributions:
-        story.append(Paragraph("三、主要影响因素", styles['Heading1Style']))
-        contrib_table_data = [[
-            Paragraph("影响因素", styles['TableHeaderStyle']),
-            Paragraph("重要性得分", styles['TableHeaderStyle'])
-        ]]
-        # 只显示前 N 个最重要的特征
-        top_n = 10 
-        sorted_features = sorted(feature_contributions.items(), key=lambda x: abs(x[1]), reverse=True)[:top_n]
-        for feature, score in sorted_features:
-             # 尝试将模型内部特征名映射回用户可读的名称
-             readable_feature = feature
-             for user_name, model_name in FIELD_MAPPING.items():
-                 if model_name == feature:
-                     readable_feature = user_name
-                     break
-             contrib_table_data.append([
-                 Paragraph(readable_feature, styles['TableKeyStyle']),
-                 Paragraph(f"{score:.4f}", styles['TableValueStyle'])
-             ])
-        contrib_table = Table(contrib_table_data, colWidths=[200, 200])
-        contrib_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.Color(0, 0.38, 0.48)),  # 深海蓝
+# 报告模板版本，模板样式或静态内容变化时递增
+REPORT_TEMPLATE_VERSION = 3
+
+PRIMARY_COLOR = colors.Color(0, 0.38, 0.48)  # 深海蓝
+RISK_COLORS = {
+    '高风险': colors.Color(0.8, 0.2, 0.2),  # 红色
+    '中风险': colors.Color(0.95, 0.6, 0.1),  # 橙色
+}
+DEFAULT_RISK_COLOR = colors.Color(0.2, 0.7, 0.2)  # 默认绿色
+
+class ReportTemplate:
+    """预编译的单例报告模板。
+
+    样式表、表格样式和静态内容 (标题、章节标题、表头、免责声明) 只在创建时构建一次，
+    每份报告只需生成动态的表格内容、时间和报告 ID。静态 Flowable 在使用时浅拷贝，可在多线程中共享。
+    """
+
+    def __init__(self, font_name: str):
+        self.font_name = font_name
+        styles = getSampleStyleSheet()
+
+        # 自定义样式
+        styles.add(ParagraphStyle(name='TitleStyle', fontName=font_name, fontSize=22, alignment=1, spaceAfter=20, textColor=PRIMARY_COLOR))
+        styles.add(ParagraphStyle(name='SubtitleStyle', fontName=font_name, fontSize=12, alignment=1, textColor=colors.Color(0.3, 0.3, 0.3), spaceAfter=25))
+        styles.add(ParagraphStyle(name='Heading1Style', fontName=font_name, fontSize=16, spaceAfter=12, spaceBefore=12, textColor=PRIMARY_COLOR))
+        styles.add(ParagraphStyle(name='BodyStyle', fontName=font_name, fontSize=10, leading=14))
+        styles.add(ParagraphStyle(name='TableKeyStyle', fontName=font_name, fontSize=9, alignment=1))
+        styles.add(ParagraphStyle(name='TableValueStyle', fontName=font_name, fontSize=9, alignment=1))
+        styles.add(ParagraphStyle(name='TableHeaderStyle', fontName=font_name, fontSize=9, alignment=1, textColor=colors.white))
+        styles.add(ParagraphStyle(name='DisclaimerStyle', fontName=font_name, fontSize=9, textColor=colors.Color(0.5, 0.5, 0.5), alignment=1, spaceBefore=10))
+        styles.add(ParagraphStyle(name='PatientHeadingStyle', fontName=font_name, fontSize=12, spaceAfter=6, spaceBefore=6, textColor=PRIMARY_COLOR))
+        self.styles = styles
+
+        # 输入信息、预测结果、影响因素三张表共用的表格样式
+        self.data_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), PRIMARY_COLOR),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),  # 修改为白色
             ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('FONTNAME', (0, 0), (-1, 0), DEFAULT_FONT),
+            ('FONTNAME', (0, 0), (-1, 0), font_name),
             ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
             ('BACKGROUND', (0, 1), (-1, -1), colors.Color(0.89, 0.95, 0.99)),  # 淡蓝色背景
             ('GRID', (0, 0), (-1, -1), 0.5, colors.Color(0.8, 0.8, 0.8)),
@@ -818,46 +2219,888 @@ def generate_single_report(input_data: dict, prediction_result: dict, report_id:
             ('LINEBELOW', (0, 0), (-1, 0), 1, colors.Color(0, 0.69, 1.0)),  # 底线颜色
             ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
             ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ]))
-        story.append(contrib_table)
-        story.append(Spacer(1, 30))
-
-    # 页脚和免责声明
-    story.append(Paragraph(
-        "免责声明: 本预测结果仅供临床参考，不能替代专业医师的诊断和评估。请结合患者具体情况和临床经验进行决策。",
-        styles['DisclaimerStyle']
-    ))
-    
-    # 添加页脚
-    story.append(Spacer(1, 20))
-    story.append(Paragraph(
-        f'"未卜先治" HAPI风险预测系统生成 · www.hapi-predictor.com · 报告ID: {report_id[:8]}',
-        styles['DisclaimerStyle']
-    ))
+        ])
+        # 风险等级表样式 (按风险颜色预先生成)
+        self.risk_table_styles = {level: self._risk_table_style(color) for level, color in RISK_COLORS.items()}
+        self.default_risk_table_style = self._risk_table_style(DEFAULT_RISK_COLOR)
+
+        header = styles['TableHeaderStyle']
+        # 静态内容
+        self.title = Paragraph("HAPI风险预测报告", styles['TitleStyle'])
+        self.input_heading = Paragraph("一、患者输入信息", styles['Heading1Style'])
+        self.prediction_heading = Paragraph("二、预测结果", styles['Heading1Style'])
+        self.contribution_heading = Paragraph("三、主要影响因素", styles['Heading1Style'])
+        self.input_header_row = [Paragraph("项目", header), Paragraph("数值", header)]
+        self.prediction_header_row = [Paragraph("评估模型", header), Paragraph("预测概率 (发生风险)", header), Paragraph("预测结果", header)]
+        # 全局特征重要性 (非负) 与逐患者贡献值 (有正负，对数几率空间) 使用不同的列名
+        self.contribution_header_rows = {
+            'global': [Paragraph("影响因素", header), Paragraph("重要性得分", header)],
+            'patient': [Paragraph("影响因素", header), Paragraph("贡献值 (对数几率，正值增加风险)", header)],
+        }
+        self.risk_header_cell = Paragraph("综合风险等级", header)
+        self.batch_title = Paragraph("HAPI批量风险预测报告", styles['TitleStyle'])
+        self.batch_input_header_row = [Paragraph("项目", header), Paragraph("数值", header), Paragraph("项目", header), Paragraph("数值", header)]
+        self.batch_summary_heading = Paragraph("风险等级汇总", styles['Heading1Style'])
+        self.batch_summary_header_row = [Paragraph("风险等级", header), Paragraph("人数", header), Paragraph("占比", header)]
+        self.ensemble_name_cell = Paragraph("综合预测", styles['TableKeyStyle'])
+        self.risk_level_cells = {level: Paragraph(level, header) for level in ('高风险', '中风险', '低风险', '未知')}
+        self.disclaimer = Paragraph(
+            "免责声明: 本预测结果仅供临床参考，不能替代专业医师的诊断和评估。请结合患者具体情况和临床经验进行决策。",
+            styles['DisclaimerStyle']
+        )
+        self.model_name_cells = {key: Paragraph(name, styles['TableKeyStyle']) for key, name in MODEL_NAMES.items()}
+        self.prediction_label_cells = {
+            1: Paragraph("有风险", styles['TableValueStyle']),
+            0: Paragraph("无风险", styles['TableValueStyle']),
+        }
+        # 未计入综合风险等级的模型及原因
+        self.excluded_model_reasons = {
+            EnsembleScheduler.TIMEOUT: '超过截止时间',
+            EnsembleScheduler.BUSY: '推理繁忙',
+            EnsembleScheduler.DEPRIORITIZED: '已临时降级',
+        }
+        # 模型内部特征名 -> 用户可读名称
+        self.readable_feature_names = {model_name: user_name for user_name, model_name in reversed(list(FIELD_MAPPING.items()))}
+
+    def _risk_table_style(self, risk_color):
+        return TableStyle([
+            ('BACKGROUND', (0, 0), (0, 0), PRIMARY_COLOR),
+            ('TEXTCOLOR', (0, 0), (0, 0), colors.white),  # 修改为白色
+            ('BACKGROUND', (1, 0), (1, 0), risk_color),
+            ('TEXTCOLOR', (1, 0), (1, 0), colors.white),  # 修改为白色
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('FONTNAME', (0, 0), (-1, 0), self.font_name),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.Color(0.8, 0.8, 0.8)),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+            ('TOPPADDING', (0, 0), (-1, -1), 12),
+            ('FONTSIZE', (1, 0), (1, 0), 12),  # 风险级别字体放大
+        ])
+
+    def build_story(self, input_data: dict, prediction_result: dict, report_id: str, generated_at: datetime = None) -> list:
+        """生成一份报告的 Flowable 列表，只有动态部分在此构建。"""
+        styles = self.styles
+        key_style = styles['TableKeyStyle']
+        value_style = styles['TableValueStyle']
+        c = copy.copy
+        story = []
+
+        # 1. 标题
+        generated_at = generated_at or datetime.now()
+        story.append(c(self.title))
+        story.append(Paragraph(f"报告生成时间: {generated_at.strftime('%Y-%m-%d %H:%M:%S')}", styles['SubtitleStyle']))
+        story.append(Spacer(1, 20))
+
+        # 2. 输入信息
+        story.append(c(self.input_heading))
+        input_table_data = [[c(cell) for cell in self.input_header_row]]
+        for key, value in input_data.items():
+            input_table_data.append([
+                Paragraph(str(key), key_style),
+                Paragraph(str(value), value_style)
+            ])
+        input_table = Table(input_table_data, colWidths=[200, 200])
+        input_table.setStyle(self.data_table_style)
+        story.append(input_table)
+        story.append(Spacer(1, 20))
+
+        # 3. 预测结果
+        story.append(c(self.prediction_heading))
+        pred_table_data = [[c(cell) for cell in self.prediction_header_row]]
+        probabilities = prediction_result.get('probabilities', {})
+        predictions = prediction_result.get('predictions', {})
+        for model_key, prob in probabilities.items():
+            if prob is not None:
+                 model_cell = self.model_name_cells.get(model_key)
+                 pred_table_data.append([
+                     c(model_cell) if model_cell is not None else Paragraph(MODEL_NAMES.get(model_key, model_key), key_style),
+                     Paragraph(f"{prob:.4f} ({prob*100:.1f}%)", value_style),
+                     c(self.prediction_label_cells[1 if predictions.get(model_key, 0) == 1 else 0])
+                 ])
+        pred_table = Table(pred_table_data, colWidths=[150, 150, 100])
+        pred_table.setStyle(self.data_table_style)
+        story.append(pred_table)
+        excluded = [
+            f"{MODEL_NAMES.get(model_key, model_key)} ({self.excluded_model_reasons.get(reason, reason)})"
+            for model_key, reason in (prediction_result.get('models_dropped') or {}).items()
+        ] + [f"{MODEL_NAMES.get(model_key, model_key)} (推理出错)" for model_key in prediction_result.get('models_failed') or []]
+        if excluded:
+            story.append(Spacer(1, 8))
+            story.append(Paragraph(f"注意: 以下模型未计入本次综合风险等级: {'、'.join(excluded)}", styles['BodyStyle']))
+        story.append(Spacer(1, 20))
+
+        # 风险等级显示 - 创建一个更加突出的风险等级显示
+        risk_level = prediction_result.get('risk_level', '未知')
+        risk_cell = self.risk_level_cells.get(risk_level)
+        risk_table_data = [[c(self.risk_header_cell), c(risk_cell) if risk_cell is not None else Paragraph(risk_level, styles['TableHeaderStyle'])]]
+        risk_table = Table(risk_table_data, colWidths=[200, 200])
+        risk_table.setStyle(self.risk_table_styles.get(risk_level, self.default_risk_table_style))
+        story.append(risk_table)
+        story.append(Spacer(1, 20))
+
+        # 4. 特征贡献度 (如果可用)
+        feature_contributions = prediction_result.get('feature_contributions', {})
+        if feature_contributions:
+            story.append(c(self.contribution_heading))
+            contribution_type = prediction_result.get('feature_contribution_type', 'global')
+            header_row = self.contribution_header_rows.get(contribution_type, self.contribution_header_rows['global'])
+            contrib_table_data = [[c(cell) for cell in header_row]]
+            # 只显示前 N 个最重要的特征
+            top_n = 10
+            sorted_features = sorted(feature_contributions.items(), key=lambda x: abs(x[1]), reverse=True)[:top_n]
+            for feature, score in sorted_features:
+                 # 尝试将模型内部特征名映射回用户可读的名称
+                 readable_feature = self.readable_feature_names.get(feature, feature)
+                 contrib_table_data.append([
+                     Paragraph(readable_feature, key_style),
+                     Paragraph(f"{score:.4f}", value_style)
+                 ])
+            contrib_table = Table(contrib_table_data, colWidths=[200, 200])
+            contrib_table.setStyle(self.data_table_style)
+            story.append(contrib_table)
+            story.append(Spacer(1, 30))
+
+        # 页脚和免责声明
+        story.append(c(self.disclaimer))
+
+        # 添加页脚
+        story.append(Spacer(1, 20))
+        story.append(Paragraph(
+            f'"未卜先治" HAPI风险预测系统生成 · www.hapi-predictor.com · 报告ID: {report_id[:8]}',
+            styles['DisclaimerStyle']
+        ))
+        return story
+
+    # --- 批量报告 ---
+    def build_batch_header(self, batch_id: str, total_rows: int, generated_at: datetime = None) -> list:
+        """批量报告的标题部分。"""
+        generated_at = generated_at or datetime.now()
+        return [
+            copy.copy(self.batch_title),
+            Paragraph(f"批次ID: {batch_id} · 患者数: {total_rows} · 报告生成时间: {generated_at.strftime('%Y-%m-%d %H:%M:%S')}", self.styles['SubtitleStyle']),
+        ]
+
+    def build_patient_block(self, index: int, row: dict) -> KeepTogether:
+        """批量报告中单个患者的内容 (输入信息、各模型结果和综合风险等级)，整体不跨页。"""
+        styles = self.styles
+        key_style = styles['TableKeyStyle']
+        value_style = styles['TableValueStyle']
+        c = copy.copy
+
+        identity = [f"{index}."]
+        for field in ('患者ID', '患者姓名', '年龄'):
+            value = display_value(row.get(field))
+            if value != '-':
+                identity.append(f"{field}: {value}")
+        flowables = [Paragraph("  ".join(identity), styles['PatientHeadingStyle'])]
+
+        # 输入信息 (两组 项目/数值 并排)
+        cells = []
+        for field in NUMERIC_FIELDS + CATEGORICAL_FIELDS:
+            cells.append(Paragraph(field, key_style))
+            cells.append(Paragraph(display_value(row.get(field)), value_style))
+        input_table_data = [[c(cell) for cell in self.batch_input_header_row]]
+        for i in range(0, len(cells), 4):
+            line = cells[i:i + 4]
+            input_table_data.append(line + [''] * (4 - len(line)))
+        input_table = Table(input_table_data, colWidths=[110, 90, 110, 90])
+        input_table.setStyle(self.data_table_style)
+        flowables.append(input_table)
+        flowables.append(Spacer(1, 6))
+
+        # 各模型结果
+        pred_table_data = [[c(cell) for cell in self.prediction_header_row]]
+        for model_key, model_name in MODEL_NAMES.items():
+            prob = row.get(f"{model_name}_概率")
+            if prob is None or pd.isna(prob):
+                continue
+            pred = row.get(f"{model_name}_预测")
+            pred_table_data.append([
+                c(self.model_name_cells[model_key]),
+                Paragraph(f"{prob:.4f} ({prob*100:.1f}%)", value_style),
+                c(self.prediction_label_cells[1 if pred == 1 else 0])
+            ])
+        ensemble_prob = row.get("综合预测概率")
+        if ensemble_prob is not None and not pd.isna(ensemble_prob):
+            pred_table_data.append([
+                c(self.ensemble_name_cell),
+                Paragraph(f"{ensemble_prob:.4f} ({ensemble_prob*100:.1f}%)", value_style),
+                c(self.prediction_label_cells[1 if row.get("综合预测结果") == 1 else 0])
+            ])
+        pred_table = Table(pred_table_data, colWidths=[150, 150, 100])
+        pred_table.setStyle(self.data_table_style)
+        flowables.append(pred_table)
+        flowables.append(Spacer(1, 6))
+
+        risk_level = display_value(row.get("风险级别"), default='未知')
+        risk_cell = self.risk_level_cells.get(risk_level)
+        risk_table = Table([[c(self.risk_header_cell), c(risk_cell) if risk_cell is not None else Paragraph(risk_level, styles['TableHeaderStyle'])]], colWidths=[200, 200])
+        risk_table.setStyle(self.risk_table_styles.get(risk_level, self.default_risk_table_style))
+        flowables.append(risk_table)
+        flowables.append(Spacer(1, 16))
+        return KeepTogether(flowables)
+
+    def build_batch_summary(self, risk_counts: dict, total_rows: int) -> list:
+        """批量报告末尾的风险等级汇总和免责声明。"""
+        styles = self.styles
+        summary_data = [[copy.copy(cell) for cell in self.batch_summary_header_row]]
+        for level, count in risk_counts.items():
+            ratio = (count / total_rows * 100) if total_rows else 0.0
+            summary_data.append([
+                Paragraph(str(level), styles['TableKeyStyle']),
+                Paragraph(str(count), styles['TableValueStyle']),
+                Paragraph(f"{ratio:.1f}%", styles['TableValueStyle'])
+            ])
+        summary_table = Table(summary_data, colWidths=[150, 100, 100])
+        summary_table.setStyle(self.data_table_style)
+        return [copy.copy(self.batch_summary_heading), summary_table, Spacer(1, 30), copy.copy(self.disclaimer)]
+
+def display_value(value, default: str = '-') -> str:
+    """将表格中的单元格值转换为报告中显示的文本，空值显示为 default。"""
+    if value is None:
+        return default
+    if isinstance(value, float):
+        if np.isnan(value):
+            return default
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+_report_template = None
+_report_template_lock = threading.Lock()
+
+def get_report_template() -> ReportTemplate:
+    """返回按报告字体编译的报告模板 (首次调用时注册字体并构建，之后复用)。"""
+    global _report_template
+    if _report_template is None:
+        with _report_template_lock:
+            if _report_template is None:
+                _report_template = ReportTemplate(register_report_font())
+    return _report_template
+
+def build_report_pdf(target, input_data: dict, prediction_result: dict, report_id: str, template: ReportTemplate = None):
+    """将报告排版写入 target (文件路径或 BytesIO 等可写对象)。"""
+    template = template or get_report_template()
+    if isinstance(target, Path):
+        target = str(target)
+    doc = SimpleDocTemplate(target, pagesize=A4, topMargin=50, bottomMargin=50)
+    doc.build(template.build_story(input_data, prediction_result, report_id))
+
+def generate_single_report(input_data: dict, prediction_result: dict, report_id: str) -> Path:
+    """根据输入和预测结果生成 PDF 报告，并保存到文件。"""
+    report_filename = f"report_{report_id}.pdf"
+    report_filepath = REPORTS_DIR / report_filename
+    # 先写入临时文件再原子替换，避免并发下载读到未写完的 PDF
+    tmp_filepath = REPORTS_DIR / f".{report_filename}.{uuid.uuid4().hex}.tmp"
 
     try:
-        doc.build(story)
+        build_report_pdf(tmp_filepath, input_data, prediction_result, report_id)
+        os.replace(tmp_filepath, report_filepath)
         logger.info(f"成功生成 PDF 报告: {report_filepath}")
         return report_filepath
+    except Exception as e:
+        logger.error(f"构建 PDF 报告时出错: {e}", exc_info=True)
+        if tmp_filepath.exists():
+            tmp_filepath.unlink()
+        raise RuntimeError("生成 PDF 报告失败")
+
+def render_report_bytes(input_data: dict, prediction_result: dict, report_id: str) -> bytes:
+    """在内存中生成报告 PDF 并返回字节内容。"""
+    buffer = BytesIO()
+    try:
+        build_report_pdf(buffer, input_data, prediction_result, report_id)
     except Exception as e:
         logger.error(f"构建 PDF 报告时出错: {e}", exc_info=True)
         raise RuntimeError("生成 PDF 报告失败")
+    return buffer.getvalue()
+
+class _ChunkedStory(list):
+    """按需从生成器补充 Flowable 的列表。
+
+    BaseDocTemplate.build 会不断从列表头部取出 Flowable，列表取空时再从生成器取下一块，
+    因此任意时刻内存中只保留一块患者的 Flowable。
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+
+    def __len__(self):
+        while super().__len__() == 0:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self.extend(chunk)
+        return super().__len__()
+
+    def __bool__(self):
+        return len(self) > 0
+
+def iter_batch_result_rows(result_path: Path, chunk_size: int = REPORT_BATCH_CHUNK_ROWS):
+    """以只读流式方式逐块读取批量结果文件 (xlsx 或 csv)，每块为若干行 {列名: 值} 字典。"""
+    if not result_path.exists():
+        raise FileNotFoundError(f"找不到预测结果文件 {result_path.name}")
+    if result_path.suffix == '.csv':
+        with pd.read_csv(result_path, encoding='utf-8-sig', chunksize=chunk_size) as reader:
+            for chunk in reader:
+                yield chunk.astype(object).where(chunk.notna(), None).to_dict('records')
+        return
+    workbook = openpyxl.load_workbook(result_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        chunk = []
+        for values in rows:
+            chunk.append(dict(zip(header, values)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        workbook.close()
+
+def generate_batch_report(batch_id: str, result_path: Path, report_filepath: Path, total_rows: int,
+                          chunk_size: int = REPORT_BATCH_CHUNK_ROWS) -> Path:
+    """为一个批次生成包含所有患者的单个 PDF 报告，写入 report_filepath。
+
+    结果文件按块流式读取，每块患者的 Flowable 排版完成后即被释放，复用预编译的报告模板样式；
+    total_rows 为批次摘要中的总行数 (用于报告开头)。文件路径由批量任务模块 (batch_jobs) 确定。
+    """
+    tmp_filepath = report_filepath.with_name(f".{report_filepath.name}.{uuid.uuid4().hex}.tmp")
+    template = get_report_template()
+    risk_counts = {}
+
+    def story_chunks():
+        yield template.build_batch_header(batch_id, total_rows)
+        index = 0
+        for rows in iter_batch_result_rows(result_path, chunk_size):
+            blocks = []
+            for row in rows:
+                index += 1
+                risk_level = display_value(row.get("风险级别"), default='未知')
+                risk_counts[risk_level] = risk_counts.get(risk_level, 0) + 1
+                blocks.append(template.build_patient_block(index, row))
+            yield blocks
+        yield template.build_batch_summary(risk_counts, total_rows)
+
+    try:
+        doc = SimpleDocTemplate(str(tmp_filepath), pagesize=A4, topMargin=50, bottomMargin=50)
+        doc.build(_ChunkedStory(story_chunks()))
+        os.replace(tmp_filepath, report_filepath)
+        logger.info(f"成功生成批量 PDF 报告: {report_filepath} (共 {total_rows} 名患者)")
+        return report_filepath
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        logger.error(f"构建批量 PDF 报告时出错: {e}", exc_info=True)
+        raise RuntimeError("生成批量 PDF 报告失败")
+    finally:
+        if tmp_filepath.exists():
+            tmp_filepath.unlink()
+
+# 报告排版执行器: ReportLab 排版是纯 Python 且受 GIL 限制，默认放在独立进程池中，与推理互不阻塞
+report_executor = ManagedExecutor(
+    'report', mode='process' if REPORT_POOL_ENABLED else 'thread',
+    workers=REPORT_WORKERS, max_queue=REPORT_MAX_QUEUE
+)
+
+async def render_report(input_data: dict, prediction_result: dict, report_id: str, as_bytes: bool = False):
+    """通过报告执行器生成报告，返回文件路径 (as_bytes=True 时返回 PDF 字节)。
+
+    每个任务的排队时间和排版时间记录在日志和 report_executor 的指标中。
+    """
+    job = render_report_bytes if as_bytes else generate_single_report
+    result, (queue_wait, render_time) = await report_executor.run_timed(job, input_data, prediction_result, report_id)
+    logger.info(f"报告 {report_id} 排队 {queue_wait * 1000:.1f} ms, 排版 {render_time * 1000:.1f} ms ({report_executor.mode})")
+    return result
+
+# --- 按内容寻址的单例报告 ---
+def report_content_key(input_data: dict, prediction_result: dict, model_version: int) -> str:
+    """根据 (输入, 预测结果, 模型集版本, 报告模板版本) 计算报告的内容地址。"""
+    payload = json.dumps(
+        [input_data, prediction_result, model_version, REPORT_TEMPLATE_VERSION],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+class ReportStore:
+    """按内容地址保存单例报告 PDF 字节。
+
+    内存中是按总字节数限额的 LRU；某个内容被下载的次数达到 persist_after_hits 后，
+    再原子写入 directory/report_{content_key}.pdf，内存淘汰后仍可从磁盘读回。
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, persist_after_hits: int = 0):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.persist_after_hits = max(0, int(persist_after_hits))
+        self._entries = OrderedDict()  # content_key -> PDF 字节
+        self._access_counts = {}  # content_key -> 下载次数 (仅内存中的条目)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.persisted = 0
+
+    def path_for(self, content_key: str) -> Path:
+        return self.directory / f"report_{content_key}.pdf"
+
+    def get(self, content_key: str):
+        """依次查找内存和磁盘，未命中返回 None。磁盘读取是阻塞 IO，异步代码中应放到线程里调用。"""
+        with self._lock:
+            data = self._entries.get(content_key)
+            if data is not None:
+                self._entries.move_to_end(content_key)
+                self.memory_hits += 1
+                return data
+        path = self.path_for(content_key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        retention_janitor.touch(path)
+        self.put(content_key, data)
+        return data
+
+    def put(self, content_key: str, data: bytes):
+        """放入内存，超出字节限额时淘汰最久未使用的条目。"""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(content_key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[content_key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._access_counts.pop(evicted_key, None)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def record_access(self, content_key: str, data: bytes):
+        """记录一次下载，达到落盘阈值时写入磁盘。阻塞 IO，异步代码中应放到线程里调用。"""
+        if not self.persist_after_hits:
+            return
+        with self._lock:
+            count = self._access_counts.get(content_key, 0) + 1
+            self._access_counts[content_key] = count
+        # 只有恰好达到阈值的那次下载负责落盘，避免并发下载重复写入
+        if count != self.persist_after_hits:
+            return
+        path = self.path_for(content_key)
+        if path.exists():
+            return
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        with self._lock:
+            self.persisted += 1
+        logger.info(f"报告 {content_key} 已下载 {count} 次，保存到 {path}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._access_counts.clear()
+            self._bytes = 0
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "persist_after_hits": self.persist_after_hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "persisted": self.persisted,
+            }
 
-def predict_batch_with_all_models(df: pd.DataFrame) -> dict:
+report_store = ReportStore(REPORTS_DIR, REPORT_MEMORY_BUDGET_MB * 1024 * 1024, REPORT_PERSIST_AFTER_HITS)
+
+# 正在生成中的报告 (内容地址或批次 -> asyncio.Future)，相同内容的并发首次下载共享一次生成
+_report_renders = {}
+
+def _prediction_snapshot_path(report_id: str) -> Path:
+    """返回预测快照文件路径，report_id 必须是合法的 UUID (防止路径穿越)。"""
+    try:
+        normalized_id = str(uuid.UUID(report_id))
+    except (ValueError, TypeError, AttributeError):
+        raise FileNotFoundError(f"无效的报告 ID: {report_id}")
+    return PREDICTIONS_DIR / f"prediction_{normalized_id}.json"
+
+def save_prediction_snapshot(report_id: str, input_data: dict, prediction_result: dict) -> Path:
+    """保存生成报告所需的预测快照 (原始输入、预测结果和报告内容地址)，报告在首次下载时据此生成。"""
+    snapshot_path = _prediction_snapshot_path(report_id)
+    snapshot = {
+        "report_id": report_id,
+        "created_at": datetime.now().isoformat(),
+        "model_set_version": model_set_version,
+        "content_key": report_content_key(input_data, prediction_result, model_set_version),
+        "input_data": input_data,
+        "prediction_result": prediction_result,
+    }
+    tmp_path = snapshot_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, snapshot_path)
+    return snapshot_path
+
+def load_prediction_snapshot(report_id: str) -> dict:
+    """读取预测快照，不存在时抛出 FileNotFoundError。"""
+    snapshot_path = _prediction_snapshot_path(report_id)
+    if not snapshot_path.exists():
+        raise FileNotFoundError(f"找不到报告 {report_id} 的预测记录")
+    with open(snapshot_path, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    retention_janitor.touch(snapshot_path)
+    return snapshot
+
+def _load_legacy_report(report_id: str) -> bytes:
+    """读取按 report_id 命名的旧版报告文件。"""
+    report_filepath = REPORTS_DIR / f"report_{report_id}.pdf"
+    data = report_filepath.read_bytes()
+    retention_janitor.touch(report_filepath)
+    return data
+
+async def _render_report_content(content_key: str, snapshot: dict) -> bytes:
+    # 报告中的编号使用内容地址，保证相同内容的报告字节可以共享
+    data = await render_report(snapshot["input_data"], snapshot["prediction_result"], content_key, as_bytes=True)
+    report_store.put(content_key, data)
+    return data
+
+def _snapshot_content_key(snapshot: dict) -> str:
+    return snapshot.get("content_key") or report_content_key(
+        snapshot["input_data"], snapshot["prediction_result"], snapshot.get("model_set_version", model_set_version)
+    )
+
+def get_report_content_key(report_id: str) -> str:
+    """返回报告的内容地址 (用作 ETag)，不生成报告；旧版报告文件以 report_id 作为内容地址。
+
+    报告不存在时抛出 FileNotFoundError。阻塞 IO，异步代码中应放到线程里调用。
+    """
+    try:
+        return _snapshot_content_key(load_prediction_snapshot(report_id))
+    except FileNotFoundError:
+        _prediction_snapshot_path(report_id)  # 校验 report_id
+        if not (REPORTS_DIR / f"report_{report_id}.pdf").exists():
+            raise
+        return report_id
+
+async def get_report_bytes(report_id: str, record_access: bool = True):
+    """返回 (内容地址, PDF 字节)，报告不在内存和磁盘中时根据预测快照在内存中生成。
+
+    相同内容的报告只生成一次；快照不存在时回退到旧版 report_{report_id}.pdf，都不存在时抛出 FileNotFoundError。
+    record_access=False 时不计入下载次数 (后台预生成)。
+    """
+    try:
+        snapshot = await asyncio.to_thread(load_prediction_snapshot, report_id)
+    except FileNotFoundError:
+        _prediction_snapshot_path(report_id)  # 校验 report_id
+        return report_id, await asyncio.to_thread(_load_legacy_report, report_id)
+
+    content_key = _snapshot_content_key(snapshot)
+    data = await asyncio.to_thread(report_store.get, content_key)
+    if data is None:
+        render = _report_renders.get(content_key)
+        if render is None:
+            render = asyncio.ensure_future(_render_report_content(content_key, snapshot))
+            _report_renders[content_key] = render
+            render.add_done_callback(lambda _: _report_renders.pop(content_key, None))
+            logger.info(f"开始按需生成报告: {report_id} (内容 {content_key})")
+        # shield: 某个下载请求被取消时不影响其他等待同一报告的请求
+        data = await asyncio.shield(render)
+    if record_access:
+        await asyncio.to_thread(report_store.record_access, content_key, data)
+    return content_key, data
+
+def iter_bytes_chunks(data: bytes, chunk_size: int = 64 * 1024):
+    """按块切分内存中的字节，用于流式下载。"""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start:start + chunk_size])
+
+def iter_file_chunks(filepath: Path, chunk_size: int = 64 * 1024):
+    """按块读取文件，用于流式下载。"""
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+# --- 产物保留与清理 ---
+class ArtifactRetention:
+    """单个产物目录的保留策略: 超过最长保留时间或超出字节预算时，优先删除最久未下载的文件。
+
+    最近下载时间保存在文件自身的 atime 中 (下载时用 os.utime 显式设置，与挂载选项无关)，
+    多个 worker 进程共享同一份记录；mtime 更晚时以 mtime 为准。以 "." 开头的文件 (临时文件) 不参与清理。
+    group_key(文件名) 把属于同一对象的文件归为一组 (例如同一批次的结果、摘要和报告)，整组按最近访问时间一起删除。
+    in_use(目录, 组内文件名列表) 返回 True 的组仍在使用 (例如未结束的批量任务)，不会因超出容量预算被删除；
+    超过最长保留时间仍会删除 (仍在运行的任务会持续刷新自己的文件)。
+    """
+
+    LEGACY_INDEX_FILENAME = '.access_index.json'
+
+    def __init__(self, name: str, directory: Path, max_bytes: int, max_age_seconds: float, suffixes: tuple,
+                 group_key=None, in_use=None):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_age = max(0.0, float(max_age_seconds))
+        self.suffixes = suffixes
+        self.group_key = group_key or (lambda filename: filename)
+        self.in_use = in_use
+        self._lock = threading.Lock()  # 只保护统计数据，清理的文件 IO 不在锁内进行
+        self.sweeps = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.evictions_by_reason = {"age": 0, "budget": 0}
+        self.skipped_in_use = 0
+        self.total_files = 0
+        self.total_bytes = 0
+        self.last_sweep_at = None
+        self.last_sweep_ms = 0.0
+
+    def touch(self, filepath: Path):
+        """记录一次下载: 把文件的 atime 设为当前时间 (mtime 不变)。只有一次 stat 和 utime，但仍是文件 IO，
+        异步代码中应放到线程里调用。"""
+        try:
+            stat = os.stat(filepath)
+            os.utime(filepath, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError as e:
+            logger.warning(f"[{self.name}] 记录 {Path(filepath).name} 的访问时间失败: {e}")
+
+    def _scan(self) -> dict:
+        """扫描目录，返回 {组: [最近访问时间, 总字节数, [文件名...]]}。"""
+        groups = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.endswith(self.suffixes):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                group = groups.setdefault(self.group_key(entry.name), [0.0, 0, []])
+                group[0] = max(group[0], stat.st_atime, stat.st_mtime)
+                group[1] += stat.st_size
+                group[2].append(entry.name)
+        return groups
+
+    def sweep(self) -> list:
+        """执行一次清理，返回被删除的文件名列表。阻塞 IO，异步代码中应放到线程里调用。"""
+        started = time.perf_counter()
+        now = time.time()
+        legacy_index = self.directory / self.LEGACY_INDEX_FILENAME
+        if legacy_index.exists():
+            # 旧版本的进程内访问索引已不再使用
+            legacy_index.unlink(missing_ok=True)
+        # 最久未访问的组在前
+        groups = sorted(self._scan().items(), key=lambda item: item[1][0])
+
+        total_bytes = sum(size for _, (_, size, _) in groups)
+        total_files = sum(len(names) for _, (_, _, names) in groups)
+        evicted = []
+        evictions = {"age": 0, "budget": 0}
+        evicted_bytes = 0
+        skipped = 0
+        for key, (last_access, size, filenames) in groups:
+            reason = None
+            if self.max_age and now - last_access > self.max_age:
+                reason = "age"
+            elif self.max_bytes and total_bytes > self.max_bytes:
+                reason = "budget"
+            if reason is None:
+                continue
+            if reason == "budget" and self.in_use is not None and self.in_use(self.directory, filenames):
+                skipped += 1
+                continue
+            removed = []
+            for filename in filenames:
+                try:
+                    (self.directory / filename).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"[{self.name}] 删除 {filename} 失败: {e}")
+                    continue
+                removed.append(filename)
+            if not removed:
+                continue
+            # 部分文件删除失败时按比例估计释放的字节数，下次清理会重新统计
+            freed = size * len(removed) // len(filenames)
+            total_bytes -= freed
+            total_files -= len(removed)
+            evicted_bytes += freed
+            evictions[reason] += 1
+            evicted.extend(removed)
+            idle_hours = (now - last_access) / 3600
+            logger.info(f"[{self.name}] 清理 {key} ({len(removed)} 个文件): {size} 字节, {idle_hours:.1f} 小时未访问, 原因: {'超过保留期限' if reason == 'age' else '超出容量预算'}")
+
+        with self._lock:
+            self.sweeps += 1
+            self.evicted_files += len(evicted)
+            self.evicted_bytes += evicted_bytes
+            for reason, count in evictions.items():
+                self.evictions_by_reason[reason] += count
+            self.skipped_in_use = skipped
+            self.total_files = total_files
+            self.total_bytes = total_bytes
+            self.last_sweep_at = datetime.now().isoformat()
+            self.last_sweep_ms = (time.perf_counter() - started) * 1000
+        return evicted
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {
+                "directory": str(self.directory),
+                "max_bytes": self.max_bytes,
+                "max_age_seconds": self.max_age,
+                "files": self.total_files,
+                "bytes": self.total_bytes,
+                "sweeps": self.sweeps,
+                "evicted_files": self.evicted_files,
+                "evicted_bytes": self.evicted_bytes,
+                "evictions_by_reason": dict(self.evictions_by_reason),
+                "skipped_in_use": self.skipped_in_use,
+                "last_sweep_at": self.last_sweep_at,
+                "last_sweep_ms": self.last_sweep_ms,
+            }
+
+class RetentionJanitor:
+    """在后台定期对各产物目录执行保留策略。"""
+
+    def __init__(self, policies: list, interval_seconds: float = RETENTION_INTERVAL_SECONDS, enabled: bool = RETENTION_ENABLED):
+        self.policies = {policy.name: policy for policy in policies}
+        self.interval = max(1.0, float(interval_seconds))
+        self.enabled = enabled
+        self._task = None
+
+    def touch(self, filepath: Path):
+        """记录某个产物文件被下载，用于按最近下载时间淘汰。"""
+        directory = Path(filepath).parent
+        for policy in self.policies.values():
+            if policy.directory == directory:
+                policy.touch(filepath)
+                return
+
+    def sweep_all(self) -> dict:
+        """对所有目录执行一次清理，返回 {目录名: 被删除的文件名列表}。"""
+        evicted = {}
+        for name, policy in self.policies.items():
+            try:
+                evicted[name] = policy.sweep()
+            except Exception as e:
+                logger.error(f"[{name}] 产物清理失败: {e}", exc_info=True)
+                evicted[name] = []
+        return evicted
+
+    async def _run(self):
+        while True:
+            await asyncio.to_thread(self.sweep_all)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """在当前事件循环中启动后台清理任务 (应用启动时调用)。"""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"产物清理任务已启动，间隔 {self.interval:.0f} 秒")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def get_metrics(self) -> dict:
+        return {"enabled": self.enabled, "interval_seconds": self.interval,
+                **{name: policy.get_metrics() for name, policy in self.policies.items()}}
+
+def batch_artifact_group(filename: str) -> str:
+    """批次产物 (batch_<id>_results/manifest/job/report/upload) 按批次 ID 归为一组。"""
+    match = re.match(r'batch_(.+)_(?:results|manifest|job|report|upload)\.', filename)
+    return match.group(1) if match else filename
+
+def batch_group_in_use(directory: Path, filenames: list) -> bool:
+    """批次组是否属于未结束的任务。
+
+    有状态文件 (batch_<id>_job.json) 时以其中的状态为准，未结束但心跳超过 BATCH_JOB_STALE_SECONDS 的任务
+    (进程已退出) 不再保护；没有状态文件时 (同步批量接口，或后台任务仍在写入上传文件)，上传文件存在即视为在使用，
+    两种处理方式结束时都会删除上传文件。
+    """
+    status_name = next((name for name in filenames if name.endswith('_job.json')), None)
+    if status_name is not None:
+        try:
+            with open(directory / status_name, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+                modified_at = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            state = None
+        except (OSError, ValueError):
+            return True
+        if state is not None:
+            if state.get("status") in BATCH_JOB_FINISHED_STATUSES:
+                return False
+            heartbeat_at = state.get("heartbeat_at") or modified_at
+            return time.time() - heartbeat_at <= BATCH_JOB_STALE_SECONDS
+    return any(re.match(r'batch_.+_upload\.', name) for name in filenames)
+
+retention_janitor = RetentionJanitor([
+    ArtifactRetention('reports', REPORTS_DIR, REPORTS_MAX_MB * 1024 * 1024, REPORTS_MAX_AGE_DAYS * 86400, ('.pdf',)),
+    ArtifactRetention('batch_results', BATCH_RESULTS_DIR, BATCH_RESULTS_MAX_MB * 1024 * 1024, BATCH_RESULTS_MAX_AGE_DAYS * 86400,
+                      ('.xlsx', '.xls', '.csv', '.pdf', '.json'), group_key=batch_artifact_group, in_use=batch_group_in_use),
+    ArtifactRetention('predictions', PREDICTIONS_DIR, PREDICTIONS_MAX_MB * 1024 * 1024, PREDICTIONS_MAX_AGE_DAYS * 86400, ('.json',)),
+])
+
+async def prerender_report(report_id: str):
+    """后台预先生成报告 (REPORT_PRERENDER 开启时使用)，失败只记录日志。"""
+    try:
+        await get_report_bytes(report_id, record_access=False)
+    except Exception as e:
+        logger.error(f"后台预生成报告 {report_id} 失败: {e}")
+
+def predict_batch_with_all_models(df: pd.DataFrame, model_set: ModelSet = None) -> dict:
     """使用所有可用模型对数据进行预测，返回综合结果。
     
     类似于单例预测，但针对批量数据。使用所有可用模型并返回整合结果。
     
     Args:
         df: 预处理后的输入数据帧
+        model_set: 任务开始时取得的模型集快照，省略时使用当前模型集
         
     Returns:
         包含各模型预测结果及综合结果的字典
     """
     logger.info(f"对 {len(df)} 行数据进行多模型批量预测")
+    model_set = model_set or current_model_set()
     
     # 检查是否有可用模型
-    available_models = {key: model for key, model in models.items() if model is not None}
+    available_models = {key: model for key, model in model_set.models.items() if model is not None}
     if not available_models:
         logger.error("没有可用模型，无法执行预测")
         raise RuntimeError("系统中没有可用的预测模型")
@@ -871,8 +3114,9 @@ def predict_batch_with_all_models(df: pd.DataFrame) -> dict:
         try:
             logger.info(f"使用 {model_key} 模型进行预测")
             # 进行预测
-            y_proba = model.predict_proba(df)[:, 1]  # 获取正类概率
-            y_pred = (y_proba >= 0.5).astype(int)    # 将概率转换为二分类结果
+            proba = model.predict_proba(df)
+            y_proba = proba[:, 1]  # 获取正类概率
+            y_pred = classes_from_proba(model_key, model, proba, model_set.thresholds).astype(int)  # 按模型阈值转换为二分类结果
             
             # 存储结果
             all_predictions[model_key] = y_pred.tolist()
@@ -908,105 +3152,21 @@ def predict_batch_with_all_models(df: pd.DataFrame) -> dict:
             ensemble_predictions.append(None)
             risk_levels.append("无法确定")
     
+    # 逐患者特征贡献: 每个支持的模型一次向量化计算整批
+    contributions = {}
+    if FEATURE_CONTRIBUTIONS == 'patient':
+        for model_key in CONTRIBUTION_MODELS:
+            if model_key in available_models:
+                try:
+                    contributions[model_key] = contribution_matrix(model_key, available_models[model_key], df)
+                except Exception as e:
+                    logger.error(f"计算 {model_key} 逐患者特征贡献时出错: {e}", exc_info=True)
+
     return {
         "model_predictions": all_predictions,
         "model_probabilities": all_probabilities,
         "ensemble_probabilities": ensemble_probas,
         "ensemble_predictions": ensemble_predictions,
-        "risk_levels": risk_levels
+        "risk_levels": risk_levels,
+        "feature_contributions": contributions,
     }
-
-async def process_batch_file_with_all_models(file: UploadFile) -> tuple[str, Path]:
-    """使用所有可用模型处理批量预测文件，生成综合结果。"""
-    # 随机生成批处理任务ID
-    batch_id = str(uuid.uuid4())
-    logger.info(f"开始批量预测任务 {batch_id}")
-    
-    # 确保批量结果目录存在
-    os.makedirs(BATCH_RESULTS_DIR, exist_ok=True)
-    
-    # 输出文件路径
-    result_filename = f"batch_{batch_id}_results.xlsx"
-    result_filepath = BATCH_RESULTS_DIR / result_filename
-    
-    try:
-        # 读取上传的文件
-        ext = os.path.splitext(file.filename)[1].lower()
-        content = await file.read()
-        
-        if ext == '.csv':
-            try:
-                input_df = pd.read_csv(BytesIO(content), encoding='utf-8')
-            except UnicodeDecodeError:
-                input_df = pd.read_csv(BytesIO(content), encoding='gbk')
-        elif ext in ['.xlsx', '.xls']:
-            input_df = pd.read_excel(BytesIO(content))
-        else:
-            raise ValueError(f"不支持的文件类型: {ext}")
-        
-        if input_df.empty:
-            raise ValueError("上传的文件为空或无法读取。")
-        
-        logger.info(f"成功读取文件，包含 {len(input_df)} 行数据")
-        
-        # 保留患者标识信息（如果存在）
-        patient_info_fields = ["患者ID", "患者姓名", "序号", "年龄"]
-        patient_info = {}
-        for field in patient_info_fields:
-            if field in input_df.columns:
-                patient_info[field] = input_df[field].copy()
-                logger.info(f"保留患者标识字段: {field}")
-        
-        # 检查是否有实际标签列（用于评估）
-        has_actual_labels = False
-        actual_labels = None
-        if "actual_label" in input_df.columns:
-            has_actual_labels = True
-            actual_labels = input_df["actual_label"].copy()
-            input_df = input_df.drop(columns=["actual_label"])
-            logger.info("检测到actual_label列，将进行模型评估")
-        
-        # 数据预处理（仅处理预测相关字段）
-        processed_df = prepare_batch_input(input_df)
-        
-        # 使用所有模型进行预测
-        prediction_results = predict_batch_with_all_models(processed_df)
-        
-        # 创建输出数据框
-        result_df = pd.DataFrame()
-        
-        # 首先添加患者标识字段（如果存在）
-        for field in patient_info_fields:
-            if field in patient_info:
-                result_df[field] = patient_info[field]
-        
-        # 添加原始输入数据的其他字段（排除患者标识字段和actual_label）
-        for col in input_df.columns:
-            if col not in patient_info_fields and col != "actual_label":
-                result_df[col] = input_df[col]
-        
-        # 添加各模型的预测结果
-        for model_key in prediction_results["model_predictions"]:
-            if model_key in MODEL_NAMES:
-                model_name = MODEL_NAMES[model_key]
-                result_df[f"{model_name}_概率"] = prediction_results["model_probabilities"][model_key]
-                result_df[f"{model_name}_预测"] = prediction_results["model_predictions"][model_key]
-        
-        # 添加综合结果
-        result_df["综合预测概率"] = prediction_results["ensemble_probabilities"]
-        result_df["综合预测结果"] = prediction_results["ensemble_predictions"]
-        result_df["风险级别"] = prediction_results["risk_levels"]
-        
-        # 如果有真实标签，添加到结果中
-        if has_actual_labels and actual_labels is not None:
-            result_df["真实标签"] = actual_labels
-        
-        # 保存结果
-        result_df.to_excel(result_filepath, index=False, engine='openpyxl')
-        logger.info(f"批量预测结果已保存到 {result_filepath}")
-        
-        return batch_id, result_filepath
-    
-    except Exception as e:
-        logger.error(f"处理批量文件时出错: {e}", exc_info=True)
-        raise RuntimeError(f"批量预测处理失败: {str(e)}")
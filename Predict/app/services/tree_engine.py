@@ -0,0 +1,242 @@
+"""
+树集成模型的快速推理引擎
+
+- FlatForest: 把已训练的 sklearn 随机森林展开为连续的节点数组 (特征、阈值、左右子节点、叶节点概率)，
+  一批输入对所有树同时逐层遍历，每层只执行几次 NumPy 运算，省去 sklearn predict_proba
+  每次调用的输入校验、joblib 调度和逐棵树的 Python 循环，适合本服务 1~100 行的小批量推理。
+- XGBoostInplace: 直接调用 XGBoost 原生 booster 的 inplace_predict，输入为连续的 float32 数组，
+  不经过 sklearn 包装器的 DataFrame 转换、特征名检查和 DMatrix 构建，线程数按批量大小逐次选择。
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("tree_engine")
+
+# 与 sklearn 概率的最大允许误差 (求和顺序不同带来的浮点误差)
+PARITY_TOLERANCE = 1e-9
+# XGBoost 输出 float32 概率
+XGB_PARITY_TOLERANCE = 1e-6
+
+
+class FlatForest:
+    """随机森林的扁平化推理引擎，对外提供与原模型相同的 predict_proba / predict 接口。
+
+    超过 max_rows 行的批量或包含缺失值的输入交给 sklearn 处理 (大批量时 sklearn 逐棵树的 C 循环更快)；
+    其余属性 (feature_importances_、estimators_ 等) 转发给原 sklearn 模型。
+    """
+
+    def __init__(self, model, max_rows: int = 256):
+        self.estimator = model
+        self.max_rows = max_rows
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        self.n_trees = len(trees)
+        self.depth = max(tree.max_depth for tree in trees)
+        self.roots = np.cumsum([0] + [tree.node_count for tree in trees[:-1]]).astype(np.intp)
+
+        features, thresholds, children, values = [], [], [], []
+        for tree, offset in zip(trees, self.roots):
+            nodes = tree.__getstate__()["nodes"]
+            is_leaf = nodes["left_child"] == -1
+            own = np.arange(tree.node_count, dtype=np.intp) + offset
+            features.append(np.where(is_leaf, 0, nodes["feature"]))
+            thresholds.append(np.where(is_leaf, np.inf, nodes["threshold"]))
+            # 每个节点两个子节点相邻存放 (左, 右)，叶节点指向自身
+            children.append(np.stack([np.where(is_leaf, own, nodes["left_child"] + offset),
+                                      np.where(is_leaf, own, nodes["right_child"] + offset)], axis=1))
+            # 单输出分类树: value 形状为 (节点数, 1, 类别数)，归一化后即该叶节点的类别概率
+            value = tree.value[:, 0, :].astype(np.float64)
+            normalizer = value.sum(axis=1, keepdims=True)
+            normalizer[normalizer == 0.0] = 1.0
+            values.append(value / normalizer)
+
+        self.feature = np.ascontiguousarray(np.concatenate(features), dtype=np.intp)
+        self.threshold = np.ascontiguousarray(np.concatenate(thresholds), dtype=np.float64)
+        self.children = np.ascontiguousarray(np.concatenate(children).ravel(), dtype=np.intp)
+        self.is_leaf = self.children[0::2] == np.arange(len(self.feature))
+        self.value = np.ascontiguousarray(np.concatenate(values))
+
+    def __getattr__(self, name):
+        # 只有在本对象上找不到的属性才会进入这里
+        if name == 'estimator':
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
+
+    def __getstate__(self):
+        # 进程池序列化时只传原模型，到达后重新展开
+        return {"estimator": self.estimator, "max_rows": self.max_rows}
+
+    def __setstate__(self, state):
+        self.__init__(state["estimator"], state["max_rows"])
+
+    def _as_array(self, X) -> np.ndarray:
+        names = getattr(self.estimator, 'feature_names_in_', None)
+        if hasattr(X, 'columns') and names is not None and list(X.columns) != list(names):
+            X = X[list(names)]
+        # sklearn 树以 float32 比较特征值
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.estimator.n_features_in_:
+            raise ValueError(f"输入特征数应为 {self.estimator.n_features_in_}，实际为 {X.shape[-1]}")
+        return X
+
+    def apply(self, X) -> np.ndarray:
+        """返回每行在每棵树中到达的叶节点 (全局节点下标)，形状为 (行数, 树数)。
+
+        所有 (行, 树) 组合同时逐层下降，每层之后剔除已到达叶节点的组合，计算量与实际路径长度成正比。
+        """
+        X = self._as_array(X)
+        n_rows, n_features = X.shape
+        flat_X = X.ravel()
+        leaves = np.empty(n_rows * self.n_trees, dtype=np.intp)
+        node = np.tile(self.roots, n_rows)
+        row_base = np.repeat(np.arange(n_rows, dtype=np.intp) * n_features, self.n_trees)
+        position = np.arange(n_rows * self.n_trees)
+        while node.size:
+            go_right = flat_X[row_base + self.feature[node]] > self.threshold[node]
+            node = self.children[2 * node + go_right]
+            done = self.is_leaf[node]
+            leaves[position[done]] = node[done]
+            active = ~done
+            node, row_base, position = node[active], row_base[active], position[active]
+        return leaves.reshape(n_rows, self.n_trees)
+
+    def predict_proba(self, X) -> np.ndarray:
+        if len(X) > self.max_rows:
+            return self.estimator.predict_proba(X)
+        array = self._as_array(X)
+        if np.isnan(array).any():
+            # 缺失值的走向 (或报错) 与 sklearn 保持一致
+            return self.estimator.predict_proba(X)
+        return self.value[self.apply(array)].sum(axis=1) / self.n_trees
+
+    def predict(self, X) -> np.ndarray:
+        return self.estimator.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def unwrap(model):
+    """返回快速推理引擎包装的原模型，其他模型原样返回 (注意 sklearn 集成模型自身也有 estimator 参数)。"""
+    return model.estimator if isinstance(model, (FlatForest, XGBoostInplace)) else model
+
+
+def sample_rows(forest: FlatForest, n_rows: int = 256, seed: int = 0) -> np.ndarray:
+    """在各特征的分裂阈值附近生成校验样本，使大部分分支都被覆盖。"""
+    rng = np.random.default_rng(seed)
+    n_features = forest.estimator.n_features_in_
+    internal = ~forest.is_leaf
+    X = np.zeros((n_rows, n_features), dtype=np.float64)
+    for j in range(n_features):
+        splits = forest.threshold[internal & (forest.feature == j)]
+        if len(splits) == 0:
+            continue
+        low, high = splits.min() - 1.0, splits.max() + 1.0
+        X[:, j] = rng.uniform(low, high, size=n_rows)
+    return X
+
+
+def build_flat_forest(model, max_rows: int = 256, verify_rows: int = 256):
+    """把随机森林展开为 FlatForest，并用校验样本比较与 sklearn 的概率；不一致或不支持时返回 None。"""
+    if type(model).__name__ != 'RandomForestClassifier' or getattr(model, 'n_outputs_', 1) != 1:
+        return None
+    forest = FlatForest(model, max_rows=max_rows)
+    if verify_rows:
+        X = sample_rows(forest, verify_rows)
+        proba = forest.value[forest.apply(X)].sum(axis=1) / forest.n_trees
+        # 以训练时的特征名调用 sklearn，避免特征名警告
+        names = getattr(model, 'feature_names_in_', None)
+        reference = model.predict_proba(X if names is None else pd.DataFrame(X, columns=names))
+        diff = float(np.max(np.abs(proba - reference)))
+        if diff > PARITY_TOLERANCE:
+            logger.error(f"向量化树引擎与 sklearn 的概率最大误差 {diff:.3g} 超过容差，继续使用 sklearn")
+            return None
+        logger.info(f"向量化树引擎已启用: {forest.n_trees} 棵树, {len(forest.feature)} 个节点, 最大深度 {forest.depth}, 校验误差 {diff:.3g}")
+    return forest
+
+
+class XGBoostInplace:
+    """XGBoost 二分类模型的 inplace_predict 推理，对外提供与 XGBClassifier 相同的 predict_proba / predict 接口。
+
+    每次调用按行数选择线程数 (每 rows_per_thread 行一个线程，取不超过 max_threads 的 2 的幂)，
+    每种线程数使用一个单独的 booster 副本，避免并发请求之间修改同一个 booster 的 nthread 参数。
+    其余属性转发给原模型。
+    """
+
+    def __init__(self, model, rows_per_thread: int = 4096, max_threads: int = 0):
+        self.estimator = model
+        self.rows_per_thread = max(1, rows_per_thread)
+        self.max_threads = max_threads or os.cpu_count() or 1
+        booster = model.get_booster()
+        self.feature_names = booster.feature_names
+        best_iteration = booster.attr('best_iteration')
+        # 与包装器一致: 训练时启用了早停则只使用最佳轮次之前的树
+        self.iteration_range = (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+        self.missing = np.nan if model.missing is None else model.missing
+        self._source_booster = booster
+        self._boosters = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == 'estimator':
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
+
+    def __getstate__(self):
+        return {"estimator": self.estimator, "rows_per_thread": self.rows_per_thread, "max_threads": self.max_threads}
+
+    def __setstate__(self, state):
+        self.__init__(state["estimator"], state["rows_per_thread"], state["max_threads"])
+
+    def threads_for(self, n_rows: int) -> int:
+        wanted = min(self.max_threads, -(-n_rows // self.rows_per_thread))
+        threads = 1
+        while threads * 2 <= wanted:
+            threads *= 2
+        return threads
+
+    def _booster(self, threads: int):
+        booster = self._boosters.get(threads)
+        if booster is None:
+            with self._lock:
+                booster = self._boosters.get(threads)
+                if booster is None:
+                    booster = self._source_booster.copy()
+                    booster.set_param({'nthread': threads})
+                    self._boosters[threads] = booster
+        return booster
+
+    def _as_array(self, X) -> np.ndarray:
+        if hasattr(X, 'columns'):
+            if self.feature_names is not None and list(X.columns) != list(self.feature_names):
+                X = X[list(self.feature_names)]
+            X = X.to_numpy(dtype=np.float32)
+        return np.ascontiguousarray(X, dtype=np.float32)
+
+    def predict_proba(self, X) -> np.ndarray:
+        X = self._as_array(X)
+        if X.ndim != 2 or X.shape[1] != self.estimator.n_features_in_:
+            raise ValueError(f"输入特征数应为 {self.estimator.n_features_in_}，实际为 {X.shape[-1]}")
+        booster = self._booster(self.threads_for(len(X)))
+        positive = booster.inplace_predict(X, iteration_range=self.iteration_range, missing=self.missing,
+                                           validate_features=False)
+        return np.vstack((1.0 - positive, positive)).transpose()
+
+    def predict(self, X) -> np.ndarray:
+        return self.estimator.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def build_xgboost_inplace(model, rows_per_thread: int = 4096, max_threads: int = 0, verify_rows: int = 256):
+    """把 XGBoost 二分类模型包装为 XGBoostInplace，并与包装器的 predict_proba 比较；不支持或不一致时返回 None。"""
+    if type(model).__name__ != 'XGBClassifier' or model.objective != 'binary:logistic' or model.n_classes_ != 2:
+        return None
+    engine = XGBoostInplace(model, rows_per_thread=rows_per_thread, max_threads=max_threads)
+    if verify_rows:
+        rng = np.random.default_rng(0)
+        X = rng.uniform(0.0, 100.0, size=(verify_rows, model.n_features_in_)).astype(np.float32)
+        diff = float(np.max(np.abs(engine.predict_proba(X) - model.predict_proba(X))))
+        if diff > XGB_PARITY_TOLERANCE:
+            logger.error(f"XGBoost inplace_predict 与包装器的概率最大误差 {diff:.3g} 超过容差，继续使用包装器")
+            return None
+        logger.info(f"XGBoost inplace_predict 推理已启用: 每 {engine.rows_per_thread} 行一个线程, 最多 {engine.max_threads} 线程, 校验误差 {diff:.3g}")
+    return engine
@@ -0,0 +1,712 @@
+"""HAPI 预测服务性能基准脚本。
+
+用法 (在仓库根目录执行):
+    python benchmark_predictor.py encoder
+    python benchmark_predictor.py parity
+    python benchmark_predictor.py coalesce
+    python benchmark_predictor.py cache
+    python benchmark_predictor.py executor --mode process
+    python benchmark_predictor.py report
+    python benchmark_predictor.py report-pool --mode process
+    python benchmark_predictor.py load --workers 4 --lazy naive_bayes
+    python benchmark_predictor.py native-load --repeat 5
+    python benchmark_predictor.py fork-memory --workers 4
+    python benchmark_predictor.py rf-engine --batch-sizes 1 10 100 1000
+    python benchmark_predictor.py xgb-inplace --batch-sizes 1 100 100000
+    python benchmark_predictor.py cascade --bands 0.05 0.1 0.2
+    python benchmark_predictor.py deadline --slow-rate 0.05 --delay-ms 300 --deadline-ms 50
+    python benchmark_predictor.py batch-stream --rows 1000000 --legacy-rows 100000
+    python benchmark_predictor.py batch-sink --rows 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from Predict.app.services import batch_jobs
+from Predict.app.services import predictor_service as ps
+
+# 示例患者输入 (与批量模板中的示例行一致)
+SAMPLE_INPUT = {
+    '住院第几天': 5,
+    '白细胞计数': 7.5,
+    '血钾浓度': 4.2,
+    '白蛋白计数': 42.0,
+    '吸烟史': '无',
+    '摩擦力/剪切力': '潜在',
+    '移动能力': '受限',
+    '感知觉': '受限',
+    '身体活动度': '卧',
+    '日常食物获取': '缺乏',
+    '水肿': '有',
+    '皮肤潮湿': '无',
+    '意识障碍': '无',
+    '高血压': '有',
+    '糖尿病': '无',
+    '冠心病': '无',
+    '下肢深静脉血栓': '无',
+}
+
+
+def synthetic_cohort(n, seed=0):
+    """生成 n 条随机但取值合法的患者原始输入。"""
+    rng = np.random.default_rng(seed)
+    cohort = []
+    for _ in range(n):
+        row = {
+            '住院第几天': int(rng.integers(1, 60)),
+            '白细胞计数': round(float(rng.uniform(2.0, 20.0)), 1),
+            '血钾浓度': round(float(rng.uniform(2.5, 6.5)), 1),
+            '白蛋白计数': round(float(rng.uniform(15.0, 55.0)), 1),
+        }
+        for field in ps.CATEGORICAL_FIELDS:
+            mapping = ps.CATEGORY_MAPPING.get(ps.FIELD_MAPPING.get(field, field)) or ps.CATEGORY_MAPPING[field]
+            options = list(mapping.keys())
+            row[field] = options[int(rng.integers(0, len(options)))]
+        cohort.append(row)
+    return cohort
+
+
+def encode_cohort(cohort):
+    """使用单例编码器将原始输入逐行写入一个预分配矩阵。"""
+    X = np.empty((len(cohort), len(ps.EXPECTED_FEATURES)), dtype=np.float64)
+    for i, row in enumerate(cohort):
+        ps.single_input_encoder.encode(row, out=X[i])
+    return X
+
+
+def _timeit(func, repeat):
+    """执行 func repeat 次，返回每次调用的平均耗时 (微秒)。"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def _legacy_prepare_single_input(data):
+    """旧版基于 DataFrame 的单例输入准备逻辑，仅用于对比。"""
+    input_dict_mapped = {}
+    for field in ps.NUMERIC_FIELDS:
+        input_dict_mapped[ps.FIELD_MAPPING.get(field, field)] = [float(data[field])]
+    for field in ps.CATEGORICAL_FIELDS:
+        mapped_field = ps.FIELD_MAPPING.get(field, field)
+        mapping_dict = ps.CATEGORY_MAPPING.get(mapped_field) or ps.CATEGORY_MAPPING.get(field)
+        input_dict_mapped[mapped_field] = [mapping_dict[data[field]]]
+    input_df = pd.DataFrame(input_dict_mapped)
+    input_df = input_df[ps.EXPECTED_FEATURES]
+    if input_df.isnull().any().any():
+        raise ValueError("数据处理后仍存在无效值 (NaN)")
+    return input_df
+
+
+def bench_encoder(args):
+    """对比旧版 DataFrame 路径与预编译编码器的单次调用耗时。"""
+    legacy = _legacy_prepare_single_input(SAMPLE_INPUT).to_numpy(dtype=np.float64)
+    encoded = ps.prepare_single_input(SAMPLE_INPUT)
+    assert np.array_equal(legacy, encoded), "编码结果与旧实现不一致"
+
+    legacy_us = _timeit(lambda: _legacy_prepare_single_input(SAMPLE_INPUT), args.repeat)
+    encoder_us = _timeit(lambda: ps.prepare_single_input(SAMPLE_INPUT), args.repeat)
+    print(f"DataFrame 路径: {legacy_us:.1f} µs/次")
+    print(f"预编译编码器:   {encoder_us:.1f} µs/次")
+    print(f"加速比: {legacy_us / encoder_us:.1f}x")
+
+
+def check_parity(args):
+    """验证由 predict_proba 推导的类别与各模型 predict() 的结果逐位一致。"""
+    X = encode_cohort(synthetic_cohort(args.rows, seed=args.seed))
+    frame = pd.DataFrame(X, columns=ps.EXPECTED_FEATURES)
+    failed = False
+    for model_key, model in ps.current_model_set().models.items():
+        if model is None:
+            print(f"{model_key}: 未加载，跳过")
+            continue
+        for name, data in (("ndarray", X), ("DataFrame", frame)):
+            proba = model.predict_proba(data)
+            derived = ps.classes_from_proba(model_key, model, proba)
+            expected = model.predict(data)
+            mismatches = int(np.sum(derived != expected))
+            ties = int(np.sum(proba[:, 1] == proba[:, 0]))
+            print(f"{model_key} [{name}]: {len(X)} 行, 平票 {ties} 行, 不一致 {mismatches} 行")
+            failed = failed or mismatches > 0 or derived.dtype.kind != expected.dtype.kind
+    if failed:
+        raise SystemExit("推导类别与 predict() 不一致")
+    print("全部模型一致")
+
+
+def bench_coalesce(args):
+    """模拟并发单例请求，对比逐个预测与请求合并的吞吐量。"""
+    X = encode_cohort(synthetic_cohort(args.requests, seed=1))
+    rows = [X[i:i + 1] for i in range(len(X))]
+
+    start = time.perf_counter()
+    expected = [ps.predict_single(row) for row in rows]
+    sequential = time.perf_counter() - start
+
+    coalescer = ps.PredictionCoalescer(window_ms=args.window_ms, max_batch_size=args.max_batch)
+    ps.prediction_cache.clear()  # 避免上面的逐个预测结果直接命中缓存
+
+    async def client(client_rows):
+        return [await coalescer.submit(row) for row in client_rows]
+
+    async def run():
+        per_client = [rows[i::args.clients] for i in range(args.clients)]
+        outputs = await asyncio.gather(*(client(r) for r in per_client))
+        return per_client, outputs
+
+    start = time.perf_counter()
+    per_client, outputs = asyncio.run(run())
+    coalesced = time.perf_counter() - start
+
+    # 多行矩阵乘法与单行的 BLAS 路径不同，逻辑回归概率可能相差 1 ulp，因此概率按容差比较
+    index = {id(row): i for i, row in enumerate(rows)}
+    for client_rows, client_results in zip(per_client, outputs):
+        for row, result in zip(client_rows, client_results):
+            reference = expected[index[id(row)]]
+            assert result["predictions"] == reference["predictions"], "合并预测类别与逐个预测不一致"
+            assert result["risk_level"] == reference["risk_level"], "合并预测风险等级与逐个预测不一致"
+            for model_key, prob in reference["probabilities"].items():
+                assert abs(result["probabilities"][model_key] - prob) <= 1e-12, "合并预测概率与逐个预测不一致"
+
+    print(f"逐个预测: {args.requests / sequential:.0f} 次/秒")
+    print(f"请求合并 ({args.clients} 个并发客户端): {args.requests / coalesced:.0f} 次/秒")
+    print(f"合并指标: {coalescer.get_metrics()}")
+
+
+def bench_cache(args):
+    """模拟重复提交 (相同特征向量)，对比缓存命中与重新推理的耗时。"""
+    X = encode_cohort(synthetic_cohort(args.unique, seed=2))
+    rng = np.random.default_rng(3)
+    order = rng.integers(0, len(X), size=args.requests)
+
+    ps.prediction_cache.enabled = False
+    start = time.perf_counter()
+    for i in order:
+        ps.predict_single(X[i:i + 1])
+    uncached = time.perf_counter() - start
+
+    ps.prediction_cache.enabled = True
+    ps.prediction_cache.clear()
+    start = time.perf_counter()
+    for i in order:
+        ps.predict_single(X[i:i + 1])
+    cached = time.perf_counter() - start
+
+    print(f"无缓存: {args.requests / uncached:.0f} 次/秒")
+    print(f"有缓存 ({args.unique} 个不同输入): {args.requests / cached:.0f} 次/秒")
+    print(f"缓存指标: {ps.prediction_cache.get_metrics()}")
+
+    version = ps.current_model_set().version
+    ps.load_models()
+    assert ps.current_model_set().version == version + 1 and ps.prediction_cache.get_metrics()["entries"] == 0, "重新加载模型后缓存未失效"
+    print("重新加载模型后缓存已失效")
+
+
+def bench_executor(args):
+    """并发提交推理任务到推理执行器，输出排队等待与计算耗时。"""
+    X = encode_cohort(synthetic_cohort(args.tasks, seed=4))
+    executor = ps.ManagedExecutor('inference', mode=args.mode, workers=args.workers, max_queue=args.tasks,
+                                  initializer=ps._init_inference_worker)
+
+    async def run():
+        return await asyncio.gather(*(executor.run(ps.predict_rows, X[i:i + 1]) for i in range(len(X))))
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    assert [r[0]["predictions"] for r in results] == [r["predictions"] for r in ps.predict_rows(X)]
+    print(f"{args.mode} x {args.workers}: {args.tasks / elapsed:.0f} 次/秒")
+    print(f"执行器指标: {executor.get_metrics()}")
+
+
+def bench_report(args):
+    """对比每份报告重新构建样式 (旧行为) 与复用预编译模板时的报告生成速度。"""
+    result = ps.predict_single(ps.prepare_single_input(SAMPLE_INPUT))
+    report_id = "00000000-0000-0000-0000-000000000000"
+
+    def render(template):
+        ps.build_report_pdf(BytesIO(), SAMPLE_INPUT, result, report_id, template=template)
+
+    fresh_us = _timeit(lambda: render(ps.ReportTemplate(ps.DEFAULT_FONT)), args.repeat)
+    cached_us = _timeit(lambda: render(ps.get_report_template()), args.repeat)
+    print(f"每次构建样式: {1e6 / fresh_us:.1f} 份/秒")
+    print(f"复用报告模板: {1e6 / cached_us:.1f} 份/秒")
+
+
+def bench_report_pool(args):
+    """并发提交报告排版任务到报告执行器，输出吞吐量与排队/排版耗时。"""
+    result = ps.predict_single(ps.prepare_single_input(SAMPLE_INPUT))
+    ps.report_executor = ps.ManagedExecutor('report', mode=args.mode, workers=args.workers, max_queue=args.jobs)
+    report_ids = [f"00000000-0000-0000-0000-{i:012d}" for i in range(args.jobs)]
+
+    async def run():
+        return await asyncio.gather(*(ps.render_report(SAMPLE_INPUT, result, rid, as_bytes=True) for rid in report_ids))
+
+    start = time.perf_counter()
+    pdfs = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    ps.report_executor.shutdown()
+    assert all(pdf.startswith(b"%PDF") for pdf in pdfs)
+    print(f"{args.mode} x {args.workers}: {args.jobs / elapsed:.1f} 份/秒")
+    print(f"报告执行器指标: {ps.report_executor.get_metrics()}")
+
+
+def _run_load_probe(workers, lazy_keys, native=None, mmap=False):
+    """在新的解释器中加载模型 (避免库导入和文件缓存影响比较)，返回 (导入耗时, 加载耗时, 首次使用耗时, 各模型统计)。
+
+    native 为 None 时沿用配置文件中的原生格式开关。
+    """
+    native_line = "" if native is None else f"ps.MODEL_NATIVE_ENABLED = {bool(native)}\nps.MODEL_NATIVE_MMAP = {bool(mmap)}"
+    probe = f"""
+import json, time
+t = time.perf_counter()
+from Predict.app.services import predictor_service as ps
+import_ms = (time.perf_counter() - t) * 1000
+ps.MODEL_LOAD_WORKERS = {workers}
+{native_line}
+t = time.perf_counter()
+model_set = ps.load_models(lazy_keys={list(lazy_keys)!r})
+load_ms = (time.perf_counter() - t) * 1000
+t = time.perf_counter()
+model_set.models
+first_use_ms = (time.perf_counter() - t) * 1000
+print(json.dumps([import_ms, load_ms, first_use_ms, model_set.load_stats]))
+"""
+    output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_load(args):
+    """模块导入耗时，以及串行 / 并行 / 延迟加载模型的耗时和内存 (每种方式在新进程中测量)。"""
+    configs = [(1, ()), (args.workers, ())]
+    if args.lazy:
+        configs.append((args.workers, tuple(key.strip() for key in args.lazy.split(",") if key.strip())))
+    for workers, lazy_keys in configs:
+        import_ms, load_ms, first_use_ms, stats = _run_load_probe(workers, lazy_keys)
+        label = f"{workers} 线程" + (f", 延迟加载 {list(lazy_keys)}" if lazy_keys else "")
+        print(f"[{label}] 导入模块 {import_ms:.0f} ms, 启动加载 {load_ms:.0f} ms, 第一次使用时加载 {first_use_ms:.0f} ms")
+        for model_key, model_stats in stats.items():
+            print(f"  {model_key}: {model_stats['load_ms']:.0f} ms, 文件 {model_stats['file_bytes'] / 1024:.0f} KB, "
+                  f"内存增量约 {model_stats['rss_delta_bytes'] / 1024 / 1024:.1f} MB")
+
+
+def bench_native_load(args):
+    """比较 pickle 与原生格式 (可选内存映射) 的启动加载耗时，每种方式在新进程中测量多次取中位数。"""
+    from Predict.app.services import model_artifacts
+    if not model_artifacts.read_manifest(ps.NATIVE_MODEL_PATH).get("models"):
+        print("未找到原生格式模型，请先执行: python -m Predict.app.services.model_artifacts convert")
+        return
+    configs = [("pickle", False, False), ("原生格式", True, False), ("原生格式 + mmap", True, True)]
+    for label, native, mmap in configs:
+        runs = [_run_load_probe(args.workers, (), native=native, mmap=mmap) for _ in range(args.repeat)]
+        load_ms = sorted(run[1] for run in runs)[len(runs) // 2]
+        print(f"[{label}] 启动加载中位数 {load_ms:.0f} ms ({args.repeat} 次, {args.workers} 线程)")
+        for model_key, model_stats in runs[-1][3].items():
+            print(f"  {model_key}: {model_stats['load_ms']:.0f} ms, 文件 {model_stats['file_bytes'] / 1024:.0f} KB, "
+                  f"内存增量约 {model_stats['rss_delta_bytes'] / 1024 / 1024:.1f} MB")
+
+
+def _run_fork_probe(workers, preload, freeze_gc, mmap):
+    """在新的解释器中模拟 gunicorn: 主进程 (可选预加载) fork 出若干 worker，各自启动并推理后读取内存统计 (KB)。"""
+    probe = f"""
+import asyncio, json, os, signal, time
+import numpy as np
+
+def smaps(pid):
+    fields = {{}}
+    with open(f"/proc/{{pid}}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 3 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields
+
+if {preload!r}:
+    from Predict.app.services import predictor_service as ps
+    ps.MODEL_NATIVE_MMAP = {mmap!r}
+    ps.preload_for_workers(freeze_gc={freeze_gc!r})
+ready_r, ready_w = os.pipe()
+pids = []
+for _ in range({workers}):
+    pid = os.fork()
+    if pid == 0:
+        from Predict.app.services import predictor_service as ps
+        ps.MODEL_NATIVE_MMAP = {mmap!r}
+        asyncio.run(ps.startup_models())
+        rng = np.random.default_rng(os.getpid())
+        for _ in range(20):
+            ps.predict_rows(rng.random((64, len(ps.EXPECTED_FEATURES))) * 10)
+        import gc; gc.collect()
+        os.write(ready_w, b"x")
+        time.sleep(600)
+        os._exit(0)
+    pids.append(pid)
+received = 0
+while received < {workers}:
+    received += len(os.read(ready_r, {workers}))
+stats = {{"master": smaps(os.getpid()), "workers": [smaps(pid) for pid in pids]}}
+for pid in pids:
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+print(json.dumps(stats))
+"""
+    output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_fork_memory(args):
+    """比较各 worker 自行加载模型与主进程预加载 (可选冻结 GC / 内存映射) 时每个 worker 的 RSS、PSS 与共享内存。"""
+    configs = [("worker 各自加载", False, False, False),
+               ("主进程预加载", True, False, False),
+               ("主进程预加载 + gc.freeze", True, True, False)]
+    if args.mmap:
+        configs.append(("主进程预加载 + gc.freeze + mmap", True, True, True))
+    for label, preload, freeze_gc, mmap in configs:
+        stats = _run_fork_probe(args.workers, preload, freeze_gc, mmap)
+        workers = stats["workers"]
+        mean = lambda field: sum(worker.get(field, 0) for worker in workers) / len(workers) / 1024
+        total_pss = (sum(worker["Pss"] for worker in workers) + stats["master"]["Pss"]) / 1024
+        print(f"[{label}] {args.workers} 个 worker: 平均 RSS {mean('Rss'):.1f} MB, 平均 PSS {mean('Pss'):.1f} MB, "
+              f"共享 {mean('Shared_Clean') + mean('Shared_Dirty'):.1f} MB, "
+              f"私有 {mean('Private_Clean') + mean('Private_Dirty'):.1f} MB, 主进程+worker 总 PSS {total_pss:.1f} MB")
+
+
+def bench_rf_engine(args):
+    """对比随机森林在 sklearn predict_proba 与向量化树引擎下各批量大小的耗时，并校验概率一致。"""
+    from Predict.app.services import tree_engine
+    model = ps.current_model_set().models["random_forest"]
+    sklearn_model = tree_engine.unwrap(model)
+    # 不设行数上限，测量向量化引擎本身在各批量下的耗时 (服务中超过 MODEL_FLAT_TREE_MAX_ROWS 的批量交给 sklearn)
+    forest = tree_engine.FlatForest(sklearn_model, max_rows=max(args.batch_sizes))
+    X = encode_cohort(synthetic_cohort(max(args.batch_sizes), seed=4))
+    frame = pd.DataFrame(X, columns=ps.EXPECTED_FEATURES)
+    diff = np.max(np.abs(forest.predict_proba(frame) - sklearn_model.predict_proba(frame)))
+    assert diff <= tree_engine.PARITY_TOLERANCE, diff
+    print(f"概率最大误差: {diff:.3g}")
+    for batch_size in args.batch_sizes:
+        batch = frame.iloc[:batch_size]
+        timings = {}
+        for label, predict in (("sklearn", sklearn_model.predict_proba), ("向量化", forest.predict_proba)):
+            predict(batch)
+            repeat = max(3, args.rows // batch_size)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                predict(batch)
+            timings[label] = (time.perf_counter() - start) / repeat * 1000
+        print(f"批量 {batch_size:>5}: sklearn {timings['sklearn']:.2f} ms, 向量化 {timings['向量化']:.2f} ms, "
+              f"加速 {timings['sklearn'] / timings['向量化']:.1f}x")
+
+
+def bench_xgb_inplace(args):
+    """对比 XGBoost 包装器 (DataFrame 输入) 与 inplace_predict 快速路径在各批量大小的耗时，并校验概率一致。"""
+    from Predict.app.services import tree_engine
+    model = ps.current_model_set().models["xgboost"]
+    wrapper = tree_engine.unwrap(model)
+    engine = tree_engine.XGBoostInplace(wrapper, rows_per_thread=args.rows_per_thread)
+    cohort = encode_cohort(synthetic_cohort(max(args.batch_sizes), seed=5))
+    frame = pd.DataFrame(cohort, columns=ps.EXPECTED_FEATURES)
+    diff = np.max(np.abs(engine.predict_proba(frame) - wrapper.predict_proba(frame)))
+    assert diff <= tree_engine.XGB_PARITY_TOLERANCE, diff
+    print(f"概率最大误差: {diff:.3g} ({len(frame)} 行)")
+    for batch_size in args.batch_sizes:
+        batch = frame.iloc[:batch_size]
+        repeat = max(3, args.rows // batch_size)
+        timings = {}
+        for label, predict in (("包装器", wrapper.predict_proba), ("inplace", engine.predict_proba)):
+            predict(batch)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                predict(batch)
+            timings[label] = (time.perf_counter() - start) / repeat * 1000
+        print(f"批量 {batch_size:>6}: 包装器 {timings['包装器']:.2f} ms, inplace {timings['inplace']:.2f} ms "
+              f"({engine.threads_for(batch_size)} 线程), 加速 {timings['包装器'] / timings['inplace']:.1f}x")
+
+
+def bench_cascade(args):
+    """级联模式在合成队列上的提前结束比例、与完整集成的风险等级一致率，以及单例请求的平均耗时。"""
+    X = encode_cohort(synthetic_cohort(args.rows, seed=6))
+    full = ps.predict_rows(X, cascade=False)
+    n_models = len(full[0]["models_evaluated"])
+    for band in args.bands:
+        ps.CASCADE_BAND = band
+        cascaded = ps.predict_rows(X, cascade=True)
+        early = sum(len(r["models_evaluated"]) < n_models for r in cascaded) / len(X)
+        agree = sum(a["risk_level"] == b["risk_level"] for a, b in zip(full, cascaded)) / len(X)
+        timings = {}
+        for label, cascade in (("完整", False), ("级联", True)):
+            start = time.perf_counter()
+            for i in range(args.requests):
+                ps.predict_rows(X[i:i + 1], cascade=cascade)
+            timings[label] = (time.perf_counter() - start) / args.requests * 1000
+        print(f"带宽 ±{band:.2f}: 提前结束 {early:.1%}, 风险等级与完整集成一致 {agree:.1%}, "
+              f"单例平均耗时 完整 {timings['完整']:.2f} ms / 级联 {timings['级联']:.2f} ms")
+
+
+class _SlowModel:
+    """以 slow_rate 的概率在推理前等待 delay 秒，模拟偶尔卡顿的模型。"""
+
+    def __init__(self, model, slow_rate, delay, seed=7):
+        self.model = model
+        self.slow_rate = slow_rate
+        self.delay = delay
+        self.rng = np.random.default_rng(seed)
+        self.classes_ = model.classes_
+
+    def predict_proba(self, X):
+        if self.rng.random() < self.slow_rate:
+            time.sleep(self.delay)
+        return self.model.predict_proba(X)
+
+
+def bench_deadline(args):
+    """一个模型偶尔卡顿时，比较不设截止时间与设截止时间的单例延迟分位数和丢弃比例。"""
+    X = encode_cohort(synthetic_cohort(args.requests, seed=8))
+    model_set = ps.current_model_set()
+    original = model_set._models[args.slow_model]
+    model_set._models[args.slow_model] = _SlowModel(original, args.slow_rate, args.delay_ms / 1000.0)
+    try:
+        for label, deadline_ms in (("不设截止时间", 0), (f"截止时间 {args.deadline_ms:.0f} ms", args.deadline_ms)):
+            ps.ensemble_scheduler = ps.EnsembleScheduler(deadline_ms=deadline_ms, miss_limit=args.miss_limit,
+                                                         deprioritize_seconds=args.deprioritize_seconds,
+                                                         max_stragglers=args.max_stragglers)
+            latencies, dropped, reasons = [], 0, {}
+            for i in range(args.requests):
+                start = time.perf_counter()
+                result = ps.predict_rows(X[i:i + 1], model_set)[0]
+                latencies.append((time.perf_counter() - start) * 1000)
+                dropped += bool(result["models_dropped"])
+                for reason in result["models_dropped"].values():
+                    reasons[reason] = reasons.get(reason, 0) + 1
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            print(f"[{label}] p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, 最大 {max(latencies):.1f} ms, "
+                  f"缺少模型的请求 {dropped / args.requests:.1%} {reasons}")
+            ps.ensemble_scheduler.shutdown()
+    finally:
+        model_set._models[args.slow_model] = original
+
+
+def write_batch_csv(path, n, seed=0, chunk=100000):
+    """按块生成 n 行随机批量输入 CSV (含患者ID列)，生成过程的内存与 n 无关。"""
+    rng = np.random.default_rng(seed)
+    for offset in range(0, n, chunk):
+        size = min(chunk, n - offset)
+        columns = {
+            '患者ID': np.arange(offset, offset + size) + 1,
+            '住院第几天': rng.integers(1, 60, size),
+            '白细胞计数': rng.uniform(2.0, 20.0, size).round(1),
+            '血钾浓度': rng.uniform(2.5, 6.5, size).round(1),
+            '白蛋白计数': rng.uniform(15.0, 55.0, size).round(1),
+        }
+        for field in ps.CATEGORICAL_FIELDS:
+            mapping = ps.CATEGORY_MAPPING.get(ps.FIELD_MAPPING.get(field, field)) or ps.CATEGORY_MAPPING[field]
+            columns[field] = rng.choice(list(mapping.keys()), size)
+        pd.DataFrame(columns).to_csv(path, mode='w' if offset == 0 else 'a', header=offset == 0, index=False)
+
+
+def _run_batch_probe(input_path, result_path, streaming, chunk_rows):
+    """在新的解释器中处理一个批量文件，返回 (加载模型后的 RSS, 峰值 RSS, 处理耗时秒数, 行数)，RSS 单位 MB。"""
+    probe = f"""
+import json, logging, resource, time
+from io import BytesIO
+from pathlib import Path
+import pandas as pd
+from Predict.app.services import batch_jobs
+from Predict.app.services import predictor_service as ps
+logging.disable(logging.INFO)
+model_set = ps.load_models(lazy_keys=())
+model_set.models
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+t = time.perf_counter()
+if {streaming!r}:
+    rows = batch_jobs.run_batch_pipeline(Path({str(input_path)!r}), '.csv', batch_jobs.XlsxResultSink(Path({str(result_path)!r})), model_set, {chunk_rows!r})["row_count"]
+else:
+    with open({str(input_path)!r}, 'rb') as f:
+        content = f.read()
+    input_df = pd.read_csv(BytesIO(content), encoding='utf-8')
+    results = ps.predict_batch_with_all_models(ps.prepare_batch_input(input_df), model_set)
+    batch_jobs.build_batch_result_frame(input_df, results).to_excel({str(result_path)!r}, index=False, engine='openpyxl')
+    rows = len(input_df)
+elapsed = time.perf_counter() - t
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps([baseline, peak, elapsed, rows]))
+"""
+    output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_batch_stream(args):
+    """比较整体读入与流式分块处理批量文件的峰值内存和耗时 (每种方式在新进程中测量)。"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configs = []
+        for rows in sorted(set(args.legacy_rows + [args.rows])):
+            input_path = os.path.join(tmpdir, f"batch_{rows}.csv")
+            write_batch_csv(input_path, rows)
+            size_mb = os.path.getsize(input_path) / 1024 / 1024
+            if rows in args.legacy_rows:
+                configs.append((f"整体读入 {rows} 行 ({size_mb:.0f} MB)", input_path, False))
+            configs.append((f"流式分块 {rows} 行 ({size_mb:.0f} MB)", input_path, True))
+        for label, input_path, streaming in configs:
+            result_path = os.path.join(tmpdir, "result.xlsx")
+            baseline, peak, elapsed, rows = _run_batch_probe(input_path, result_path, streaming, args.chunk_rows)
+            print(f"[{label}] 峰值 RSS {peak:.0f} MB (模型加载后 {baseline:.0f} MB, 增量 {peak - baseline:.0f} MB), "
+                  f"耗时 {elapsed:.1f} 秒, {rows / elapsed:.0f} 行/秒")
+            os.unlink(result_path)
+
+
+def _run_sink_probe(chunk_path, result_path, writer, rows):
+    """在新的解释器中把一块已评分的结果重复写出 rows 行，返回 (写入前的 RSS, 峰值 RSS, 写入耗时秒数)，RSS 单位 MB。"""
+    probe = f"""
+import json, logging, resource, time
+from pathlib import Path
+import pandas as pd
+from Predict.app.services import batch_jobs
+logging.disable(logging.INFO)
+chunk = pd.read_pickle({str(chunk_path)!r})
+repeats = -(-{rows} // len(chunk))
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+t = time.perf_counter()
+if {writer!r} == 'to_excel':
+    pd.concat([chunk] * repeats, ignore_index=True).iloc[:{rows}].to_excel({str(result_path)!r}, index=False, engine='openpyxl')
+else:
+    sink = batch_jobs.BATCH_RESULT_SINKS[{writer!r}](Path({str(result_path)!r}))
+    for i in range(repeats):
+        sink.write_chunk(chunk.iloc[:{rows} - i * len(chunk)])
+    sink.commit()
+elapsed = time.perf_counter() - t
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps([baseline, peak, elapsed]))
+"""
+    output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_batch_sink(args):
+    """比较整表 to_excel 与流式 xlsx / CSV 写入器写出同样结果的耗时和峰值内存 (每种方式在新进程中测量)。"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_path = os.path.join(tmpdir, "input.csv")
+        write_batch_csv(input_path, args.chunk_rows)
+        input_df = pd.read_csv(input_path)
+        results = ps.predict_batch_with_all_models(ps.prepare_batch_input(input_df))
+        chunk_path = os.path.join(tmpdir, "chunk.pkl")
+        batch_jobs.build_batch_result_frame(input_df, results).to_pickle(chunk_path)
+        for label, writer, suffix in (("整表 to_excel", "to_excel", "xlsx"),
+                                      ("流式 xlsx (openpyxl 只写模式)", "xlsx", "xlsx"),
+                                      ("流式 CSV", "csv", "csv")):
+            result_path = os.path.join(tmpdir, f"result.{suffix}")
+            baseline, peak, elapsed = _run_sink_probe(chunk_path, result_path, writer, args.rows)
+            size_mb = os.path.getsize(result_path) / 1024 / 1024
+            print(f"[{label}] {args.rows} 行: 写入 {elapsed:.1f} 秒 ({args.rows / elapsed:.0f} 行/秒), "
+                  f"峰值 RSS {peak:.0f} MB (写入前 {baseline:.0f} MB, 增量 {peak - baseline:.0f} MB), 文件 {size_mb:.1f} MB")
+            os.unlink(result_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HAPI 预测服务性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("encoder", help="单例输入编码耗时")
+    p.add_argument("--repeat", type=int, default=20000)
+    p.set_defaults(func=bench_encoder)
+
+    p = subparsers.add_parser("parity", help="验证由概率推导的类别与 predict() 一致")
+    p.add_argument("--rows", type=int, default=20000)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=check_parity)
+
+    p = subparsers.add_parser("coalesce", help="并发单例请求合并吞吐量")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--clients", type=int, default=32)
+    p.add_argument("--window-ms", type=float, default=2.0)
+    p.add_argument("--max-batch", type=int, default=64)
+    p.set_defaults(func=bench_coalesce)
+
+    p = subparsers.add_parser("cache", help="重复提交时的预测缓存效果")
+    p.add_argument("--requests", type=int, default=1000)
+    p.add_argument("--unique", type=int, default=100)
+    p.set_defaults(func=bench_cache)
+
+    p = subparsers.add_parser("executor", help="推理执行器排队与计算耗时")
+    p.add_argument("--mode", choices=["thread", "process"], default="thread")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--tasks", type=int, default=200)
+    p.set_defaults(func=bench_executor)
+
+    p = subparsers.add_parser("report", help="单例 PDF 报告生成速度")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_report)
+
+    p = subparsers.add_parser("report-pool", help="报告排版执行器吞吐量")
+    p.add_argument("--mode", choices=["thread", "process"], default="process")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--jobs", type=int, default=40)
+    p.set_defaults(func=bench_report_pool)
+
+    p = subparsers.add_parser("load", help="模型加载耗时与内存")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--lazy", default="", help="逗号分隔的延迟加载模型键")
+    p.set_defaults(func=bench_load)
+
+    p = subparsers.add_parser("native-load", help="原生格式与 pickle 的加载耗时对比")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_native_load)
+
+    p = subparsers.add_parser("fork-memory", help="gunicorn 预加载模式下各 worker 的内存占用")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--mmap", action="store_true", help="同时测量原生格式内存映射加载")
+    p.set_defaults(func=bench_fork_memory)
+
+    p = subparsers.add_parser("rf-engine", help="随机森林向量化推理引擎与 sklearn 的对比")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    p.add_argument("--rows", type=int, default=2000, help="每种批量大小累计推理的行数")
+    p.set_defaults(func=bench_rf_engine)
+
+    p = subparsers.add_parser("xgb-inplace", help="XGBoost inplace_predict 快速路径与包装器的对比")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100, 100000])
+    p.add_argument("--rows", type=int, default=20000, help="每种批量大小累计推理的行数")
+    p.add_argument("--rows-per-thread", type=int, default=ps.MODEL_XGB_ROWS_PER_THREAD)
+    p.set_defaults(func=bench_xgb_inplace)
+
+    p = subparsers.add_parser("cascade", help="级联提前结束比例与耗时")
+    p.add_argument("--rows", type=int, default=5000)
+    p.add_argument("--requests", type=int, default=300, help="测量单例耗时的请求数")
+    p.add_argument("--bands", type=float, nargs="+", default=[0.05, 0.1, 0.15, 0.2])
+    p.set_defaults(func=bench_cascade)
+
+    p = subparsers.add_parser("deadline", help="模型偶尔卡顿时截止时间对尾延迟的影响")
+    p.add_argument("--requests", type=int, default=500)
+    p.add_argument("--slow-model", default="random_forest")
+    p.add_argument("--slow-rate", type=float, default=0.05)
+    p.add_argument("--delay-ms", type=float, default=300.0)
+    p.add_argument("--deadline-ms", type=float, default=50.0)
+    p.add_argument("--miss-limit", type=int, default=3)
+    p.add_argument("--deprioritize-seconds", type=float, default=1.0)
+    p.add_argument("--max-stragglers", type=int, default=ps.ENSEMBLE_MAX_STRAGGLERS)
+    p.set_defaults(func=bench_deadline)
+
+    p = subparsers.add_parser("batch-stream", help="流式分块批量预测与整体读入的峰值内存对比")
+    p.add_argument("--rows", type=int, default=1000000, help="流式处理的行数")
+    p.add_argument("--legacy-rows", type=int, nargs="*", default=[100000], help="同时用整体读入方式处理的行数")
+    p.add_argument("--chunk-rows", type=int, default=ps.BATCH_CHUNK_ROWS)
+    p.set_defaults(func=bench_batch_stream)
+
+    p = subparsers.add_parser("batch-sink", help="批量结果写入器的耗时与峰值内存")
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--chunk-rows", type=int, default=ps.BATCH_CHUNK_ROWS)
+    p.set_defaults(func=bench_batch_sink)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
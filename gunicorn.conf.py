@@ -0,0 +1,27 @@
+"""gunicorn 配置文件 (在仓库根目录执行 gunicorn Predict.app.main:app 时自动读取)。
+
+环境变量:
+    HAPI_BIND       监听地址，默认 0.0.0.0:8000
+    HAPI_WORKERS    worker 进程数，默认 4
+    HAPI_PRELOAD    是否在主进程中预加载应用和模型后再 fork worker，默认 1
+    HAPI_GC_FREEZE  预加载后是否冻结 GC，默认 1
+"""
+import os
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).strip().lower() not in ("0", "false", "no", "off")
+
+
+bind = os.environ.get("HAPI_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("HAPI_WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# 预加载时模型只在主进程中反序列化一次，各 worker 以写时复制方式共享模型内存
+preload_app = _env_flag("HAPI_PRELOAD", "1")
+
+
+def when_ready(server):
+    """preload_app 开启时应用已在主进程中导入，此时加载模型并冻结 GC，随后 gunicorn 才开始 fork worker。"""
+    if preload_app:
+        from Predict.app.services import predictor_service
+        predictor_service.preload_for_workers(freeze_gc=_env_flag("HAPI_GC_FREEZE", "1"))
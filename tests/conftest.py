@@ -0,0 +1,50 @@
+"""
+测试共用的夹具: 模型集 (加载模型目录中的模型) 和随机生成的患者输入矩阵。
+"""
+import pytest
+
+COHORT_ROWS = 200
+
+
+def synthetic_rows(n, seed=0):
+    """生成 n 条随机但取值合法的患者原始输入，并编码为按 EXPECTED_FEATURES 排列的矩阵。"""
+    import numpy as np
+    from Predict.app.services import predictor_service as ps
+
+    rng = np.random.default_rng(seed)
+    X = np.empty((n, len(ps.EXPECTED_FEATURES)), dtype=np.float64)
+    for i in range(n):
+        row = {
+            '住院第几天': int(rng.integers(1, 60)),
+            '白细胞计数': round(float(rng.uniform(2.0, 20.0)), 1),
+            '血钾浓度': round(float(rng.uniform(2.5, 6.5)), 1),
+            '白蛋白计数': round(float(rng.uniform(15.0, 55.0)), 1),
+        }
+        for field in ps.CATEGORICAL_FIELDS:
+            mapping = ps.CATEGORY_MAPPING.get(ps.FIELD_MAPPING.get(field, field)) or ps.CATEGORY_MAPPING[field]
+            options = list(mapping.keys())
+            row[field] = options[int(rng.integers(0, len(options)))]
+        ps.single_input_encoder.encode(row, out=X[i])
+    return X
+
+
+@pytest.fixture(scope="session")
+def model_set():
+    from Predict.app.services import predictor_service as ps
+    return ps.load_models(lazy_keys=())
+
+
+@pytest.fixture(scope="session")
+def cohort():
+    return synthetic_rows(COHORT_ROWS, seed=0)
+
+
+@pytest.fixture
+def loaded_model(model_set):
+    """按模型键取出已加载的模型，模型文件缺失 (服务用模拟模型代替) 时跳过测试。"""
+    def get(model_key):
+        model = model_set.models.get(model_key)
+        if model is None or not model_set.sources.get(model_key):
+            pytest.skip(f"模型 {model_key} 的模型文件不可用")
+        return model
+    return get
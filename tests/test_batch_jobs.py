@@ -0,0 +1,160 @@
+"""
+批量预测流水线测试: 结果写入器、分块流式处理、批次摘要。
+推理用按住院时长给出概率的假函数代替，不需要模型文件；结果目录改为临时目录。
+"""
+import uuid
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("openpyxl")
+
+from Predict.app.services import batch_jobs
+from Predict.app.services import predictor_service as ps
+
+ROWS = 25
+CHUNK_ROWS = 10
+
+
+def fake_predict_batch(df, model_set=None):
+    probabilities = (df['住院时长'] / 100.0).tolist()
+    predictions = [int(p >= 0.5) for p in probabilities]
+    return {
+        "model_predictions": {"logistic_regression": predictions},
+        "model_probabilities": {"logistic_regression": probabilities},
+        "ensemble_probabilities": probabilities,
+        "ensemble_predictions": predictions,
+        "risk_levels": ['高风险' if p >= 0.5 else '低风险' for p in probabilities],
+    }
+
+
+@pytest.fixture
+def results_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, 'BATCH_RESULTS_DIR', tmp_path)
+    monkeypatch.setattr(batch_jobs, 'predict_batch_with_all_models', fake_predict_batch)
+    executor = ps.ManagedExecutor('inference', 'thread', workers=1, max_queue=4)
+    monkeypatch.setattr(ps, 'inference_executor', executor)
+    yield tmp_path
+    executor.shutdown()
+
+
+@pytest.fixture
+def input_csv(tmp_path):
+    path = tmp_path / "input.csv"
+    pd.DataFrame({
+        '患者ID': range(1, ROWS + 1),
+        '住院第几天': [day * 4 for day in range(ROWS)],
+        'actual_label': [day % 2 for day in range(ROWS)],
+    }).to_csv(path, index=False, encoding='utf-8-sig')
+    return path
+
+
+def read_results(path):
+    return [row for rows in ps.iter_batch_result_rows(path, chunk_size=7) for row in rows]
+
+
+@pytest.mark.parametrize("result_format", list(batch_jobs.BATCH_RESULT_SINKS))
+def test_sink_aligns_columns_and_publishes_atomically(tmp_path, result_format):
+    path = tmp_path / f"results.{result_format}"
+    sink = batch_jobs.BATCH_RESULT_SINKS[result_format](path)
+    sink.write_chunk(pd.DataFrame({"a": [1, 2], "b": ["x", "y"]}))
+    # 之后的块按第一块的列顺序写入
+    sink.write_chunk(pd.DataFrame({"b": ["z"], "a": [3]}))
+    sink.finish()
+    assert not path.exists()
+    assert sink.publish() == path
+    assert not sink.partial_path.exists()
+
+    rows = read_results(path)
+    assert [(row["a"], row["b"]) for row in rows] == [(1, "x"), (2, "y"), (3, "z")]
+    assert sink.rows == 3 and sink.columns == ["a", "b"]
+
+
+@pytest.mark.parametrize("result_format", list(batch_jobs.BATCH_RESULT_SINKS))
+def test_aborted_sink_leaves_nothing(tmp_path, result_format):
+    path = tmp_path / f"results.{result_format}"
+    sink = batch_jobs.BATCH_RESULT_SINKS[result_format](path)
+    sink.write_chunk(pd.DataFrame({"a": [1]}))
+    sink.abort()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pipeline_streams_chunks(results_dir, input_csv):
+    sink = batch_jobs.CsvResultSink(results_dir / "results.csv")
+    progress = []
+    finalized = []
+
+    def finalize(summary):
+        # 摘要在结果文件出现之前写入
+        finalized.append((dict(summary), sink.path.exists()))
+
+    summary = batch_jobs.run_batch_pipeline(input_csv, '.csv', sink, ps.ModelSet({}), CHUNK_ROWS,
+                                            progress=progress.append, finalize=finalize)
+
+    assert progress == [10, 20, 25]
+    assert summary["row_count"] == ROWS and summary["chunks"] == 3
+    assert summary["risk_level_counts"] == {'低风险': 13, '高风险': 12}
+    assert summary["models"] == [{"key": "logistic_regression", "name": ps.MODEL_NAMES["logistic_regression"]}]
+    assert finalized == [(summary, False)]
+
+    rows = read_results(sink.path)
+    assert [row["患者ID"] for row in rows] == list(range(1, ROWS + 1))
+    assert rows[0]["风险级别"] == '低风险' and rows[-1]["风险级别"] == '高风险'
+    assert [row["真实标签"] for row in rows] == [day % 2 for day in range(ROWS)]
+    assert summary["columns"][0] == '患者ID'
+
+
+def test_pipeline_failure_discards_partial_results(results_dir, input_csv):
+    sink = batch_jobs.XlsxResultSink(results_dir / "results.xlsx")
+
+    def cancel_after_first_chunk(rows_done):
+        raise batch_jobs.BatchJobCancelled("已取消")
+
+    with pytest.raises(batch_jobs.BatchJobCancelled):
+        batch_jobs.run_batch_pipeline(input_csv, '.csv', sink, ps.ModelSet({}), CHUNK_ROWS,
+                                      progress=cancel_after_first_chunk)
+    assert sorted(path.name for path in results_dir.iterdir()) == ["input.csv"]
+
+
+def test_pipeline_rejects_empty_input(results_dir):
+    empty = results_dir / "empty.csv"
+    empty.write_text("患者ID,住院第几天\n", encoding='utf-8')
+    sink = batch_jobs.CsvResultSink(results_dir / "results.csv")
+    with pytest.raises(ValueError):
+        batch_jobs.run_batch_pipeline(empty, '.csv', sink, ps.ModelSet({}), CHUNK_ROWS)
+    assert not sink.path.exists() and not sink.partial_path.exists()
+
+
+def test_manifest_round_trip(results_dir, input_csv):
+    batch_id = str(uuid.uuid4())
+    sink = batch_jobs.create_result_sink(batch_id, 'csv')
+    summary = batch_jobs.run_batch_pipeline(input_csv, '.csv', sink, ps.ModelSet({}), CHUNK_ROWS)
+    written = batch_jobs.write_batch_manifest(batch_id, summary, source_filename="input.csv")
+
+    assert batch_jobs.get_batch_results_path(batch_id) == sink.path
+    assert batch_jobs.get_batch_manifest_path(batch_id).exists()
+    loaded = batch_jobs.load_batch_manifest(batch_id)
+    assert loaded == written
+    assert loaded["batch_id"] == batch_id and loaded["source_filename"] == "input.csv"
+    assert loaded["row_count"] == ROWS and loaded["result_format"] == 'csv'
+
+
+def test_manifest_rebuilt_for_legacy_batches(results_dir, input_csv):
+    batch_id = str(uuid.uuid4())
+    sink = batch_jobs.create_result_sink(batch_id, 'xlsx')
+    summary = batch_jobs.run_batch_pipeline(input_csv, '.csv', sink, ps.ModelSet({}), CHUNK_ROWS)
+    assert not batch_jobs.get_batch_manifest_path(batch_id).exists()
+
+    rebuilt = batch_jobs.load_batch_manifest(batch_id)
+    assert rebuilt["rebuilt"] is True
+    assert rebuilt["row_count"] == ROWS
+    assert rebuilt["risk_level_counts"] == summary["risk_level_counts"]
+    assert rebuilt["models"] == summary["models"]
+    assert batch_jobs.get_batch_manifest_path(batch_id).exists()
+
+
+def test_manifest_of_unknown_batch(results_dir):
+    with pytest.raises(FileNotFoundError):
+        batch_jobs.load_batch_manifest(str(uuid.uuid4()))
+    with pytest.raises(FileNotFoundError):
+        batch_jobs.get_batch_results_path("../etc/passwd")
@@ -0,0 +1,118 @@
+"""
+单例预测合并器测试: 空闲时直接执行、繁忙时合并为一个批次、按最大行数切分、缓存命中不排队、批次出错时通知所有请求。
+推理函数用记录调用的假函数代替，不需要模型文件。
+"""
+import asyncio
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from Predict.app.services import predictor_service as ps
+
+BLOCKING_ROW = -1.0
+
+
+class FakePredictRows:
+    """代替 predict_rows: 每行返回 {"row": 第一列的值}，记录每次调用的行数；第一列为 BLOCKING_ROW 的行阻塞到 release()。"""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.error = None
+
+    def __call__(self, input_rows, model_set=None, **kwargs):
+        rows = np.atleast_2d(input_rows)
+        self.batches.append([float(row[0]) for row in rows])
+        if (rows[:, 0] == BLOCKING_ROW).any():
+            self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [{"row": float(row[0])} for row in rows]
+
+
+@pytest.fixture
+def fake_predict(monkeypatch):
+    fake = FakePredictRows()
+    executor = ps.ManagedExecutor('inference', 'thread', workers=4, max_queue=16)
+
+    def predict_rows(input_rows, model_set=None, **kwargs):
+        return fake(input_rows, model_set)
+
+    monkeypatch.setattr(ps, 'predict_rows', predict_rows)
+    monkeypatch.setattr(ps, 'inference_executor', executor)
+    monkeypatch.setattr(ps, 'prediction_cache', ps.PredictionCache(max_entries=64, ttl_seconds=60, enabled=True))
+    yield fake
+    fake.release.set()
+    executor.shutdown()
+
+
+def row(value):
+    return np.full(len(ps.EXPECTED_FEATURES), value, dtype=np.float64)
+
+
+async def submit_while_busy(coalescer, fake, values):
+    """在一个阻塞的请求执行期间提交 values 对应的各行，返回它们的结果。"""
+    busy = asyncio.ensure_future(coalescer.submit(row(BLOCKING_ROW)))
+    while not fake.batches:
+        await asyncio.sleep(0.001)
+    try:
+        return await asyncio.gather(*(coalescer.submit(row(value)) for value in values))
+    finally:
+        fake.release.set()
+        await busy
+
+
+def test_idle_request_runs_immediately_and_is_cached(fake_predict):
+    coalescer = ps.PredictionCoalescer(window_ms=2.0, max_batch_size=8, enabled=True)
+
+    async def scenario():
+        first = await coalescer.submit(row(1.0))
+        again = await coalescer.submit(row(1.0))
+        return first, again
+
+    first, again = asyncio.run(scenario())
+    assert first == again == {"row": 1.0}
+    assert fake_predict.batches == [[1.0]]
+    metrics = coalescer.get_metrics()
+    assert metrics["bypassed"] == 1 and metrics["cache_hits"] == 1 and metrics["batches"] == 0
+
+
+def test_requests_queued_while_busy_share_one_batch(fake_predict):
+    coalescer = ps.PredictionCoalescer(window_ms=2.0, max_batch_size=8, enabled=True)
+    results = asyncio.run(submit_while_busy(coalescer, fake_predict, [1.0, 2.0, 3.0]))
+
+    assert results == [{"row": 1.0}, {"row": 2.0}, {"row": 3.0}]
+    assert fake_predict.batches == [[BLOCKING_ROW], [1.0, 2.0, 3.0]]
+    metrics = coalescer.get_metrics()
+    assert metrics["batches"] == 1 and metrics["batched_rows"] == 3
+    assert metrics["batch_size_histogram"] == {3: 1}
+
+
+def test_batches_are_split_at_max_batch_size(fake_predict):
+    coalescer = ps.PredictionCoalescer(window_ms=2.0, max_batch_size=2, enabled=True)
+    results = asyncio.run(submit_while_busy(coalescer, fake_predict, [1.0, 2.0, 3.0]))
+
+    assert results == [{"row": 1.0}, {"row": 2.0}, {"row": 3.0}]
+    assert sorted(fake_predict.batches[1:]) == [[1.0, 2.0], [3.0]]
+    assert coalescer.get_metrics()["max_batch_size_seen"] == 2
+
+
+def test_batch_failure_reaches_every_waiting_request(fake_predict):
+    coalescer = ps.PredictionCoalescer(window_ms=2.0, max_batch_size=8, enabled=True)
+    fake_predict.error = RuntimeError("推理失败")
+
+    async def scenario():
+        busy = asyncio.ensure_future(coalescer.submit(row(BLOCKING_ROW)))
+        while not fake_predict.batches:
+            await asyncio.sleep(0.001)
+        waiting = await asyncio.gather(coalescer.submit(row(1.0)), coalescer.submit(row(2.0)), return_exceptions=True)
+        fake_predict.release.set()
+        await asyncio.gather(busy, return_exceptions=True)
+        return waiting
+
+    waiting = asyncio.run(scenario())
+    assert all(result is fake_predict.error for result in waiting)
+    # 失败的结果不写入缓存
+    assert ps.prediction_cache.get_metrics()["entries"] == 0
@@ -0,0 +1,169 @@
+"""
+集成推理截止时间测试: 超时模型不计入结果、连续超时降级、降级期满后只放行一个试探请求、后台超时推理过多时跳过。
+模型用可控的函数代替，不需要模型文件。
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from Predict.app.services import predictor_service as ps
+
+DEADLINE_MS = 100
+
+
+class Gate:
+    """在 release() 之前阻塞的模型推理 (最多等待 timeout 秒)，记录调用次数。"""
+
+    def __init__(self, timeout=5.0):
+        self.event = threading.Event()
+        self.timeout = timeout
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        self.event.wait(self.timeout)
+        return 'slow'
+
+    def release(self):
+        self.event.set()
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+    gates = []
+
+    def make(**kwargs):
+        options = {"deadline_ms": DEADLINE_MS, "budgets_ms": '', "miss_limit": 1,
+                   "deprioritize_seconds": 60.0, "max_stragglers": 4, **kwargs}
+        scheduler = ps.EnsembleScheduler(**options)
+        schedulers.append(scheduler)
+        return scheduler
+
+    def gate():
+        gates.append(Gate())
+        return gates[-1]
+
+    make.gate = gate
+    yield make
+    for blocked in gates:
+        blocked.release()
+    for scheduler in schedulers:
+        scheduler.shutdown()
+
+
+def test_disabled_runs_every_model_in_order():
+    scheduler = ps.EnsembleScheduler(deadline_ms=0)
+    calls = []
+    error = RuntimeError("boom")
+
+    def fail():
+        calls.append('b')
+        raise error
+
+    results, dropped = scheduler.run({'a': lambda: calls.append('a') or 1, 'b': fail})
+    assert calls == ['a', 'b']
+    assert results == {'a': 1, 'b': error}
+    assert dropped == {}
+
+
+def test_model_past_its_deadline_is_dropped(make_scheduler):
+    scheduler = make_scheduler(miss_limit=3)
+    gate = make_scheduler.gate()
+    started = time.monotonic()
+    results, dropped = scheduler.run({'fast': lambda: 'fast', 'slow': gate})
+    elapsed = time.monotonic() - started
+
+    assert results == {'fast': 'fast'}
+    assert dropped == {'slow': ps.EnsembleScheduler.TIMEOUT}
+    assert elapsed < DEADLINE_MS / 1000 + 1.0
+    metrics = scheduler.get_metrics()["models"]["slow"]
+    assert metrics["misses"] == 1 and metrics["stragglers_in_flight"] == 1
+    assert not metrics["deprioritized"]
+
+    gate.release()
+    for _ in range(100):
+        if scheduler.get_metrics()["models"]["slow"]["stragglers_in_flight"] == 0:
+            break
+        time.sleep(0.01)
+    assert scheduler.get_metrics()["models"]["slow"]["stragglers_in_flight"] == 0
+
+
+def test_per_model_budget_overrides_deadline(make_scheduler):
+    scheduler = make_scheduler(budgets_ms=f"slow:{DEADLINE_MS * 5}")
+    results, dropped = scheduler.run({'slow': lambda: time.sleep(DEADLINE_MS * 2 / 1000) or 'slow'})
+    assert results == {'slow': 'slow'} and dropped == {}
+
+
+def test_consecutive_misses_deprioritize_the_model(make_scheduler):
+    scheduler = make_scheduler(miss_limit=2)
+    gate = make_scheduler.gate()
+    for _ in range(2):
+        _, dropped = scheduler.run({'slow': gate})
+        assert dropped == {'slow': ps.EnsembleScheduler.TIMEOUT}
+    assert scheduler.get_metrics()["models"]["slow"]["deprioritized"]
+
+    # 降级期间直接跳过，不再提交推理
+    calls = gate.calls
+    _, dropped = scheduler.run({'slow': gate})
+    assert dropped == {'slow': ps.EnsembleScheduler.DEPRIORITIZED}
+    assert gate.calls == calls
+
+
+def test_only_one_probe_after_deprioritization_expires(make_scheduler):
+    scheduler = make_scheduler(deprioritize_seconds=0.05)
+    stuck = make_scheduler.gate()
+    scheduler.run({'model': stuck})
+    time.sleep(0.06)
+
+    probe = make_scheduler.gate()
+    probe_result = {}
+
+    def run_probe():
+        probe_result["results"], probe_result["dropped"] = scheduler.run({'model': probe})
+
+    thread = threading.Thread(target=run_probe)
+    thread.start()
+    for _ in range(100):
+        if probe.calls:
+            break
+        time.sleep(0.005)
+    assert probe.calls == 1
+
+    # 试探进行期间其他请求仍跳过该模型
+    other = make_scheduler.gate()
+    _, dropped = scheduler.run({'model': other})
+    assert dropped == {'model': ps.EnsembleScheduler.DEPRIORITIZED}
+    assert other.calls == 0
+
+    probe.release()
+    thread.join()
+    assert probe_result["dropped"] == {}
+    # 试探按时完成: 恢复正常
+    results, dropped = scheduler.run({'model': lambda: 'ok'})
+    assert results == {'model': 'ok'} and dropped == {}
+
+
+def test_failed_probe_deprioritizes_again(make_scheduler):
+    scheduler = make_scheduler(deprioritize_seconds=0.05)
+    scheduler.run({'model': make_scheduler.gate()})
+    time.sleep(0.06)
+
+    _, dropped = scheduler.run({'model': make_scheduler.gate()})
+    assert dropped == {'model': ps.EnsembleScheduler.TIMEOUT}
+    _, dropped = scheduler.run({'model': lambda: 'ok'})
+    assert dropped == {'model': ps.EnsembleScheduler.DEPRIORITIZED}
+
+
+def test_busy_model_is_skipped_while_stragglers_run(make_scheduler):
+    scheduler = make_scheduler(miss_limit=10, max_stragglers=2)
+    gate = make_scheduler.gate()
+    for _ in range(2):
+        scheduler.run({'model': gate})
+    calls = gate.calls
+    _, dropped = scheduler.run({'model': gate})
+    assert dropped == {'model': ps.EnsembleScheduler.BUSY}
+    assert gate.calls == calls
@@ -0,0 +1,76 @@
+"""
+单例预测缓存测试: 缓存键、LRU 淘汰、过期、结果副本和不完整结果不缓存。不需要模型文件。
+"""
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from Predict.app.services import predictor_service as ps
+
+
+def result(probability=0.5, **extra):
+    return {"probabilities": {"xgboost": probability}, "risk_level": "中风险", **extra}
+
+
+def test_key_depends_on_features_and_model_version():
+    row = np.array([1.0, 2.0, 3.0])
+    key = ps.PredictionCache.make_key(row, version=1)
+    assert key == ps.PredictionCache.make_key([[1.0, 2.0, 3.0]], version=1)
+    assert key != ps.PredictionCache.make_key(row, version=2)
+    assert key != ps.PredictionCache.make_key(np.array([1.0, 2.0, 3.5]), version=1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ps.PredictionCache(max_entries=2, ttl_seconds=60, enabled=True)
+    cache.put("a", result(0.1))
+    cache.put("b", result(0.2))
+    assert cache.get("a") is not None  # a 变为最近使用
+    cache.put("c", result(0.3))
+
+    assert cache.get("b") is None
+    assert cache.get("a")["probabilities"]["xgboost"] == 0.1
+    assert cache.get("c")["probabilities"]["xgboost"] == 0.3
+    metrics = cache.get_metrics()
+    assert metrics["entries"] == 2
+    assert metrics["evictions"] == 1
+    assert metrics["hits"] == 3 and metrics["misses"] == 1
+
+
+def test_expired_entry_is_a_miss():
+    cache = ps.PredictionCache(max_entries=4, ttl_seconds=0.01, enabled=True)
+    cache.put("a", result())
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.get_metrics()["expirations"] == 1
+
+
+def test_returns_copies():
+    cache = ps.PredictionCache(max_entries=4, ttl_seconds=60, enabled=True)
+    stored = result(0.4)
+    cache.put("a", stored)
+    stored["probabilities"]["xgboost"] = 0.9
+    first = cache.get("a")
+    first["probabilities"]["xgboost"] = 0.8
+    assert cache.get("a")["probabilities"]["xgboost"] == 0.4
+
+
+@pytest.mark.parametrize("incomplete", [{"models_dropped": {"xgboost": "timeout"}},
+                                        {"models_failed": {"xgboost": "error"}}])
+def test_incomplete_results_are_not_cached(incomplete):
+    cache = ps.PredictionCache(max_entries=4, ttl_seconds=60, enabled=True)
+    cache.put("a", result(**incomplete))
+    assert cache.get("a") is None
+
+
+def test_clear_and_disabled():
+    cache = ps.PredictionCache(max_entries=4, ttl_seconds=60, enabled=True)
+    cache.put("a", result())
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.get_metrics()["invalidations"] == 1
+
+    disabled = ps.PredictionCache(max_entries=4, ttl_seconds=60, enabled=False)
+    disabled.put("a", result())
+    assert disabled.get("a") is None
@@ -0,0 +1,80 @@
+"""
+预测历史批量写入测试: 按块提交事务、关闭时写入剩余行、批量任务失败时删除本批次的记录。
+数据库引擎替换为临时 SQLite 数据库。
+"""
+import json
+
+import pytest
+
+sqlalchemy = pytest.importorskip("sqlalchemy")
+pytest.importorskip("pymysql")
+
+from Predict.app.services import db
+
+CREATE_PREDICTION_HISTORY_SQL = """
+    CREATE TABLE prediction_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT, username TEXT, prediction_type TEXT, batch_id TEXT,
+        input_data TEXT, prediction_result TEXT, risk_level TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'history.db'}")
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(CREATE_PREDICTION_HISTORY_SQL))
+    monkeypatch.setattr(db, 'engine', engine)
+    yield engine
+    engine.dispose()
+
+
+def history_rows(n, offset=0):
+    for i in range(offset, offset + n):
+        yield {"患者ID": i}, {"prediction": i % 2, "probability": i / 10}, '高风险' if i % 2 else '低风险'
+
+
+def stored(engine, batch_id=None):
+    query = "SELECT user_id, username, prediction_type, batch_id, input_data, prediction_result, risk_level FROM prediction_history"
+    params = {}
+    if batch_id is not None:
+        query += " WHERE batch_id = :batch_id"
+        params["batch_id"] = batch_id
+    with engine.connect() as connection:
+        return connection.execute(sqlalchemy.text(query + " ORDER BY id"), params).fetchall()
+
+
+def test_rows_are_committed_in_chunks(engine):
+    writer = db.PredictionHistoryWriter('7', 'bob', "batch", "b1", chunk_rows=3)
+    writer.extend(history_rows(7))
+    assert len(stored(engine)) == 6 and writer.chunks == 2
+
+    stats = writer.close()
+    assert stats["rows"] == 7 and stats["chunks"] == 3
+    rows = stored(engine)
+    assert len(rows) == 7
+    user_id, username, prediction_type, batch_id, input_data, prediction_result, risk_level = rows[1]
+    assert (user_id, username, prediction_type, batch_id) == ('7', 'bob', "batch", "b1")
+    assert json.loads(input_data) == {"患者ID": 1}
+    assert json.loads(prediction_result) == {"prediction": 1, "probability": 0.1}
+    assert risk_level == '高风险'
+
+
+def test_discard_removes_only_this_batch(engine):
+    db.save_prediction_history_bulk(history_rows(4), '1', 'alice', batch_id="kept", chunk_rows=2)
+    writer = db.PredictionHistoryWriter('7', 'bob', "batch", "cancelled", chunk_rows=2)
+    writer.extend(history_rows(5))
+    assert len(stored(engine, "cancelled")) == 4
+
+    writer.discard()
+    assert stored(engine, "cancelled") == []
+    assert len(stored(engine, "kept")) == 4
+    assert writer.rows == 0
+
+
+def test_bulk_save_accepts_a_generator(engine):
+    stats = db.save_prediction_history_bulk(history_rows(2500), '1', 'alice', batch_id="g", chunk_rows=1000)
+    assert stats["rows"] == 2500 and stats["chunks"] == 3
+    assert len(stored(engine, "g")) == 2500
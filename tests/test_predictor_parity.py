@@ -0,0 +1,55 @@
+"""
+预测服务的推理一致性回归测试
+
+加载模型目录中的四个模型，校验:
+- 单行推理与整批推理得到的概率一致 (单例接口与批量接口的结果不应随批量大小变化)
+- 由 predict_proba 推导的类别与各模型 predict() 一致
+
+模型文件缺失 (服务会用模拟模型代替) 的模型跳过。
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+from Predict.app.services import predictor_service as ps
+from Predict.app.services import tree_engine
+
+MODEL_KEYS = list(ps.MODEL_NAMES)
+
+
+def tolerance_for(model_key):
+    # XGBoost 输出 float32 概率
+    return tree_engine.XGB_PARITY_TOLERANCE if model_key == 'xgboost' else tree_engine.PARITY_TOLERANCE
+
+
+@pytest.mark.parametrize("model_key", MODEL_KEYS)
+def test_single_row_matches_batch(loaded_model, cohort, model_key):
+    model = loaded_model(model_key)
+    batch = ps.model_predict_proba(model, cohort)
+    single = np.vstack([ps.model_predict_proba(model, cohort[i:i + 1]) for i in range(len(cohort))])
+    assert batch.shape == (len(cohort), 2)
+    np.testing.assert_allclose(single, batch, rtol=0, atol=tolerance_for(model_key))
+
+
+@pytest.mark.parametrize("model_key", MODEL_KEYS)
+def test_classes_from_proba_match_predict(loaded_model, cohort, model_key):
+    model = loaded_model(model_key)
+    frame = pd.DataFrame(cohort, columns=ps.EXPECTED_FEATURES)
+    proba = model.predict_proba(frame)
+    derived = ps.classes_from_proba(model_key, model, proba)
+    expected = model.predict(frame)
+    np.testing.assert_array_equal(derived, expected)
+    assert derived.dtype.kind == expected.dtype.kind
+
+
+def test_predict_rows_single_matches_batch(model_set, cohort):
+    rows = cohort[:50]
+    batch = ps.predict_rows(rows, model_set, cascade=False)
+    for i, expected in enumerate(batch):
+        single = ps.predict_rows(rows[i:i + 1], model_set, cascade=False)[0]
+        assert single["predictions"] == expected["predictions"]
+        assert single["risk_level"] == expected["risk_level"]
+        assert single["models_evaluated"] == expected["models_evaluated"]
+        for model_key, probability in expected["probabilities"].items():
+            assert single["probabilities"][model_key] == pytest.approx(probability, abs=tolerance_for(model_key))
@@ -0,0 +1,104 @@
+"""
+产物保留策略测试
+
+在临时目录中运行清理: 容量预算按最近访问时间淘汰、下载会刷新访问时间、同组文件一起删除，
+以及按批量结果目录的实际策略 (后缀、分组、在使用判断) 校验容量预算不会删除未结束批量任务的文件。
+"""
+import json
+import os
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from Predict.app.services import predictor_service as ps
+
+
+def write_file(directory, name, content, age_seconds):
+    path = directory / name
+    path.write_text(content, encoding='utf-8')
+    stamp = time.time() - age_seconds
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def write_job(directory, job_id, status, age_seconds, heartbeat_age=None):
+    state = {"job_id": job_id, "status": status, "pid": os.getpid(),
+             "heartbeat_at": time.time() - (age_seconds if heartbeat_age is None else heartbeat_age)}
+    return write_file(directory, f"batch_{job_id}_job.json", json.dumps(state), age_seconds)
+
+
+def test_budget_evicts_least_recently_downloaded_first(tmp_path):
+    for name, age in (("a.pdf", 300), ("b.pdf", 200), ("c.pdf", 100)):
+        write_file(tmp_path, name, "x" * 100, age)
+    write_file(tmp_path, "notes.txt", "x" * 1000, 400)  # 后缀不在策略中，不参与清理
+    policy = ps.ArtifactRetention('reports', tmp_path, 250, 0, ('.pdf',))
+    janitor = ps.RetentionJanitor([policy], enabled=False)
+    # 最早生成的文件刚被下载过，不应被淘汰
+    janitor.touch(tmp_path / "a.pdf")
+
+    assert janitor.sweep_all() == {"reports": ["b.pdf"]}
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.pdf", "c.pdf", "notes.txt"]
+    metrics = policy.get_metrics()
+    assert metrics["files"] == 2 and metrics["bytes"] == 200
+    assert metrics["evictions_by_reason"] == {"age": 0, "budget": 1}
+
+
+def test_age_limit_and_groups(tmp_path):
+    write_file(tmp_path, "batch_old_results.xlsx", "old", 3 * 86400)
+    write_file(tmp_path, "batch_old_report.pdf", "old", 60)  # 同组文件按组内最近的访问时间判断
+    write_file(tmp_path, "batch_stale_results.csv", "stale", 3 * 86400)
+    write_file(tmp_path, "batch_stale_manifest.json", "{}", 2 * 86400)
+    write_file(tmp_path, "batch_stale_results.csv.part", "tmp", 3 * 86400)  # 写入中的结果文件不参与清理
+    policy = ps.ArtifactRetention('batch_results', tmp_path, 0, 86400, ('.xlsx', '.csv', '.pdf', '.json'),
+                                  group_key=ps.batch_artifact_group)
+
+    assert sorted(policy.sweep()) == ["batch_stale_manifest.json", "batch_stale_results.csv"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "batch_old_report.pdf", "batch_old_results.xlsx", "batch_stale_results.csv.part"]
+
+
+def batch_policy(directory, max_bytes=1, max_age_seconds=0):
+    policy = ps.retention_janitor.policies['batch_results']
+    return ps.ArtifactRetention('batch_results', directory, max_bytes, max_age_seconds, policy.suffixes,
+                                group_key=policy.group_key, in_use=policy.in_use)
+
+
+def test_budget_skips_unfinished_jobs(tmp_path):
+    # 未结束的任务最早提交 (最久未访问)，按访问时间排序会最先被淘汰
+    write_file(tmp_path, "batch_running_upload.csv", "a,b\n1,2\n", 3000)
+    write_job(tmp_path, "running", "processing", 3000, heartbeat_age=1)
+    write_file(tmp_path, "batch_running_results.xlsx", "partial", 3000)
+    write_file(tmp_path, "batch_queued_upload.xlsx", "queued", 2900)
+    write_job(tmp_path, "queued", "queued", 2900, heartbeat_age=1)
+    # 同步批量接口: 只有上传文件，没有状态文件
+    write_file(tmp_path, "batch_sync_upload.csv", "a,b\n", 2800)
+    # 进程已退出的任务心跳过期，不再保护
+    write_file(tmp_path, "batch_crashed_upload.csv", "a,b\n", 2700)
+    write_job(tmp_path, "crashed", "processing", 2700, heartbeat_age=ps.BATCH_JOB_STALE_SECONDS + 60)
+    write_file(tmp_path, "batch_done_results.xlsx", "done", 100)
+    write_file(tmp_path, "batch_done_manifest.json", "{}", 100)
+    write_job(tmp_path, "done", "completed", 100)
+
+    evicted = batch_policy(tmp_path).sweep()
+
+    assert sorted(evicted) == sorted([
+        "batch_crashed_upload.csv", "batch_crashed_job.json",
+        "batch_done_results.xlsx", "batch_done_manifest.json", "batch_done_job.json",
+    ])
+    remaining = sorted(path.name for path in tmp_path.iterdir())
+    assert remaining == sorted([
+        "batch_queued_job.json", "batch_queued_upload.xlsx",
+        "batch_running_job.json", "batch_running_results.xlsx", "batch_running_upload.csv",
+        "batch_sync_upload.csv",
+    ])
+
+
+def test_age_still_applies_to_abandoned_uploads(tmp_path):
+    write_file(tmp_path, "batch_old_upload.csv", "a,b\n", 10 * 86400)
+    write_file(tmp_path, "batch_new_upload.csv", "a,b\n", 60)
+
+    evicted = batch_policy(tmp_path, max_bytes=0, max_age_seconds=86400).sweep()
+
+    assert evicted == ["batch_old_upload.csv"]
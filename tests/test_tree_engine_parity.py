@@ -0,0 +1,33 @@
+"""
+树模型快速推理引擎的一致性测试
+
+随机森林向量化树引擎 (FlatForest)、XGBoost inplace_predict (XGBoostInplace) 与原模型的概率一致。
+模型文件缺失或模型类型不符时跳过。
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+from Predict.app.services import predictor_service as ps
+from Predict.app.services import tree_engine
+
+
+def test_flat_forest_matches_sklearn(loaded_model, cohort):
+    sklearn_model = tree_engine.unwrap(loaded_model('random_forest'))
+    if type(sklearn_model).__name__ != 'RandomForestClassifier':
+        pytest.skip("随机森林模型不是 RandomForestClassifier")
+    forest = tree_engine.FlatForest(sklearn_model, max_rows=len(cohort))
+    frame = pd.DataFrame(cohort, columns=ps.EXPECTED_FEATURES)
+    np.testing.assert_allclose(forest.predict_proba(frame), sklearn_model.predict_proba(frame),
+                               rtol=0, atol=tree_engine.PARITY_TOLERANCE)
+
+
+def test_xgboost_inplace_matches_wrapper(loaded_model, cohort):
+    wrapper = tree_engine.unwrap(loaded_model('xgboost'))
+    if type(wrapper).__name__ != 'XGBClassifier':
+        pytest.skip("XGBoost 模型不是 XGBClassifier")
+    engine = tree_engine.XGBoostInplace(wrapper)
+    frame = pd.DataFrame(cohort, columns=ps.EXPECTED_FEATURES)
+    np.testing.assert_allclose(engine.predict_proba(frame), wrapper.predict_proba(frame),
+                               rtol=0, atol=tree_engine.XGB_PARITY_TOLERANCE)